@@ -1,13 +1,16 @@
 from mediaprocessor.configuration_mod import configuration
+from mediaprocessor.configuration_mod.model import compile_config
 import logging
-from transitions import Machine, State
+from configobj import ConfigObj
 from mediaprocessor.processor import processor
-from mediaprocessor.fetchers.fetchers import FetchersFactory, FetcherException
-from mediaprocessor.taggers import tagger
 from mediaprocessor.helpers.helpers import breakdown
-from mediaprocessor.refreshers.refreshers import RefresherFactory
-import shutil
+from mediaprocessor.converter.containers import ContainerFactory
+from mediaprocessor.jobqueue import Journal
+from mediaprocessor import deploy
 import os
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Optional
 import sys
 
@@ -22,11 +25,15 @@ import sys
 
 log = logging.getLogger(__name__)
 
+# Tag lookups and artwork downloads run in the background while the files are converted, see prefetch_tags.
+_fetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='fetch')
+
 
 class VideoProcessor(object):
 
-    def __init__(self, infile: str, target: str, config: Union[str, dict] = None, overrides: dict = None, tagging_info: dict = None,
-                 notify: list = None):
+    def __init__(self, infile: str, target: Union[str, list], config: Union[str, dict, ConfigObj] = None,
+                 overrides: dict = None, tagging_info: dict = None, notify: list = None, processor_configs: dict = None,
+                 journal: Journal = None):
         """
         Videoprocessor contains the methods to process a video from start to finish. The steps are :
         1) Analyse the input file to determine the source source_container, and create the theoretical target source_container
@@ -36,32 +43,48 @@ class VideoProcessor(object):
         5) Deploy the output file to its destination
         6) Notify various apps of the
         :param infile: path to the input file
-        :param target: extension of source_container, e.g. mp4, mkv
-        :param config: name of the configuration file, relative to the config directory
+        :param target: extension of source_container, e.g. mp4, mkv, or a list of them. All the targets are produced
+        by a single conversion of the input, then each one is tagged, postprocessed and deployed
+        :param config: name of the configuration file, relative to the config directory, or a configuration already
+        loaded by CfgMgr, which is used as is
         :param overrides: a dictionary containing overrides to the configuration file
         :param tagging_info: a dictionary in the same form as the config file. Does not need to contain all
         the configuration file entries, just those you want to override
         :param notify: a dictionary holding the list of applications to notify
+        :param processor_configs: ProcessorConfigs already built from config, by target, so that processing several
+        files does not build them again for each one
+        :param journal: Journal recording every state reached, so that processing can resume after a crash
         """
-        conf = configuration.CfgMgr()
-
-        if config:
+        if isinstance(config, ConfigObj):
+            self.config = config
+        elif config:
+            conf = configuration.CfgMgr()
             try:
                 conf.load(config, overrides=overrides)
                 self.config = conf.cfg
             except FileNotFoundError:
                 raise Exception('Config %s is not available in config directory', config)
         else:
-            self.config = conf.defaultconfig
+            self.config = configuration.CfgMgr().defaultconfig
+        self.settings = compile_config(self.config)
 
-        if target in self.config['Containers'].keys():
-            self.target = target
-        else:
-            raise Exception(f'Unsupported source_container, valid containers are {self.config.keys()}')
+        self.targets = [target] if isinstance(target, str) else list(target)
+        for t in self.targets:
+            if t not in self.settings.containers:
+                raise Exception(f'Unsupported source_container, valid containers are {list(self.settings.containers)}')
+        if not self.targets:
+            raise Exception('No target container')
+        self.target = self.targets[0]
 
         self.copy_folder = None
         self.move_folder = None
-        self.output_container = None
+        self.output_containers = {}
+        self.deployed_files = []
+        # Bytes written again after the conversion, by the post processors
+        self.rewritten_bytes = 0
+        # How each file was copied or moved to its destination, and the bytes that took, see deploy.copy_file
+        self.deploy_reports = []
+        self.deployed_bytes = 0
 
         path = os.path.abspath(infile)
         if os.path.isfile(path):
@@ -69,39 +92,126 @@ class VideoProcessor(object):
         else:
             raise FileNotFoundError(f'File {path} does not exist')
 
-        if self.config['File'].get('work_directory') and os.path.isdir(self.config['File'].get('work_directory')):
-            self.work_dir = os.path.abspath(self.config['File'].get('work_directory'))
+        file_settings = self.settings.file
+        if file_settings.work_directory and os.path.isdir(file_settings.work_directory):
+            self.work_dir = os.path.abspath(file_settings.work_directory)
         else:
             self.work_dir = os.path.abspath(breakdown(self.inputfile)['dir'])
 
-        if self.config['File'].get('copy_to') and os.path.isdir(self.config['File'].get('copy_to')):
-            self.copy_folder = os.path.abspath(self.config['File'].get('copy_to'))
+        if file_settings.copy_to and os.path.isdir(file_settings.copy_to):
+            self.copy_folder = os.path.abspath(file_settings.copy_to)
 
-        if self.config['File'].get('move_to') and os.path.isdir(
-                self.config['File'].get('move_to')) and not self.copy_folder:
-            self.move_folder = os.path.abspath(self.config['File'].get('move_to'))
+        if file_settings.move_to and os.path.isdir(file_settings.move_to) and not self.copy_folder:
+            self.move_folder = os.path.abspath(file_settings.move_to)
 
-        self.delete_original = self.config['File'].get('delete_original')
+        self.delete_original = file_settings.delete_original
+        self.hardlink_copies = file_settings.hardlink_copies
 
         self.tagging_info = tagging_info
-        self.tv_fetcher = self.config['Tagging'].get('preferred_show_tagger', 'tvdb')
-        self.movie_fetcher = self.config['Tagging'].get('preferred_movie_tagger', 'tmdb')
-        self.download_artwork = self.config['Tagging'].get('download_artwork')
+        self.tv_fetcher = self.settings.tagging.preferred_show_tagger
+        self.movie_fetcher = self.settings.tagging.preferred_movie_tagger
+        self.download_artwork = self.settings.tagging.download_artwork
 
-        work_file = os.path.join(self.work_dir, breakdown(self.inputfile)['file'] + '-working.' + self.target)
+        # The working files are written in move_to, under a hidden name, so that deploying them is a rename
+        self.write_to_destination = False
+        if file_settings.write_to_destination and self.move_folder:
+            if os.access(self.move_folder, os.W_OK):
+                self.write_to_destination = True
+            else:
+                log.error('Directory %s is not writeable, working in %s', self.move_folder, self.work_dir)
 
-        self.processor = processor.Processor(self.config, self.inputfile, work_file, self.target)
+        if self.write_to_destination:
+            outputs = [(t, os.path.join(self.move_folder, '.' + breakdown(self.inputfile)['file'] + '-working.' + t))
+                       for t in self.targets]
+        else:
+            outputs = [(t, os.path.join(self.work_dir, breakdown(self.inputfile)['file'] + '-working.' + t))
+                       for t in self.targets]
+
+        self.processor = processor.MultiProcessor(self.config, self.inputfile, outputs,
+                                                  processor_configs=processor_configs)
+        self._progress = None
+        self._plan = None
+        self._tags = None
+        self._tags_future = None
+        self._tags_lock = threading.Lock()
+        self.journal = journal
         self.refreshers = []
 
         if notify:
+            from mediaprocessor.refreshers.refreshers import RefresherFactory
             for r in notify:
-                if r in self.config['Refreshers']:
-                    refresher = RefresherFactory.get_refesher(r, **self.config['Refreshers'][r])
+                if r in self.settings.refreshers:
+                    refresher = RefresherFactory.get_refesher(r, **self.settings.refreshers[r].options)
                     if refresher:
                         self.refreshers.append(refresher)
 
+    def plan(self) -> dict:
+        """What the conversion will do, a working file made from a different plan cannot be reused."""
+        if self._plan is None:
+            self._plan = {'command': [str(c) for c in self.processor.commandline()]}
+        return self._plan
+
+    def save_state(self):
+        """Records the state just reached in the journal, called after every transition."""
+        if not self.journal:
+            return
+        if self.state == 'finished':
+            self.journal.forget(self.inputfile)
+            return
+        work_files = {target: container.file_path for target, container in self.output_containers.items()}
+        self.journal.save(self.inputfile, self.state, self.targets, self.plan(), work_files)
+
+    def resume_state(self) -> str:
+        """
+        State to start from, the last one journaled for the file if it can be resumed. States between the conversion
+        and the deployment need the working files, which must still be there, unchanged, readable by ffprobe, and made
+        from the same plan; the conversion is done again otherwise.
+        """
+        entry = self.journal.load(self.inputfile, self.targets) if self.journal else None
+        if entry is None:
+            return 'initialised'
+
+        state = entry['state']
+        if state in ['processed', 'tagged', 'postprocessed']:
+            if entry['plan'] != self.plan():
+                log.info('The conversion of %s changed since it was interrupted, starting over', self.inputfile)
+                return 'initialised'
+
+            containers = {}
+            for target, (work_file, size) in entry['work_files'].items():
+                container = self.verify_work_file(work_file, size)
+                if container is None:
+                    log.info('Working file %s cannot be reused, starting over', work_file)
+                    return 'initialised'
+                containers[target] = container
+            self.output_containers = containers
+
+        log.info('Resuming %s from state %s', self.inputfile, state)
+        return state
+
+    def verify_work_file(self, work_file, size):
+        """Returns the container of a working file left by an interrupted run, None if it is not usable."""
+        try:
+            if os.path.getsize(work_file) != size:
+                return None
+            container = ContainerFactory.container_from_parser(self.processor.first.config.ffmpeg.probe(work_file))
+        except Exception:
+            return None
+
+        duration = self.processor.source_container.duration
+        if duration and container.duration and abs(container.duration - duration) > 1:
+            # Truncated
+            return None
+        container.file_path = work_file
+        return container
+
+    @property
+    def output_container(self):
+        """Output container of the first target, None until the file is processed"""
+        return self.output_containers.get(self.target)
+
     def conversion_success(self):
-        if self.output_container and os.path.exists(self.output_container.file_path):
+        if self.output_containers and all(os.path.exists(ctn.file_path) for ctn in self.output_containers.values()):
             return True
         return False
 
@@ -133,21 +243,80 @@ class VideoProcessor(object):
         Processes the sourcefile into a target source_container
         :return: None
         """
-        for k in self.processor.process():
-            self._progress = k
+        self.mux_tags()
+        for event in self.processor.process():
+            self._progress = event
+
+        self.output_containers = self.processor.target_containers  # type: dict
+
+    async def process_async(self):
+        """
+        The process transition for asyncio: the file is converted on the running loop, then the machine moves to
+        processed as if process had been triggered.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.mux_tags)
+        async for event in self.processor.process_async():
+            self._progress = event
 
-        self.output_container = self.processor.target_container  # type: converter.containers.Container
+        self.output_containers = self.processor.target_containers  # type: dict
+        self.to_processed()
 
     @property
     def progress(self):
+        """Last ProgressEvent of the conversion, None until it has started"""
         return self._progress
 
-    def do_tag(self):
+    def subscribe(self, callback, interval=None):
+        """
+        Registers callback to receive ProgressEvents while the file is processed.
+        :param callback: callable taking a ProgressEvent
+        :param interval: minimum number of seconds between two calls, defaults to FFMPEG.progress_interval
+        :return: a token for unsubscribe
+        """
+        return self.processor.subscribe(callback, interval)
+
+    def unsubscribe(self, token):
+        self.processor.unsubscribe(token)
+
+    def cancel(self, graceful=True):
+        """
+        Stops the conversion of the file, if it is running, and removes the partially written working file.
+        :param graceful: ask ffmpeg to quit before resorting to signals
+        :return: True if no ffmpeg is running anymore
+        """
+        return self.processor.cancel(graceful)
+
+    def prefetch_tags(self):
+        """Starts looking the tags up in the background, so that the lookup overlaps the conversion."""
+        with self._tags_lock:
+            if self._tags is None and self._tags_future is None and self.has_tag_info():
+                self._tags_future = _fetch_executor.submit(self._fetch_tags)
+
+    def fetch_tags(self):
+        """
+        Looks the tags up and downloads the artwork, or waits for prefetch_tags to have done it. Only done once,
+        whenever convenient before do_tag, which uses the result.
+        :return: (tags, poster_file), tags is None if they could not be fetched
+        """
+        with self._tags_lock:
+            future = self._tags_future
+            if self._tags is None and future is None:
+                self._tags = self._fetch_tags()
+        if future is not None:
+            # Raises what the lookup raised, as if it had been done here
+            tags = future.result()
+            with self._tags_lock:
+                self._tags, self._tags_future = tags, None
+        return self._tags
+
+    def _fetch_tags(self):
+        from mediaprocessor.fetchers.fetchers import FetchersFactory, FetcherException
+
         _id = self.tagging_info.get('id', None)
         id_type = self.tagging_info.get('id_type', None)
         season = self.tagging_info.get('season', None)
         episode = self.tagging_info.get('episode', None)
-        language = self.config['Languages'].get('tagging')
+        language = self.settings.languages.tagging
 
         fetcher = self.tv_fetcher if season else self.movie_fetcher
 
@@ -155,65 +324,124 @@ class VideoProcessor(object):
             ftch = FetchersFactory.getfetcher(fetcher, _id, id_type, language=language, season=season, episode=episode)
             tags = ftch.gettags()
         except FetcherException:
-            return None
+            return None, None
 
         if tags.poster_url and self.download_artwork:
             poster_file = ftch.downloadArtwork(tags.poster_url)
         else:
             poster_file = None
 
-        t = tagger.TaggerFactory.get_tagger(self.target, tags, self.output_container.file_path,
-                                            artwork_file=poster_file, is_hd=self.output_container.hd)
-        if t:
-            t.writetags()
-        else:
-            log.info('Tagging is not supported for source_container %s at this time, skipping',
-                     self.target)
+        return tags, poster_file
+
+    def mux_tags(self):
+        """
+        With Tagging.mux_tags, waits for the tags and hands them to the processors, so that ffmpeg writes them while
+        muxing instead of do_tag rewriting the file. Targets whose conversion could not take them (chunked or
+        several targets in one command) are tagged by do_tag as usual.
+        """
+        if not self.settings.tagging.mux_tags or not self.has_tag_info():
+            return
+
+        # The journaled plan is the conversion's, a resumed file has no tags to compare.
+        self.plan()
+        tags, poster_file = self.fetch_tags()
+        if tags is None:
+            return
+
+        from mediaprocessor.taggers import tagger
+        for target, processor in self.processor.processors.items():
+            processor.plan()
+            metadata = tagger.TaggerFactory.get_mux_metadata(target, tags, is_hd=processor.target_container.hd)
+            if metadata is not None:
+                processor.metadata = metadata
+                processor.cover = poster_file
+
+    def do_tag(self):
+        from mediaprocessor.taggers import tagger
+
+        tags, poster_file = self.fetch_tags()
+        if tags is None:
+            return None
+
+        for target, container in self.output_containers.items():
+            if self.processor.processors[target].tags_muxed:
+                log.debug('%s was tagged by ffmpeg', container.file_path)
+                continue
+            t = tagger.TaggerFactory.get_tagger(target, tags, container.file_path,
+                                                artwork_file=poster_file, is_hd=container.hd)
+            if t:
+                t.writetags()
+            else:
+                log.info('Tagging is not supported for source_container %s at this time, skipping', target)
 
     def do_postprocess(self):
         from mediaprocessor.postprocesses import PostProcessorFactory
-        try:
-            postprocesses = PostProcessorFactory.get_post_processors(
-                self.config['Containers'][self.target].get('post_processors'))
-        except:
-            log.info('No post processing needed')
-            postprocesses = None
+        for target, container in self.output_containers.items():
+            try:
+                postprocesses = PostProcessorFactory.get_post_processors(
+                    self.settings.containers[target].post_processors)
+            except:
+                log.info('No post processing needed')
+                postprocesses = None
 
-        if postprocesses:
-            for postprocess in postprocesses:
-                postprocess().process(self.output_container.file_path)
+            if postprocesses:
+                for postprocess in postprocesses:
+                    written = postprocess().process(container.file_path) or 0
+                    self.rewritten_bytes += written
+                    log.info('%s rewrote %d bytes of %s', postprocess.name, written, container.file_path)
 
     def do_deploy(self):
+        for target, container in self.output_containers.items():
+            self.deploy_target(target, container)
+
+    def deploy_target(self, target, container):
         path_elements = breakdown(self.inputfile)
+        if self.move_folder and os.path.dirname(container.file_path) == self.move_folder:
+            # Written in place, see write_to_destination
+            destination = os.path.join(self.move_folder, path_elements['file'] + '.' + target)
+            self._deployed(destination, deploy.move_file(container.file_path, destination))
+            self.deployed_files.append(destination)
+            return
+
         try:
-            os.rename(self.output_container.file_path, os.path.join(self.work_dir,
-                                                                    path_elements['file'] + '.' + self.target))
-            infile = os.path.join(self.work_dir, path_elements['file'] + '.' + self.target)
+            os.rename(container.file_path, os.path.join(self.work_dir, path_elements['file'] + '.' + target))
+            infile = os.path.join(self.work_dir, path_elements['file'] + '.' + target)
         except FileNotFoundError:
             raise FileNotFoundError
+        self.deployed_files.append(infile)
 
         if self.copy_folder:
+            destination = os.path.join(self.copy_folder, path_elements['file'] + '.' + target)
             if os.access(self.copy_folder, os.W_OK):
                 try:
-                    shutil.copy2(infile,
-                                 os.path.join(self.copy_folder, path_elements['file'] + '.' + self.target))
+                    report = deploy.copy_file(infile, destination, hardlink=self.hardlink_copies)
+                    self.deployed_files.append(destination)
                 except:
                     raise Exception('Error while copying file')
+                self._deployed(destination, report)
             else:
                 log.error('Directory %s is not writeable', self.copy_folder)
 
-            log.info('%s copied to folder(s)  %s', self.output_container,
-                     os.path.join(self.copy_folder, path_elements['file'] + '.' + self.target))
+            log.info('%s copied to folder(s)  %s', container, destination)
 
         elif self.move_folder:
+            destination = os.path.join(self.move_folder, path_elements['file'] + '.' + target)
             if os.access(self.move_folder, os.W_OK):
                 try:
-                    os.rename(infile, os.path.join(self.move_folder, path_elements['file'] + '.' + self.target))
+                    report = deploy.move_file(infile, destination)
+                    self.deployed_files[-1] = destination
+                    self._deployed(destination, report)
                 except:
                     log.exception('Error while moving file')
             else:
                 log.error('Directory %s is not writeable', self.move_folder)
 
+    def _deployed(self, destination, report):
+        report = dict(report, path=destination)
+        self.deploy_reports.append(report)
+        self.deployed_bytes += report['bytes']
+        log.info('Deployed %s with %s, %d bytes copied', destination, report['primitive'], report['bytes'])
+
     def do_delete(self):
         try:
             os.chmod(self.inputfile, int("0777", 8))
@@ -232,9 +460,15 @@ class VideoProcessor(object):
             r.refresh('movie')
 
 
-def build_machine(infile, target, config, tagging_info=None, notify=None):
-    videoprocessor = VideoProcessor(infile, target, config, tagging_info=tagging_info, notify=notify)
-    machine = Machine(model=videoprocessor, initial='initialised')
+def build_machine(infile, target, config, tagging_info=None, notify=None, processor_configs=None, journal=None):
+    from transitions import Machine, State
+
+    videoprocessor = VideoProcessor(infile, target, config, tagging_info=tagging_info, notify=notify,
+                                    processor_configs=processor_configs, journal=journal)
+    initial = videoprocessor.resume_state()
+    # A resumed machine is asked for the transitions it already went through, they are skipped.
+    machine = Machine(model=videoprocessor, initial='initialised', after_state_change='save_state',
+                      ignore_invalid_triggers=initial != 'initialised')
 
     states = ['initialised',
               State(name='processed'),
@@ -247,6 +481,10 @@ def build_machine(infile, target, config, tagging_info=None, notify=None):
               ]
 
     machine.add_states(states)
+    if initial != 'initialised':
+        machine.set_state(initial)
+    if initial in ['initialised', 'processed']:
+        videoprocessor.prefetch_tags()
 
     machine.add_transition(trigger='process', source='initialised', dest='processed',
                            before='do_process')
@@ -0,0 +1,48 @@
+"""
+Module aio.py
+asyncio interface to the VideoProcessor state machine, for hosts running an event loop. run drives a machine through
+the same stages as start_machine: the conversion runs on the loop through converter.aio, so that one loop can
+supervise many jobs, and the other steps, which are short, run in an executor so that they do not block it.
+The fetchers and refreshers are built on blocking HTTP libraries (tmdbsimple, tvdb_api, requests), they run in the
+executor too.
+"""
+import asyncio
+import logging
+from functools import partial
+
+from mediaprocessor.Videoprocessor import VideoProcessor, build_machine
+
+log = logging.getLogger(__name__)
+
+
+async def build(infile, target, config, tagging_info=None, notify=None, processor_configs=None,
+                journal=None, executor=None) -> VideoProcessor:
+    """build_machine without blocking the loop, it probes the file. See build_machine for the parameters."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(build_machine, infile, target, config,
+                                                        tagging_info=tagging_info, notify=notify,
+                                                        processor_configs=processor_configs, journal=journal))
+
+
+async def fetch_tags(job: VideoProcessor, executor=None):
+    """VideoProcessor.fetch_tags without blocking the loop, it waits for the lookup started by build_machine."""
+    return await asyncio.get_running_loop().run_in_executor(executor, job.fetch_tags)
+
+
+async def run(job: VideoProcessor, executor=None) -> VideoProcessor:
+    """
+    Drives a machine built by build_machine, or build, to the end, as start_machine does. Cancelling the task stops
+    the conversion and removes its partial outputs, the machine stays in the state it had reached.
+    :param job: the VideoProcessor
+    :param executor: executor for the blocking steps, the loop's default executor if None
+    :return: job
+    """
+    loop = asyncio.get_running_loop()
+    if job.state == 'initialised':
+        await job.process_async()
+    if job.state == 'processed' and job.has_tag_info():
+        await fetch_tags(job, executor)
+
+    for step in [job.tag, job.postprocess, job.deploy, job.delete, job.refresh, job.finish]:
+        await loop.run_in_executor(executor, step)
+    return job
@@ -0,0 +1,432 @@
+"""
+Module cli.py
+The mediaprocessor command. Processes every video found in the files, directories and globs given on the command
+line, running the VideoProcessor state machine over a pool of worker processes. Each worker loads the configuration
+once, and reuses its ProcessorConfigs for every file it is given; they are built before the workers are forked where
+possible, so that the workers share them.
+"""
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+log = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('avi', 'm2ts', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 'ts', 'webm', 'wmv')
+
+# State of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def iter_files(paths, extensions=VIDEO_EXTENSIONS, recursive=True):
+    """
+    Yields the files designated by paths, lazily, so that processing can start before large trees are walked.
+    Directories are walked for files with one of the extensions, globs are expanded. Files given explicitly are
+    yielded whatever their extension. No file is yielded twice.
+    :param paths: files, directories or glob patterns
+    :param extensions: extensions, without the dot, of the files picked up in directories
+    :param recursive: whether to walk subdirectories
+    """
+    extensions = tuple('.' + e.lower().lstrip('.') for e in extensions)
+    seen = set()
+
+    def walk(directory):
+        if not recursive:
+            for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+                if entry.is_file() and entry.name.lower().endswith(extensions):
+                    yield entry.path
+            return
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    yield os.path.join(root, name)
+
+    for path in paths:
+        if glob.has_magic(path):
+            matches = glob.iglob(path, recursive=recursive)
+        else:
+            matches = [path]
+
+        for match in matches:
+            if os.path.isdir(match):
+                candidates = walk(match)
+            elif os.path.isfile(match):
+                candidates = [match]
+            else:
+                log.warning('%s does not exist, skipping', match)
+                continue
+
+            for candidate in candidates:
+                candidate = os.path.abspath(candidate)
+                if candidate not in seen:
+                    seen.add(candidate)
+                    yield candidate
+
+
+def _init_worker(config, workers, journal=None, pids=None):
+    from mediaprocessor.converter.jobs import JobRegistry
+    from mediaprocessor.jobqueue import Journal
+
+    if pids is not None:
+        pids.report()
+
+    # Forked workers inherit the handlers of their parent, a watch daemon's would keep them from exiting.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, _interrupt)
+
+    _worker['config'] = _worker_config(config, workers)
+    _worker['config_name'] = config
+    _worker['workers'] = workers
+    _worker['journal'] = Journal(journal) if journal else None
+    JobRegistry.default().install_signal_handlers()
+
+
+def _interrupt(signum, frame):
+    # The pool is being shut down: the file being processed is given up, and so are those already handed to the
+    # worker, while an idle worker waits for the shutdown.
+    _worker['interrupted'] = True
+    if _worker.get('busy'):
+        raise KeyboardInterrupt
+
+
+class WorkerPids(object):
+    """
+    Pids of the workers of a pool, which ProcessPoolExecutor does not expose. Given to _init_worker, each worker
+    reports its own through a queue.
+    """
+    def __init__(self):
+        self._queue = multiprocessing.SimpleQueue()
+        self._pids = set()
+
+    def report(self):
+        """Called in the worker."""
+        self._queue.put(os.getpid())
+
+    def __iter__(self):
+        while not self._queue.empty():
+            self._pids.add(self._queue.get())
+        return iter(sorted(self._pids))
+
+
+def interrupt_workers(pids: WorkerPids):
+    """
+    Interrupts the files being processed by the workers whose pids are given, so that the pool can be shut down
+    within seconds instead of waiting for their conversions. The workers get SIGINT, on which their JobRegistry
+    cancels the running ffmpeg, and process_file gives the file up with a KeyboardInterrupt, as it does for the files
+    the workers are given afterwards; the journal resumes them on the next run.
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+
+def _handle_signals(handler, signals=(signal.SIGTERM, signal.SIGINT)) -> dict:
+    """Installs handler for signals, returns the previous handlers. Does nothing outside of the main thread."""
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+    return {signum: signal.signal(signum, handler) for signum in signals}
+
+
+def load_config(name=None, overrides=None):
+    """
+    Loads the configuration file name, relative to the config directory, or the default configuration. Files are
+    shared by every load in the process, settings are changed through overrides, a dict in the form of the file.
+    """
+    from mediaprocessor.configuration_mod.configuration import CfgMgr
+
+    conf = CfgMgr()
+    if name:
+        conf.load(name, overrides=overrides)
+        return conf.cfg
+    cfg = conf.defaultconfig
+    if overrides:
+        cfg.merge(overrides)
+    return cfg
+
+
+def _worker_config(config, workers):
+    # Every worker has its own scheduler, the core budget is split between them.
+    return load_config(config, overrides={'FFMPEG': {'concurrent_jobs': workers}})
+
+
+def prepare_workers(config, workers, targets):
+    """
+    Builds the ProcessorConfigs of the workers before they are forked, so that they inherit them instead of each
+    building their own, and share their memory. The objects of this process are then left out of the garbage
+    collections, whose passes would write to every page and undo the sharing. Does nothing if the workers are not
+    forked.
+    :param config: name of the configuration file, as given to _init_worker
+    :param workers: number of workers, as given to _init_worker
+    :param targets: target containers
+    """
+    import gc
+    import multiprocessing
+    from mediaprocessor.processor.processor import ProcessorConfig
+
+    if multiprocessing.get_start_method() != 'fork':
+        return
+    try:
+        cfg = _worker_config(config, workers)
+        for target in targets:
+            ProcessorConfig.shared(cfg, target)
+    except Exception:
+        log.debug('Could not build the ProcessorConfigs, the workers will build their own', exc_info=True)
+        return
+    gc.freeze()
+
+
+def _current_config():
+    """
+    The configuration of the worker, in the version for the next file: the configuration file is loaded again if it
+    changed since the last one, so that a daemon's workers follow the changes. Files already started keep theirs.
+    """
+    if _worker['config_name']:
+        _worker['config'] = _worker_config(_worker['config_name'], _worker['workers'])
+    return _worker['config']
+
+
+def _processor_configs(targets, config) -> dict:
+    from mediaprocessor.processor.processor import ProcessorConfig
+
+    return {target: ProcessorConfig.shared(config, target) for target in targets}
+
+
+def process_file(path, targets, tagging_info=None, notify=None) -> dict:
+    """
+    Runs the state machine over a file, in a worker set up by _init_worker.
+    :return: dict with the path, the final state, the status (ok or failed), the error if any, the files deployed,
+    the bytes the post processors rewrote and the seconds spent
+    """
+    from mediaprocessor.Videoprocessor import build_machine, start_machine
+
+    started = time.monotonic()
+    result = {'path': path, 'state': None, 'status': 'ok', 'error': None, 'outputs': [], 'rewritten': 0,
+              'deployed': []}
+    if _worker.get('interrupted'):
+        raise KeyboardInterrupt
+    _worker['busy'] = True
+    try:
+        config = _current_config()
+        vp = build_machine(path, targets, config, tagging_info=tagging_info, notify=notify,
+                           processor_configs=_processor_configs(targets, config), journal=_worker['journal'])
+        try:
+            start_machine(vp)
+        finally:
+            result['state'] = vp.state
+            result['outputs'] = vp.deployed_files
+            result['rewritten'] = vp.rewritten_bytes
+            result['deployed'] = vp.deploy_reports
+    except Exception as e:
+        log.exception('Processing %s failed', path)
+        result['status'] = 'failed'
+        result['error'] = str(e) or e.__class__.__name__
+    finally:
+        _worker['busy'] = False
+    result['seconds'] = time.monotonic() - started
+    return result
+
+
+def run(files, targets, config=None, workers=1, notify=None, report=None, journal=None):
+    """
+    Processes files over a pool of workers processes. Files are pulled from the iterable as workers become
+    available, at most two per worker are queued at any time.
+    :param files: iterable of paths
+    :param targets: target containers, e.g. ['mp4']
+    :param config: name of the configuration file, None for the default configuration
+    :param workers: number of files processed at the same time
+    :param notify: applications to notify, see VideoProcessor
+    :param report: callable taking each result as it comes, see process_file
+    :param journal: path to the Journal database, files interrupted by a crash resume where they were. None to
+    process every file from the start
+    :return: list of results, in completion order
+    :raise KeyboardInterrupt: on SIGTERM or SIGINT, once the files being processed are interrupted
+    """
+    results = []
+    files = iter(files)
+    prepare_workers(config, workers, targets)
+    pids = WorkerPids()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(config, workers, journal, pids)) as executor:
+        def on_signal(signum, frame):
+            log.warning('Received signal %s, cancelling the running conversions', signum)
+            interrupt_workers(pids)
+            raise KeyboardInterrupt
+
+        previous = _handle_signals(on_signal)
+        pending = set()
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < 2 * workers:
+                    path = next(files, None)
+                    if path is None:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(process_file, path, targets, notify=notify))
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results.append(result)
+                    if report:
+                        report(result)
+        finally:
+            # The files queued but not started yet are dropped, the pool then only waits for the interrupted ones
+            for future in pending:
+                future.cancel()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+    return results
+
+
+def summary(results, elapsed) -> str:
+    lines = []
+    width = max([len(r['path']) for r in results] + [4])
+    for r in sorted(results, key=lambda r: r['path']):
+        line = f"{r['path']:<{width}}  {r['status']:<6}  {r['seconds']:>9.1f}s  {r['state'] or '-'}"
+        if r['error']:
+            line += f"  {r['error']}"
+        lines.append(line)
+
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    lines.append(f'{len(results)} file(s), {len(results) - failed} ok, {failed} failed in {elapsed:.1f}s')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='mediaprocessor', description='Converts, tags and deploys video files.')
+    parser.add_argument('paths', nargs='*', help='files, directories or glob patterns to process, directories to '
+                                                 'watch with --watch')
+    parser.add_argument('-t', '--target', action='append', dest='targets',
+                        help='target container, may be repeated to produce several (default: mp4)')
+    parser.add_argument('-c', '--config', help='configuration file, relative to the config directory')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of files processed at the same time')
+    parser.add_argument('-e', '--extensions', default=','.join(VIDEO_EXTENSIONS),
+                        help='comma separated extensions of the files picked up in directories')
+    parser.add_argument('--no-recursive', action='store_false', dest='recursive',
+                        help='do not walk subdirectories')
+    parser.add_argument('-n', '--notify', action='append', help='application to notify, may be repeated')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running, processing the files that appear in the directories (default: '
+                             'Watch.directories)')
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='run the steps of different files at the same time, -j sets the number of files encoded '
+                             'at the same time, the other stages are sized in the Pipeline section')
+    parser.add_argument('--no-journal', action='store_false', dest='journal',
+                        help='do not record progress, files interrupted earlier are processed from the start')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.watch:
+        return watch(args)
+    if not args.paths:
+        parser.error('no file to process')
+
+    files = iter_files(args.paths, extensions=[e for e in args.extensions.split(',') if e], recursive=args.recursive)
+
+    def report(result):
+        log.info('%s: %s in %.1fs, %d bytes rewritten, %d bytes copied to deploy', result['path'], result['status'],
+                 result['seconds'], result.get('rewritten', 0),
+                 sum(deployed['bytes'] for deployed in result.get('deployed', [])))
+
+    started = time.monotonic()
+    if args.pipeline:
+        results = pipeline(files, args, report)
+        print(summary(results, time.monotonic() - started))
+        return 0 if all(r['status'] == 'ok' for r in results) else 1
+
+    try:
+        results = run(files, args.targets or ['mp4'], config=args.config, workers=max(args.workers, 1),
+                      notify=args.notify, report=report, journal=default_journal() if args.journal else None)
+    except KeyboardInterrupt:
+        log.warning('Interrupted')
+        return 130
+
+    print(summary(results, time.monotonic() - started))
+    return 0 if all(r['status'] == 'ok' for r in results) else 1
+
+
+def pipeline(files, args, report) -> list:
+    """Processes files in this process, through a VideoPipeline sized by the Pipeline section and -j."""
+    from mediaprocessor.converter.jobs import JobRegistry
+    from mediaprocessor.jobqueue import Journal
+    from mediaprocessor.pipeline import VideoPipeline
+
+    settings = {name: dict(stage) for name, stage in load_config(args.config).get('Pipeline', {}).items()}
+    encoders = max(args.workers, settings.get('encode', {}).get('workers', 1))
+    settings.setdefault('encode', {})['workers'] = encoders
+    # The encode stage is the only one running ffmpeg, the core budget is split between its workers.
+    cfg = load_config(args.config, overrides={'FFMPEG': {'concurrent_jobs': encoders}})
+
+    journal = Journal(default_journal()) if args.journal else None
+    vpipeline = VideoPipeline(args.targets or ['mp4'], cfg, settings=settings, notify=args.notify, journal=journal,
+                              report=lambda item: report(item.result()))
+
+    def on_signal(signum, frame):
+        log.warning('Received signal %s, stopping once the files in the pipeline are through', signum)
+        vpipeline.cancel()
+        JobRegistry.default().cancel_all()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    try:
+        return vpipeline.run(files)
+    finally:
+        if journal:
+            journal.close()
+
+
+def default_journal() -> str:
+    from mediaprocessor.converter.cache import cache_directory
+    return os.path.join(cache_directory(), 'queue.sqlite')
+
+
+def watch(args):
+    from mediaprocessor.watcher import WatchDaemon
+
+    settings = load_config(args.config)['Watch']
+
+    directories = args.paths or settings.get('directories') or []
+    directories = [d for d in directories if os.path.isdir(d)]
+    if not directories:
+        log.error('No directory to watch')
+        return 2
+
+    daemon = WatchDaemon(directories, args.targets or ['mp4'],
+                         settings.get('queue') or default_journal(),
+                         config=args.config,
+                         workers=max(args.workers, 1),
+                         queue_size=settings.get('queue_size'),
+                         stability_window=settings.get('stability_window', 30),
+                         poll_interval=settings.get('poll_interval', 10),
+                         extensions=[e for e in args.extensions.split(',') if e],
+                         recursive=args.recursive,
+                         notify=args.notify,
+                         journal=args.journal)
+
+    def on_signal(signum, frame):
+        log.warning('Received signal %s, cancelling the running conversions, they are resumed on restart', signum)
+        daemon.stop()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    daemon.serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,13 @@
-from configobj import ConfigObj
+from configobj import ConfigObj, ConfigObjError
 from configobj import flatten_errors
 from typing import Union
+import hashlib
+import json
+import threading
 import validate
 import logging
-from mediaprocessor.configuration_mod.defaultconfig import configspec
+from mediaprocessor.configuration_mod.defaultconfig import get_configspec
 import os
-from mediaprocessor.helpers import languagecode
 import os
 import glob
 
@@ -13,6 +15,17 @@ log = logging.getLogger(__name__)
 
 
 class CfgMgr(object):
+    # Configuration files already loaded, by path, modification time, size and overrides. Each version of a file is
+    # validated once per process, see load.
+    _loaded = {}
+    _loaded_lock = threading.Lock()
+    # Version of each file, by path and overrides, which failed validation while a previous version was loaded. It is
+    # not read again until the file changes, see load
+    _rejected = {}
+    # Callbacks told when a new version of a file replaces the one loaded, see subscribe
+    _listeners = {}
+    _next_token = 0
+
     def __init__(self):
         #self.configdir = os.getenv('CONVERTER_CONFIG_DIR',
         #                           os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'config'))
@@ -20,17 +33,7 @@ class CfgMgr(object):
                                    os.path.join('/Users/jon/Downloads/', 'config'))
         self._usercfg = None
         self._validator = validate.Validator()
-
-        cfg = ConfigObj({},
-                        configspec=configspec,
-                        encoding='UTF8',
-                        default_encoding='UTF8',
-                        write_empty_values=True,
-                        create_empty=True,
-                        stringify=True)
-
-        cfg.validate(self._validator, copy=True)
-        self._defaultconfig = cfg
+        self._defaultconfig = None
 
     @property
     def config_directory(self):
@@ -43,8 +46,19 @@ class CfgMgr(object):
     @property
     def defaultconfig(self) -> ConfigObj:
         """
-        Contains the default configuration
+        Contains the default configuration, built the first time it is asked for
         """
+        if self._defaultconfig is None:
+            cfg = ConfigObj({},
+                            configspec=get_configspec(),
+                            encoding='UTF8',
+                            default_encoding='UTF8',
+                            write_empty_values=True,
+                            create_empty=True,
+                            stringify=True)
+
+            cfg.validate(self._validator, copy=True)
+            self._defaultconfig = cfg
         return self._defaultconfig
 
     def savedefaults(self):
@@ -57,12 +71,85 @@ class CfgMgr(object):
         """
         return self._usercfg
 
+    @property
+    def model(self):
+        """The user configuration compiled, see model.compile_config"""
+        from mediaprocessor.configuration_mod.model import compile_config
+        return compile_config(self._usercfg) if self._usercfg is not None else None
+
+    @classmethod
+    def subscribe(cls, callback) -> int:
+        """
+        Registers callback to be told when a configuration file that was loaded changes and its new version is
+        loaded, so that what was built from the previous version can be dropped. callback is called with the path of
+        the file, the previous ConfigObj and the new one, by the thread loading the new version.
+        :return: a token for unsubscribe
+        """
+        with cls._loaded_lock:
+            cls._next_token += 1
+            cls._listeners[cls._next_token] = callback
+            return cls._next_token
+
+    @classmethod
+    def unsubscribe(cls, token):
+        with cls._loaded_lock:
+            cls._listeners.pop(token, None)
+
     def load(self, config: Union[str, dict], overrides=None):
         """
         Loads userconfig and validates it.
+        A file is only read and validated the first time it is loaded with these overrides, and again when it
+        changes: loading it again gives the same ConfigObj, which must not be changed, pass overrides instead. A new
+        version replaces the previous one for the loads that follow, those which got the previous one keep it. If
+        the new version is not valid, the previous one is kept, and the invalid version is not read again until the
+        file changes.
         """
+        inifile = os.path.join(self.configdir, config) if not isinstance(config, dict) else None
+        key = None
+        previous = None
+        if inifile and os.path.exists(inifile):
+            stat = os.stat(inifile)
+            key = (os.path.abspath(inifile), stat.st_mtime_ns, stat.st_size, config_hash(overrides or {}))
+            with self._loaded_lock:
+                cached = self._loaded.get(key)
+                if cached is None:
+                    previous = next((k for k in self._loaded if k[0] == key[0] and k[3] == key[3]), None)
+                    if previous is not None and self._rejected.get((key[0], key[3])) == key:
+                        cached = self._loaded[previous]
+            if cached is not None:
+                self._usercfg = cached
+                return
+
+        try:
+            self._load(config, inifile, overrides)
+        except (ConfigException, ConfigObjError):
+            if previous is None:
+                raise
+            log.error('%s changed but is not valid anymore, keeping its previous version', inifile)
+            with self._loaded_lock:
+                self._rejected[(key[0], key[3])] = key
+                self._usercfg = self._loaded.get(previous, self._usercfg)
+            return
+
+        if key is not None:
+            with self._loaded_lock:
+                previous = next((k for k in self._loaded if k[0] == key[0] and k[3] == key[3]), None)
+                replaced = self._loaded.pop(previous) if previous else None
+                self._rejected.pop((key[0], key[3]), None)
+                self._loaded[key] = self._usercfg
+                listeners = list(self._listeners.values()) if replaced is not None else []
+
+            if listeners:
+                log.info('%s changed, reloaded it', inifile)
+            for callback in listeners:
+                try:
+                    callback(key[0], replaced, self._usercfg)
+                except Exception:
+                    log.exception('Configuration change listener %s failed', callback)
+
+    def _load(self, config, inifile, overrides):
         if overrides:
-            override_settings = ConfigObj(overrides, configspec=configspec, encoding='UTF8', default_encoding='UTF8',
+            override_settings = ConfigObj(overrides, configspec=get_configspec(), encoding='UTF8', default_encoding='UTF8',
                                           write_empty_values=False)
 
             r = override_settings.validate(self._validator, preserve_errors=True)
@@ -71,17 +158,13 @@ class CfgMgr(object):
                 log.error('Overrides contained errors, discarding')
                 overrides = None
 
-
-        inifile = os.path.join(self.configdir, config) if not isinstance(config, dict) else None
-
         if inifile and os.path.exists(inifile):
-            usersettings = ConfigObj(inifile, configspec=configspec, encoding='UTF8', default_encoding='UTF8',
+            usersettings = ConfigObj(inifile, configspec=get_configspec(), encoding='UTF8', default_encoding='UTF8',
                                      write_empty_values=True)
         else:
-            usersettings = ConfigObj(config, configspec=configspec, encoding='UTF8', default_encoding='UTF8',
+            usersettings = ConfigObj(config, configspec=get_configspec(), encoding='UTF8', default_encoding='UTF8',
                                      write_empty_values=True)
 
-        output = ""
         if usersettings:
 
             if overrides:
@@ -90,7 +173,7 @@ class CfgMgr(object):
             r = usersettings.validate(self._validator, preserve_errors=True)
 
             if isinstance(r, dict):
-                raise ConfigException(output, self._usercfg)
+                raise ConfigException(r, usersettings)
             usersettings.walk(self.proper_none)
 
             self._usercfg = usersettings
@@ -113,7 +196,8 @@ class CfgMgr(object):
                           'x265': 'hevc'}
 
             output = list(
-                set([codecname if codecname not in codecalias else codecalias[codecname] for codecname in codecnames]))
+                dict.fromkeys([codecname if codecname not in codecalias else codecalias[codecname]
+                               for codecname in codecnames]))
             return output
 
         for section in self._usercfg['Containers']:
@@ -130,6 +214,7 @@ class CfgMgr(object):
                 self._usercfg['Containers'][section]['subtitle']['accepted_track_formats'])
 
         # Make sure that languages are in the correct ISO standard.
+        from mediaprocessor.helpers import languagecode
         for t in ['audio', 'subtitle']:
             self._usercfg['Languages'][t] = languagecode.validate(self._usercfg['Languages'][t])
 
@@ -155,6 +240,15 @@ class CfgMgr(object):
         return False
 
 
+def config_hash(config: Union[dict, ConfigObj]) -> str:
+    """
+    Digest of the settings of a configuration, two configurations with the same settings have the same digest
+    whatever the order of their keys or the file they were loaded from.
+    """
+    settings = config.dict() if isinstance(config, ConfigObj) else config
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
 class ConfigException(Exception):
     def __init__(self, validator_output, config):
         error_message = ''
@@ -1,74 +1,90 @@
 # coding=utf-8
+"""
+The specification of the configuration files. The options of the codecs and stream formats are found by going through
+their classes, which is only done the first time the configspec is asked for: get_configspec, or the configspec and
+defaultconfig attributes of the module.
+"""
+import functools
 from collections import OrderedDict
 from configobj import ConfigObj
-from mediaprocessor.converter.encoders import Encoders, _VideoCodec, _AudioCodec, _SubtitleCodec
-from mediaprocessor.converter.formats import FormatFactory, VideoFormat, AudioFormat, SubtitleFormat
-from mediaprocessor.converter.options import *
-
-exposed_options = {
-    Bitrate.__name__: 'integer(default=-1)',
-    PixFmt.__name__: 'force_list(default=list(None))',
-    Channels.__name__: 'integer(default=-1)',
-    Level.__name__: 'float(default=-1)',
-    Profile.__name__: 'force_list(default=list(High))',
-    Height.__name__: 'integer(default=-1)',
-    Bsf.__name__: 'string(default=None)',
-    Crf.__name__: 'integer(default=-1)',
-    Width.__name__: 'integer(default=-1)',
-    Tag.__name__: 'string(default=None)'}
-
-encoders = OrderedDict()
-
-videocodecs = OrderedDict()
-audiocodecs = OrderedDict()
-subtitlecodecs = OrderedDict()
-
-p = {}
-preferred_encoders = OrderedDict()
-for codec in Encoders._supported_codecs:
-    optdict = OrderedDict()
-    for opt in codec.supported_options:
-        if opt.__name__ in exposed_options and issubclass(opt, EncoderOption):
-            optdict.update({opt.__name__: exposed_options[opt.__name__]})
-    if optdict:
-        if issubclass(codec, _VideoCodec):
-            videocodecs.update({codec.codec_name: optdict})
-        elif issubclass(codec, _AudioCodec):
-            audiocodecs.update({codec.codec_name: optdict})
-        elif issubclass(codec, _SubtitleCodec):
-            subtitlecodecs.update({codec.codec_name: optdict})
-
-    if codec.produces.name in p:
-        p[codec.produces.name].append(codec.ffmpeg_codec_name)
-    else:
-        p.update({codec.produces.name: [codec.ffmpeg_codec_name]})
-
-
-for fmt in p:
-    if len(p[fmt]) > 1:
-        preferred_encoders[fmt] = f'string(default={p[fmt][0]})'
-
-encoders = {**videocodecs, **audiocodecs, **subtitlecodecs}
-
-videostreams = OrderedDict()
-audiostreams = OrderedDict()
-subtitlestreams = OrderedDict()
-
-
-for fmt_name, fmt in FormatFactory.supported_formats.items():
-    optdict = OrderedDict()
-    for opt in fmt.supported_options:
-        if opt.__name__ in exposed_options and issubclass(opt, IStreamOption):
-            optdict.update({opt.__name__: exposed_options[opt.__name__]})
-            if optdict:
-                if issubclass(fmt, VideoFormat):
-                    videostreams.update({fmt.__name__[:-6].lower(): optdict})
-                elif issubclass(fmt, AudioFormat):
-                    audiostreams.update({fmt.__name__[:-6].lower(): optdict})
-                elif issubclass(fmt, SubtitleFormat):
-                    subtitlestreams.update({fmt.__name__[:-6].lower(): optdict})
-
-streams = {**videostreams, **audiostreams, **subtitlestreams}
+
+
+def _codec_specs(exposed_options):
+    """Options of the encoders, and the preferred encoder of each format that several encoders produce."""
+    from mediaprocessor.converter.encoders import Encoders, _VideoCodec, _AudioCodec, _SubtitleCodec
+    from mediaprocessor.converter.options import EncoderOption
+
+    videocodecs = OrderedDict()
+    audiocodecs = OrderedDict()
+    subtitlecodecs = OrderedDict()
+
+    p = {}
+    preferred_encoders = OrderedDict()
+    for codec in Encoders._supported_codecs:
+        optdict = OrderedDict()
+        for opt in codec.supported_options:
+            if opt.__name__ in exposed_options and issubclass(opt, EncoderOption):
+                optdict.update({opt.__name__: exposed_options[opt.__name__]})
+        if optdict:
+            if issubclass(codec, _VideoCodec):
+                videocodecs.update({codec.codec_name: optdict})
+            elif issubclass(codec, _AudioCodec):
+                audiocodecs.update({codec.codec_name: optdict})
+            elif issubclass(codec, _SubtitleCodec):
+                subtitlecodecs.update({codec.codec_name: optdict})
+
+        if codec.produces.name in p:
+            p[codec.produces.name].append(codec.ffmpeg_codec_name)
+        else:
+            p.update({codec.produces.name: [codec.ffmpeg_codec_name]})
+
+    for fmt in p:
+        if len(p[fmt]) > 1:
+            preferred_encoders[fmt] = f'string(default={p[fmt][0]})'
+
+    return {**videocodecs, **audiocodecs, **subtitlecodecs}, preferred_encoders
+
+
+def _stream_specs(exposed_options):
+    """Options of the stream formats."""
+    from mediaprocessor.converter.formats import FormatFactory, VideoFormat, AudioFormat, SubtitleFormat
+    from mediaprocessor.converter.options import IStreamOption
+
+    videostreams = OrderedDict()
+    audiostreams = OrderedDict()
+    subtitlestreams = OrderedDict()
+
+    for fmt_name, fmt in FormatFactory.supported_formats.items():
+        optdict = OrderedDict()
+        for opt in fmt.supported_options:
+            if opt.__name__ in exposed_options and issubclass(opt, IStreamOption):
+                optdict.update({opt.__name__: exposed_options[opt.__name__]})
+                if optdict:
+                    if issubclass(fmt, VideoFormat):
+                        videostreams.update({fmt.__name__[:-6].lower(): optdict})
+                    elif issubclass(fmt, AudioFormat):
+                        audiostreams.update({fmt.__name__[:-6].lower(): optdict})
+                    elif issubclass(fmt, SubtitleFormat):
+                        subtitlestreams.update({fmt.__name__[:-6].lower(): optdict})
+
+    return {**videostreams, **audiostreams, **subtitlestreams}
+
+
+def _exposed_options():
+    from mediaprocessor.converter.options import Bitrate, PixFmt, Channels, Level, Profile, Height, Bsf, Crf, Width, Tag
+
+    return {
+        Bitrate.__name__: 'integer(default=-1)',
+        PixFmt.__name__: 'force_list(default=list(None))',
+        Channels.__name__: 'integer(default=-1)',
+        Level.__name__: 'float(default=-1)',
+        Profile.__name__: 'force_list(default=list(High))',
+        Height.__name__: 'integer(default=-1)',
+        Bsf.__name__: 'string(default=None)',
+        Crf.__name__: 'integer(default=-1)',
+        Width.__name__: 'integer(default=-1)',
+        Tag.__name__: 'string(default=None)'}
+
 
 ctn_default_options = {
             'video': {
@@ -91,9 +107,19 @@ ctn_default_options = {
             },
 
             'post_processors': 'force_list(default=None)',
+            'faststart': "option('off', 'movflags', 'reserve', default='off')",
             'preopts': 'string(default=None)',
             'postopts': 'string(default=None)'}
 
+pipeline_stages = {
+    'prepare': {'workers': 'integer(default=2)', 'depth': 'integer(default=2)'},
+    'fetch': {'workers': 'integer(default=4)', 'depth': 'integer(default=4)'},
+    'encode': {'workers': 'integer(default=1)', 'depth': 'integer(default=2)'},
+    'tag': {'workers': 'integer(default=2)', 'depth': 'integer(default=2)'},
+    'postprocess': {'workers': 'integer(default=1)', 'depth': 'integer(default=2)'},
+    'deploy': {'workers': 'integer(default=2)', 'depth': 'integer(default=2)'}
+}
+
 refreshers = {
     'plex': {'host': 'string(default=localhost)',
              'ssl': 'boolean(default=False)',
@@ -110,40 +136,86 @@ refreshers = {
                  'api_key': 'string(default=None)'}
 }
 
-defaultconfig = {
-    'FFMPEG': {
-        'ffmpeg': 'string(default=/usr/local/bin/ffmpeg)',
-        'ffprobe': 'string(default=/usr/local/bin/ffprobe)',
-        'threads': 'string(default=auto)',
-    },
-
-    'Languages': {
-        'audio': 'force_list(default=list(eng))',
-        'subtitle': 'force_list(default=list(eng))',
-        'tagging': 'string(default=eng)'
-    },
-
-    'Tagging': {
-        'tagfile': 'boolean(default=True)',
-        'preferred_show_tagger': 'string(default=tmdb)',
-        'preferred_movie_tagger': 'string(default=tmdb)',
-        'download_artwork': 'boolean(default=False)'
-    },
-
-    'File': {
-        'work_directory': 'string(default=None)',
-        'copy_to': 'string(default=None)',
-        'move_to': 'string(default=None)',
-        'delete_original': 'boolean(default=False)',
-        'permissions': 'integer(default=777)'
-    },
-    'Containers': {
-        'mp4': ctn_default_options,
-        'matroska': ctn_default_options
+
+@functools.lru_cache(maxsize=None)
+def get_defaultconfig() -> dict:
+    """The specification of every section and key, as a dict."""
+    exposed_options = _exposed_options()
+    encoders, preferred_encoders = _codec_specs(exposed_options)
+    streams = _stream_specs(exposed_options)
+
+    return {
+        'FFMPEG': {
+            'ffmpeg': 'string(default=/usr/local/bin/ffmpeg)',
+            'ffprobe': 'string(default=/usr/local/bin/ffprobe)',
+            'threads': 'string(default=auto)',
+            'probe_cache': 'boolean(default=True)',
+            'probe_cache_size': 'integer(default=50000)',
+            'probe_cache_hash': 'boolean(default=False)',
+            'progress_interval': 'float(default=1.0)',
+            'stall_timeout': 'integer(default=300)',
+            'min_speed': 'float(default=0)',
+            'min_speed_window': 'integer(default=120)',
+            'core_budget': 'integer(default=0)',
+            'concurrent_jobs': 'integer(default=1)',
+            'chunked': 'boolean(default=False)',
+            'chunk_threads': 'integer(default=4)',
+            'chunk_min_duration': 'integer(default=60)',
+            'chunk_retries': 'integer(default=1)',
+        },
+
+        'Languages': {
+            'audio': 'force_list(default=list(eng))',
+            'subtitle': 'force_list(default=list(eng))',
+            'tagging': 'string(default=eng)'
+        },
+
+        'Tagging': {
+            'tagfile': 'boolean(default=True)',
+            'preferred_show_tagger': 'string(default=tmdb)',
+            'preferred_movie_tagger': 'string(default=tmdb)',
+            'download_artwork': 'boolean(default=False)',
+            'mux_tags': 'boolean(default=False)'
         },
-    'StreamFormats': streams,
-    'PreferredEncoders': preferred_encoders,
-    'EncoderOptions': encoders,
-    'Refreshers': refreshers}
 
-configspec = ConfigObj(defaultconfig, list_values=False)
+        'File': {
+            'work_directory': 'string(default=None)',
+            'copy_to': 'string(default=None)',
+            'move_to': 'string(default=None)',
+            'delete_original': 'boolean(default=False)',
+            'hardlink_copies': 'boolean(default=False)',
+            'write_to_destination': 'boolean(default=False)',
+            'permissions': 'integer(default=777)'
+        },
+
+        'Watch': {
+            'directories': 'force_list(default=None)',
+            'stability_window': 'integer(default=30)',
+            'poll_interval': 'integer(default=10)',
+            'queue_size': 'integer(default=0)',
+            'queue': 'string(default=None)'
+        },
+
+        'Pipeline': pipeline_stages,
+        'Containers': {
+            'mp4': ctn_default_options,
+            'matroska': ctn_default_options
+            },
+        'StreamFormats': streams,
+        'PreferredEncoders': preferred_encoders,
+        'EncoderOptions': encoders,
+        'Refreshers': refreshers}
+
+
+@functools.lru_cache(maxsize=None)
+def get_configspec() -> ConfigObj:
+    """The configspec of the configuration files, built the first time it is asked for."""
+    return ConfigObj(get_defaultconfig(), list_values=False)
+
+
+def __getattr__(name):
+    if name == 'configspec':
+        return get_configspec()
+    if name == 'defaultconfig':
+        return get_defaultconfig()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
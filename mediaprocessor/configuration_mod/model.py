@@ -0,0 +1,168 @@
+"""
+Module model.py
+The settings of a validated configuration, compiled into frozen dataclasses, so that the code running for every file
+reads attributes instead of walking ConfigObj sections, and can share them between threads. compile_config builds the
+model of a ConfigObj once, later calls return the same model: it is a snapshot of the configuration, which should not
+be changed once compiled.
+"""
+import weakref
+from dataclasses import dataclass, fields
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+from configobj import ConfigObj
+
+from mediaprocessor.configuration_mod.configuration import config_hash
+
+
+def _build(cls, section):
+    """Instance of the dataclass cls from the keys of section that match its fields, lists become tuples."""
+    values = {}
+    for field in fields(cls):
+        if field.name not in section:
+            continue
+        value = section[field.name]
+        if field.type is tuple:
+            value = tuple(value or ())
+        values[field.name] = value
+    return cls(**values)
+
+
+def _frozen(section) -> Mapping:
+    """Read-only copy of a section, sub-sections included."""
+    return MappingProxyType({k: _frozen(v) if isinstance(v, dict) else tuple(v) if isinstance(v, list) else v
+                             for k, v in section.items()})
+
+
+@dataclass(frozen=True, slots=True)
+class FFmpegConfig:
+    ffmpeg: str = '/usr/local/bin/ffmpeg'
+    ffprobe: str = '/usr/local/bin/ffprobe'
+    threads: str = 'auto'
+    probe_cache: bool = True
+    probe_cache_size: int = 50000
+    probe_cache_hash: bool = False
+    progress_interval: float = 1.0
+    stall_timeout: Optional[int] = 300
+    min_speed: Optional[float] = 0
+    min_speed_window: int = 120
+    core_budget: int = 0
+    concurrent_jobs: int = 1
+    chunked: bool = False
+    chunk_threads: int = 4
+    chunk_min_duration: int = 60
+    chunk_retries: int = 1
+
+
+@dataclass(frozen=True, slots=True)
+class LanguagesConfig:
+    audio: tuple = ('eng',)
+    subtitle: tuple = ('eng',)
+    tagging: str = 'eng'
+
+
+@dataclass(frozen=True, slots=True)
+class TaggingConfig:
+    tagfile: bool = True
+    preferred_show_tagger: str = 'tmdb'
+    preferred_movie_tagger: str = 'tmdb'
+    download_artwork: bool = False
+    mux_tags: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class FileConfig:
+    work_directory: Optional[str] = None
+    copy_to: Optional[str] = None
+    move_to: Optional[str] = None
+    delete_original: bool = False
+    hardlink_copies: bool = False
+    write_to_destination: bool = False
+    permissions: int = 777
+
+
+@dataclass(frozen=True, slots=True)
+class StreamConfig:
+    """Settings of the video, audio or subtitle streams of a container."""
+    accepted_track_formats: tuple = ()
+    default_format: Optional[str] = None
+    prefer_copy: bool = True
+    force_create_tracks: tuple = ()
+
+
+@dataclass(frozen=True, slots=True)
+class ContainerConfig:
+    video: StreamConfig
+    audio: StreamConfig
+    subtitle: StreamConfig
+    post_processors: tuple = ()
+    faststart: str = 'off'
+    preopts: Optional[str] = None
+    postopts: Optional[str] = None
+
+    @classmethod
+    def from_section(cls, section) -> 'ContainerConfig':
+        return cls(video=_build(StreamConfig, section.get('video', {})),
+                   audio=_build(StreamConfig, section.get('audio', {})),
+                   subtitle=_build(StreamConfig, section.get('subtitle', {})),
+                   post_processors=tuple(section.get('post_processors') or ()),
+                   faststart=section.get('faststart', 'off'),
+                   preopts=section.get('preopts'),
+                   postopts=section.get('postopts'))
+
+
+@dataclass(frozen=True, slots=True)
+class RefresherConfig:
+    """The settings of a refresher, as given to RefresherFactory.get_refesher."""
+    name: str
+    options: Mapping
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    The compiled configuration. digest identifies its settings, two configurations with the same settings have the
+    same digest, caches can key on it.
+    """
+    ffmpeg: FFmpegConfig
+    languages: LanguagesConfig
+    tagging: TaggingConfig
+    file: FileConfig
+    containers: Mapping
+    refreshers: Mapping
+    stream_formats: Mapping
+    preferred_encoders: Mapping
+    encoder_options: Mapping
+    digest: str
+
+
+# Models compiled, by id of their ConfigObj, dropped with it
+_compiled = {}
+
+
+def compile_config(cfg: ConfigObj) -> Config:
+    """
+    The model of a validated configuration, compiled the first time it is asked for.
+    :param cfg: a configuration loaded by CfgMgr, or the default configuration
+    """
+    entry = _compiled.get(id(cfg))
+    if entry is not None and entry[0]() is cfg:
+        return entry[1]
+
+    model = Config(ffmpeg=_build(FFmpegConfig, cfg.get('FFMPEG', {})),
+                   languages=_build(LanguagesConfig, cfg.get('Languages', {})),
+                   tagging=_build(TaggingConfig, cfg.get('Tagging', {})),
+                   file=_build(FileConfig, cfg.get('File', {})),
+                   containers=MappingProxyType({name: ContainerConfig.from_section(section)
+                                                for name, section in cfg.get('Containers', {}).items()}),
+                   refreshers=MappingProxyType({name: RefresherConfig(name, _frozen(section))
+                                                for name, section in cfg.get('Refreshers', {}).items()}),
+                   stream_formats=_frozen(cfg.get('StreamFormats', {})),
+                   preferred_encoders=_frozen(cfg.get('PreferredEncoders', {})),
+                   encoder_options=_frozen(cfg.get('EncoderOptions', {})),
+                   digest=config_hash(cfg))
+
+    key = id(cfg)
+    _compiled[key] = (weakref.ref(cfg), model)
+    weakref.finalize(cfg, _compiled.pop, key, None)
+    return model
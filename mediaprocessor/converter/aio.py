@@ -0,0 +1,274 @@
+"""
+Module converter.aio.py
+asyncio interface to ffmpeg, for hosts running an event loop. Probes and conversions run through
+asyncio.create_subprocess_exec, and the progress of a conversion is read with async for, so one loop can supervise
+many ffmpeg processes without a thread each. Command lines, progress events and errors are those of FFMpeg.
+"""
+import asyncio
+import logging
+import os
+
+from mediaprocessor.converter.ffmpeg import FFMpeg, FFMpegError, console_encoding
+from mediaprocessor.converter.parsers import FFprobeParser
+from mediaprocessor.converter.progress import ProgressEvent, ProgressParser, StderrRing
+from mediaprocessor.converter.watchdog import Watchdog
+
+log = logging.getLogger(__name__)
+
+
+class AsyncConversionJob(object):
+    """
+    A running ffmpeg process, see ConversionJob. async for over the job drives it and yields ProgressEvents, the
+    job can be cancelled from any task of the loop. Cancelling the task iterating over the job kills ffmpeg and
+    removes the partial outputs.
+    Async jobs are not in the JobRegistry: they belong to the loop, which cancels its tasks on shutdown.
+    """
+    quit_timeout = 10
+    term_timeout = 5
+
+    def __init__(self, process, cmds: list, outputs=None):
+        """
+        :param process: the ffmpeg asyncio.subprocess.Process
+        :param cmds: the ffmpeg command line
+        :param outputs: files written by ffmpeg, removed if the job is cancelled
+        """
+        self.process = process
+        self.cmds = cmds
+        self.outputs = list(outputs or [])
+        self.cancelled = False
+        self.events = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    @property
+    def running(self) -> bool:
+        return self.process.returncode is None
+
+    def __aiter__(self):
+        return self.events
+
+    async def wait(self, timeout=None) -> bool:
+        """Waits for ffmpeg to exit, returns False if it is still running after timeout seconds."""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.process.wait()), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def cancel(self, graceful=True) -> bool:
+        """
+        Stops ffmpeg and removes the partial outputs, see ConversionJob.cancel.
+        :param graceful: whether to give ffmpeg a chance to exit on its own
+        :return: True if ffmpeg is gone
+        """
+        if not self.running:
+            return True
+
+        self.cancelled = True
+        log.info('Cancelling ffmpeg (pid %s)', self.pid)
+        try:
+            if graceful:
+                try:
+                    self.process.stdin.write(b'q')
+                    await self.process.stdin.drain()
+                except (OSError, ValueError):
+                    pass
+                if not await self.wait(self.quit_timeout):
+                    self.process.terminate()
+                    if not await self.wait(self.term_timeout):
+                        self.process.kill()
+            else:
+                self.process.kill()
+        except ProcessLookupError:
+            # Exited in the meantime
+            pass
+
+        gone = await self.wait(self.term_timeout)
+        if gone:
+            self.remove_outputs()
+        return gone
+
+    def remove_outputs(self):
+        for output in self.outputs:
+            try:
+                os.remove(output)
+                log.debug('Removed partial output %s', output)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.exception('Could not remove partial output %s', output)
+
+    def close(self):
+        pass
+
+
+class AsyncFFMpeg(object):
+    """
+    Runs the command lines of an FFMpeg with asyncio. Everything that does not run a process, generate_commands and
+    the like, is the FFMpeg's.
+    """
+
+    def __init__(self, ffmpeg: FFMpeg = None):
+        """
+        :param ffmpeg: the FFMpeg to use, a new one with the default paths if not given
+        """
+        self.ffmpeg = ffmpeg or FFMpeg()
+
+    def __getattr__(self, name):
+        return getattr(self.ffmpeg, name)
+
+    @staticmethod
+    async def _spawn(cmds):
+        return await asyncio.create_subprocess_exec(*[str(c) for c in cmds], stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    async def probe(self, fname):
+        """See FFMpeg.probe"""
+        if not os.path.exists(fname):
+            raise FileNotFoundError
+
+        if self.ffmpeg.probe_cache:
+            stdout_data = self.ffmpeg.probe_cache.get(fname)
+            if stdout_data is not None:
+                return FFprobeParser(stdout_data, file_path=fname)
+
+        st = os.stat(fname)
+        p = await self._spawn(self.ffmpeg.probe_commands(fname))
+        stdout_data, _ = await p.communicate()
+        return self.ffmpeg._probed(fname, stdout_data, p.returncode, st)
+
+    async def start(self, cmds: list, duration=None, timeout=None, min_speed=None, min_speed_window=60,
+                    outputs=None) -> AsyncConversionJob:
+        """See FFMpeg.start, the job is iterated over with async for."""
+        cmds = [cmds[0], '-nostats', '-progress', 'pipe:1'] + list(cmds[1:])
+        if outputs is None:
+            outputs = [cmds[-1]]
+
+        try:
+            p = await self._spawn(cmds)
+        except OSError:
+            raise FFMpegError('Error while calling ffmpeg binary')
+
+        job = AsyncConversionJob(p, cmds, outputs)
+        job.events = self._follow(job, duration, timeout, min_speed, min_speed_window)
+        return job
+
+    async def convert2(self, cmds: list, duration=None, timeout=None, min_speed=None, min_speed_window=60):
+        """Runs an ffmpeg command line and yields ProgressEvents, see FFMpeg.convert2."""
+        job = await self.start(cmds, duration=duration, timeout=timeout, min_speed=min_speed,
+                               min_speed_window=min_speed_window)
+        async for event in job:
+            yield event
+
+    async def _follow(self, job: AsyncConversionJob, duration, timeout, min_speed, min_speed_window):
+        p = job.process
+
+        stderr = StderrRing(None, max_lines=FFMpeg.STDERR_LINES, encoding=console_encoding)
+        drain = asyncio.ensure_future(self._drain(p.stderr, stderr))
+        parser = ProgressParser()
+
+        watchdog = None
+        guard = None
+        if timeout or min_speed:
+            watchdog = Watchdog(p, stall_timeout=timeout, min_speed=min_speed, min_speed_window=min_speed_window)
+            guard = asyncio.ensure_future(self._guard(job, watchdog))
+
+        yielded = False
+        try:
+            while True:
+                data = await p.stdout.read(65536)
+                if not data:
+                    break
+
+                for block in parser.feed(data):
+                    event = ProgressEvent.from_block(block, duration or stderr.duration, p.pid)
+                    if watchdog:
+                        watchdog.notify(event)
+                    yielded = True
+                    yield event
+        except (GeneratorExit, asyncio.CancelledError):
+            # The caller stopped listening, or its task was cancelled.
+            job.cancelled = True
+            if job.running:
+                p.kill()
+            await p.wait()
+            job.remove_outputs()
+            raise
+        finally:
+            await p.wait()
+            if guard:
+                guard.cancel()
+            await drain
+
+        FFMpeg._check_exit(job, stderr, watchdog)
+
+        if not yielded:
+            # For small or very fast jobs, ffmpeg may never report any progress.
+            yield ProgressEvent(fraction=1.0, pid=p.pid, finished=True)
+
+    @staticmethod
+    async def _drain(stream, ring: StderrRing):
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                break
+            ring.feed(data)
+        ring.close()
+
+    @staticmethod
+    async def _guard(job: AsyncConversionJob, watchdog: Watchdog):
+        """The Watchdog's checks, on the loop instead of a thread."""
+        while job.running:
+            await asyncio.sleep(watchdog._poll)
+            reason = watchdog.check()
+            if reason and job.running:
+                watchdog.reason = reason
+                log.error('Stopping ffmpeg (pid %s): %s', job.pid, reason)
+                try:
+                    job.process.terminate()
+                    if not await job.wait(watchdog.grace):
+                        log.error('ffmpeg (pid %s) did not terminate, killing it', job.pid)
+                        job.process.kill()
+                except ProcessLookupError:
+                    pass
+                return
+
+
+async def iterate_in_thread(iterable, executor=None):
+    """
+    Yields the items of a blocking iterable, each one taken in an executor so that the loop is not blocked.
+    Closing the async generator closes the iterable, in the executor too. If it is closed, or its task cancelled,
+    while an item is being taken, the iterable is cancelled first when it can be (a ConversionJob or a
+    ChunkedConversion), and closed once the pending next has returned: a generator cannot be closed while it runs.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    done = object()
+    pending = None
+    try:
+        while True:
+            # Shielded, so that cancelling the task leaves the future to wait for in finally
+            pending = loop.run_in_executor(executor, next, iterator, done)
+            item = await asyncio.shield(pending)
+            pending = None
+            if item is done:
+                break
+            yield item
+    finally:
+        if pending is not None:
+            cancel = getattr(iterable, 'cancel', None)
+            if cancel and not pending.done():
+                await asyncio.shield(loop.run_in_executor(executor, cancel, False))
+            try:
+                await asyncio.shield(pending)
+            except Exception:
+                pass
+        close = getattr(iterator, 'close', None)
+        if close:
+            await asyncio.shield(loop.run_in_executor(executor, close))
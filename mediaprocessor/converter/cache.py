@@ -0,0 +1,302 @@
+"""
+Module converter.cache.py
+Caches for information obtained by spawning the ffmpeg binaries. Those are expensive to obtain (a process spawn and
+some text parsing each time) but only change when the binary changes, so they are kept both in memory for the life
+of the process and on disk between runs.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def cache_directory() -> str:
+    """
+    Directory where the on-disk caches live. MEDIAPROCESSOR_CACHE_DIR takes precedence, then a cache folder inside
+    CONVERTER_CONFIG_DIR, then ~/.cache/mediaprocessor.
+    """
+    if os.getenv('MEDIAPROCESSOR_CACHE_DIR'):
+        return os.getenv('MEDIAPROCESSOR_CACHE_DIR')
+    if os.getenv('CONVERTER_CONFIG_DIR'):
+        return os.path.join(os.getenv('CONVERTER_CONFIG_DIR'), 'cache')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'mediaprocessor')
+
+
+def _is_separator(fields: list) -> bool:
+    return len(fields) == 1 and set(fields[0]) == {'-'}
+
+
+class Capabilities(object):
+    """What a given ffmpeg binary is able to do. All collections are frozensets so that membership tests are cheap."""
+    fields = ('encoders', 'decoders', 'hwaccels', 'muxers', 'filters')
+
+    def __init__(self, encoders=(), decoders=(), hwaccels=(), muxers=(), filters=()):
+        self.encoders = frozenset(encoders)
+        self.decoders = frozenset(decoders)
+        self.hwaccels = frozenset(hwaccels)
+        self.muxers = frozenset(muxers)
+        self.filters = frozenset(filters)
+
+    def to_dict(self) -> dict:
+        return {f: sorted(getattr(self, f)) for f in self.fields}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(**{f: d.get(f, []) for f in cls.fields})
+
+    @staticmethod
+    def parse_codecs(output: str) -> list:
+        """Parses the output of ffmpeg -encoders or ffmpeg -decoders."""
+        codecs = []
+        start = False
+        for line in output.split('\n'):
+            fields = line.split()
+            if not start:
+                start = _is_separator(fields)
+                continue
+            if len(fields) >= 2 and fields[0][0] in ['V', 'A', 'S']:
+                codecs.append(fields[1])
+        return codecs
+
+    @staticmethod
+    def parse_hwaccels(output: str) -> list:
+        """Parses the output of ffmpeg -hwaccels."""
+        hwaccels = []
+        start = False
+        for line in output.split('\n'):
+            if not start:
+                start = line.strip().endswith(':')
+                continue
+            if line.strip():
+                hwaccels.append(line.strip())
+        return hwaccels
+
+    @staticmethod
+    def parse_muxers(output: str) -> list:
+        """Parses the output of ffmpeg -muxers."""
+        muxers = []
+        start = False
+        for line in output.split('\n'):
+            fields = line.split()
+            if not start:
+                start = _is_separator(fields)
+                continue
+            if len(fields) >= 2 and 'E' in fields[0]:
+                muxers.extend(fields[1].split(','))
+        return muxers
+
+    @staticmethod
+    def parse_filters(output: str) -> list:
+        """Parses the output of ffmpeg -filters."""
+        filters = []
+        for line in output.split('\n'):
+            fields = line.split()
+            if len(fields) >= 3 and '->' in fields[2] and '=' not in fields:
+                filters.append(fields[1])
+        return filters
+
+
+class CapabilityCache(object):
+    """
+    Process-wide and on-disk cache of Capabilities. Entries are keyed on the binary's real path, inode, size and
+    mtime, so replacing or upgrading ffmpeg invalidates the entry without any user action.
+    """
+    filename = 'capabilities.json'
+    _memory = {}
+    _lock = threading.Lock()
+
+    def __init__(self, directory=None):
+        self.directory = directory or cache_directory()
+        self.path = os.path.join(self.directory, self.filename)
+
+    @staticmethod
+    def key(binary: str):
+        """Returns the cache key for binary, or None if the binary cannot be stat'ed."""
+        try:
+            real_path = os.path.realpath(binary)
+            st = os.stat(real_path)
+        except OSError:
+            return None
+        return f'{real_path}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+
+    def get(self, binary: str):
+        """
+        Returns the cached Capabilities of binary, or None if they are unknown.
+        :param binary: path to the ffmpeg binary
+        :rtype: Capabilities or None
+        """
+        key = self.key(binary)
+        if key is None:
+            return None
+
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key]
+
+            entry = self._read().get(key)
+            if entry is None:
+                return None
+
+            capabilities = Capabilities.from_dict(entry)
+            self._memory[key] = capabilities
+            return capabilities
+
+    def put(self, binary: str, capabilities: Capabilities) -> None:
+        key = self.key(binary)
+        if key is None:
+            return
+
+        with self._lock:
+            self._memory[key] = capabilities
+
+            # Drop entries for older versions of the same binary
+            real_path = key.rsplit(':', 3)[0]
+            entries = {k: v for k, v in self._read().items() if k.rsplit(':', 3)[0] != real_path}
+            entries[key] = capabilities.to_dict()
+            self._write(entries)
+
+    @classmethod
+    def clear_memory(cls):
+        with cls._lock:
+            cls._memory.clear()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            log.warning('Capability cache %s is unreadable, ignoring it', self.path)
+            return {}
+
+    def _write(self, entries: dict) -> None:
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            log.warning('Could not write capability cache %s', self.path)
+
+
+class ProbeCache(object):
+    """
+    Persistent cache of raw ffprobe output, stored in SQLite. Entries are keyed on the file's device and inode and are
+    only valid as long as its size and mtime (and, optionally, a hash of its first and last blocks) are unchanged.
+    The cache is bounded to max_entries rows, least recently used entries are evicted first.
+    """
+    filename = 'probe.sqlite'
+    hash_block = 1 << 20
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, directory=None, max_entries=50000, content_hash=False):
+        """
+        :param directory: directory holding the database, defaults to cache_directory()
+        :param max_entries: maximum number of probes kept
+        :param content_hash: whether to also check a hash of the first and last MB of the file
+        """
+        self.directory = directory or cache_directory()
+        self.path = os.path.join(self.directory, self.filename)
+        self.max_entries = max_entries
+        self.content_hash = content_hash
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    @classmethod
+    def shared(cls, directory=None, max_entries=50000, content_hash=False):
+        """Returns a process-wide instance for these settings, so that counters and the connection are shared."""
+        key = (directory, max_entries, content_hash)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(directory, max_entries=max_entries, content_hash=content_hash)
+            return cls._shared[key]
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS probes ('
+                             'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, '
+                             'payload TEXT, last_used REAL, PRIMARY KEY (dev, ino))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)')
+        return self._db
+
+    def _digest(self, fname: str, size: int) -> str:
+        if not self.content_hash:
+            return ''
+        h = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(fname, 'rb') as f:
+            h.update(f.read(self.hash_block))
+            if size > 2 * self.hash_block:
+                f.seek(-self.hash_block, os.SEEK_END)
+                h.update(f.read(self.hash_block))
+        return h.hexdigest()
+
+    def get(self, fname: str):
+        """
+        Returns the cached ffprobe output for fname, or None if there is no valid entry.
+        :rtype: str or None
+        """
+        st = os.stat(fname)
+        with self._lock:
+            try:
+                db = self._connect()
+                row = db.execute('SELECT size, mtime_ns, digest, payload FROM probes WHERE dev=? AND ino=?',
+                                 (st.st_dev, st.st_ino)).fetchone()
+                if row is not None:
+                    size, mtime_ns, digest, payload = row
+                    if (size, mtime_ns) == (st.st_size, st.st_mtime_ns) and digest == self._digest(fname, size):
+                        db.execute('UPDATE probes SET last_used=? WHERE dev=? AND ino=?',
+                                   (time.time(), st.st_dev, st.st_ino))
+                        self.hits += 1
+                        return payload
+                    db.execute('DELETE FROM probes WHERE dev=? AND ino=?', (st.st_dev, st.st_ino))
+            except Exception:
+                log.exception('Probe cache %s lookup failed', self.path)
+
+            self.misses += 1
+            return None
+
+    def put(self, fname: str, payload: str, st: os.stat_result = None) -> None:
+        """
+        Stores the ffprobe output of fname.
+        :param st: os.stat of fname taken before probing it. The probe is not stored if the file changed since, it
+        may describe the previous version.
+        """
+        current = os.stat(fname)
+        if st is not None and (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != \
+                (current.st_dev, current.st_ino, current.st_size, current.st_mtime_ns):
+            log.debug('%s changed while it was probed, not caching the probe', fname)
+            return
+        st = current
+        with self._lock:
+            try:
+                db = self._connect()
+                db.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, self._digest(fname, st.st_size),
+                            payload, time.time()))
+                excess = db.execute('SELECT COUNT(*) FROM probes').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    db.execute('DELETE FROM probes WHERE rowid IN '
+                               '(SELECT rowid FROM probes ORDER BY last_used LIMIT ?)', (excess,))
+            except Exception:
+                log.exception('Could not store probe of %s in cache %s', fname, self.path)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connect().execute('DELETE FROM probes')
@@ -0,0 +1,212 @@
+"""
+Module converter.chunks.py
+Chunked encoding: the video of a file is split at keyframes, every chunk is encoded by its own ffmpeg process, all of
+them in parallel, and the chunks are then joined with the concat demuxer while the other streams are muxed from the
+source. A single encoder rarely keeps many cores busy, independent chunks do.
+"""
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mediaprocessor.converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError, FFMpegCancelledError
+from mediaprocessor.converter.progress import ProgressEvent
+
+log = logging.getLogger(__name__)
+
+
+def split_at_keyframes(keyframes: list, duration: float, chunks: int, start_time: float = 0.0) -> list:
+    """
+    Splits [0, duration] into at most chunks segments of similar length, starting at keyframes.
+    :param keyframes: sorted keyframe timestamps, in seconds, as ffprobe reports them
+    :param duration: duration of the stream, in seconds
+    :param chunks: number of segments wanted
+    :param start_time: start time of the container (non zero in MPEG-TS for instance). The segments are relative to
+    it, like the positions given to -ss, so the keyframe timestamps are shifted by it.
+    :return: list of (start, end) tuples, end is None for the last segment
+    """
+    if not keyframes or chunks < 2:
+        return [(0.0, None)]
+
+    keyframes = [k - start_time for k in keyframes]
+
+    starts = [keyframes[0]]
+    for i in range(1, chunks):
+        target = duration * i / chunks
+        closest = min(keyframes, key=lambda k: abs(k - target))
+        if closest > starts[-1]:
+            starts.append(closest)
+
+    # Whatever precedes the first keyframe cannot be decoded on its own, it goes with the first chunk.
+    starts[0] = 0.0
+    return list(zip(starts, starts[1:] + [None]))
+
+
+class ChunkedConversion(object):
+    """
+    Runs a chunked encode. Like a ConversionJob, iterating over it drives the conversion and yields ProgressEvents,
+    and it can be cancelled from any thread. Each chunk is retried up to retries times before the whole conversion
+    fails. The encode phase accounts for encode_share of the reported progress, the final mux for the rest.
+    """
+    encode_share = 0.9
+
+    def __init__(self, ffmpeg: FFMpeg, source_container, target_container, mapping, encoder_factory, segments,
+                 threads=None, retries=1, preopts=None, postopts=None, timeout=None, min_speed=None,
+                 min_speed_window=60):
+        """
+        :param segments: list of (start, end) tuples, see split_at_keyframes
+        :param threads: threads given to each chunk's encoder
+        :param retries: number of times a failed chunk is encoded again
+        :param timeout: stall timeout applied to every ffmpeg process, see FFMpeg.start
+        """
+        self.ffmpeg = ffmpeg
+        self.source_container = source_container
+        self.target_container = target_container
+        self.mapping = mapping
+        self.encoder_factory = encoder_factory
+        self.segments = segments
+        self.threads = threads
+        self.retries = retries
+        self.preopts = preopts
+        self.postopts = postopts
+        self.timeout = timeout
+        self.min_speed = min_speed
+        self.min_speed_window = min_speed_window
+
+        self.cancelled = False
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.events = self._run()
+
+    @property
+    def duration(self):
+        return self.source_container.duration
+
+    def __iter__(self):
+        return self.events
+
+    def cancel(self, graceful=True) -> bool:
+        """
+        Cancels every running ffmpeg of the conversion, see ConversionJob.cancel.
+        :return: True if they are all gone
+        """
+        self.cancelled = True
+        with self._lock:
+            jobs = list(self._jobs.values())
+
+        results = {}
+        threads = [threading.Thread(target=lambda j=job: results.update({j: j.cancel(graceful)}), daemon=True)
+                   for job in jobs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return all(results.values())
+
+    def _run(self):
+        target = self.target_container.file_path
+        workdir = tempfile.mkdtemp(prefix='.chunks-', dir=os.path.dirname(os.path.abspath(target)))
+        try:
+            chunk_paths = [os.path.join(workdir, f'chunk{i:04d}.mkv') for i in range(len(self.segments))]
+            yield from self._encode(chunk_paths)
+
+            concat_list = os.path.join(workdir, 'concat.txt')
+            with open(concat_list, 'w') as f:
+                for path in chunk_paths:
+                    escaped = path.replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+
+            cmds = self.ffmpeg.generate_concat_commands(self.source_container, self.target_container, self.mapping,
+                                                        self.encoder_factory, concat_list,
+                                                        preopts=self.preopts, postopts=self.postopts)
+            log.debug('FFmpeg concat command:\n %s', ' '.join(cmds))
+            job = self._start(-1, cmds, self.duration, target)
+            for event in job:
+                event.fraction = self.encode_share + (1 - self.encode_share) * float(event)
+                yield event
+        except GeneratorExit:
+            self.cancel(graceful=False)
+            raise
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _start(self, key, cmds, duration, output):
+        if self.cancelled:
+            raise FFMpegCancelledError('Cancelled', ' '.join(cmds), '')
+        job = self.ffmpeg.start(cmds, duration=duration, timeout=self.timeout, min_speed=self.min_speed,
+                                min_speed_window=self.min_speed_window, outputs=[output])
+        with self._lock:
+            self._jobs[key] = job
+        return job
+
+    def _encode(self, chunk_paths):
+        """Encodes every chunk in parallel, yields the combined progress."""
+        events = queue.Queue()
+        lengths = [(end if end is not None else self.duration) - start for start, end in self.segments]
+        done = [0.0] * len(self.segments)
+        latest = [None] * len(self.segments)
+
+        with ThreadPoolExecutor(max_workers=len(self.segments), thread_name_prefix='chunk') as executor:
+            futures = [executor.submit(self._encode_chunk, i, chunk_paths[i], lengths[i], events)
+                       for i in range(len(self.segments))]
+            # A finished chunk puts None on the queue, so that a failure is seen among the other chunks' events
+            for i, future in enumerate(futures):
+                future.add_done_callback(lambda f, i=i: events.put((i, None)))
+
+            running = len(futures)
+            try:
+                while running:
+                    i, event = events.get()
+                    if event is None:
+                        running -= 1
+                        if futures[i].exception():
+                            raise futures[i].exception()
+                        continue
+
+                    latest[i] = event
+                    if event.out_time is not None:
+                        done[i] = min(event.out_time, lengths[i])
+                    yield self._combine(latest, sum(done))
+            except BaseException:
+                # A failed chunk, or the progress closed (GeneratorExit): the other chunks are stopped before the
+                # executor waits for them
+                self.cancel(graceful=False)
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def _combine(self, latest, out_time) -> ProgressEvent:
+        running = [e for e in latest if e is not None]
+        speed = sum(e.speed for e in running if e.speed) or None
+        fps = sum(e.fps for e in running if e.fps) or None
+        total_size = sum(e.total_size for e in running if e.total_size) or None
+
+        fraction = None
+        eta = None
+        if self.duration:
+            fraction = self.encode_share * min(out_time / self.duration, 1.0)
+            if speed:
+                eta = max(self.duration - out_time, 0) / speed
+
+        return ProgressEvent(out_time=out_time, fraction=fraction, fps=fps, speed=speed, total_size=total_size,
+                             eta=eta)
+
+    def _encode_chunk(self, i, path, length, events):
+        start, end = self.segments[i]
+        cmds = self.ffmpeg.generate_chunk_commands(self.source_container, self.target_container, self.mapping,
+                                                   self.encoder_factory, start, end, path, threads=self.threads,
+                                                   preopts=self.preopts)
+        for attempt in range(self.retries + 1):
+            job = self._start(i, cmds, length, path)
+            try:
+                for event in job:
+                    events.put((i, event))
+                return path
+            except FFMpegCancelledError:
+                raise
+            except (FFMpegError, FFMpegConvertError):
+                if self.cancelled or attempt == self.retries:
+                    raise
+                log.warning('Chunk %s (%.3f-%s) failed, retrying', i, start, end, exc_info=True)
@@ -26,6 +26,11 @@ class Container(object):
             self.subtitle_streams = []
             self.image_streams = []
             self.file_path = file_path
+            self.duration = None
+            # Timestamp of the start of the container, in seconds, see split_at_keyframes
+            self.start_time = None
+            # Private options of the muxer writing the container, e.g. movflags
+            self.format_options = {}
             self._absolute_number = {}
             self._relative_number = {}
 
@@ -148,16 +153,16 @@ class Container(object):
             else:
                 s.add_options(Disposition({'default': 0}))
 
+        # The options of the target's streams are those of the source's and of the templates, which other targets
+        # use too: changed dispositions are new options.
         if len(dispo_dict[1]) == 0 and len(dispo_dict[0]) > 0:
             dispo = dispo_dict[0][0].options.get_unique_option(Disposition)
-            dispo._value['default'] = 1
-            # dispo_dict[0][0].add_options(Disposition({'default': 1}))
+            dispo_dict[0][0].add_options(Disposition({**dispo.value, 'default': 1}))
 
         if len(dispo_dict[1]) > 1:
             for k in dispo_dict[1][1:]:
                 dispo = k.options.get_unique_option(Disposition)
-                dispo._value['default'] = 0
-                #k.add_options(Disposition({'default': 0}))
+                k.add_options(Disposition({**dispo.value, 'default': 0}))
 
 
 class ContainerFactory(object):
@@ -180,6 +185,9 @@ class ContainerFactory(object):
         else:
             ctn = Container(parser.container_format, parser.file_path)
 
+        ctn.duration = parser.duration
+        ctn.start_time = parser.start_time
+
         for idx in range(len(parser.streams)):
             s = StreamFactory.create_stream(parser.stream_format(idx))
 
@@ -212,5 +220,6 @@ class ContainerFactory(object):
                 s.add_options(parser.disposition(idx))
 
             if s:
+                s.rate = parser.rate(idx)
                 ctn.add_stream(s, idx)
         return ctn
@@ -479,10 +479,10 @@ class Encoders(object):
                          MOVText, WebVTT, SSA, SubRip, DVBSub, DVDSub, Pgs, Srt]
 
     def __init__(self, ffmpeg):
-        self._available_encoders = ffmpeg.encoders
-        self._available_decoders = ffmpeg.decoders
+        self._available_encoders = frozenset(ffmpeg.encoders)
+        self._available_decoders = frozenset(ffmpeg.decoders)
         self.supported_codecs = [cdc for cdc in self.__class__._supported_codecs if
-                                 cdc.ffmpeg_codec_name in ffmpeg.encoders]
+                                 cdc.ffmpeg_codec_name in self._available_encoders]
 
     def is_ffmpeg_encoder(self, enc):
         return enc in self._available_encoders
@@ -5,12 +5,16 @@ import logging
 import os
 import os.path
 import re
-import signal
 from subprocess import Popen, PIPE
 from typing import Union
 import sys
 from mediaprocessor.converter.parsers import FFprobeParser
 from mediaprocessor.converter.options import Language
+from mediaprocessor.converter.encoders import VideoCopy, AudioCopy, SubtitleCopy
+from mediaprocessor.converter.cache import Capabilities, CapabilityCache, ProbeCache
+from mediaprocessor.converter.progress import ProgressEvent, ProgressParser, StderrRing
+from mediaprocessor.converter.watchdog import Watchdog
+from mediaprocessor.converter.jobs import ConversionJob
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -52,6 +56,26 @@ class FFMpegConvertError(Exception):
         return self.__repr__()
 
 
+class FFMpegStallError(FFMpegConvertError):
+    """Raised when ffmpeg was stopped because it stopped making progress, or progressed too slowly."""
+
+    def __init__(self, message, cmd, output, last_progress=None, pid=0):
+        """
+        :param last_progress: last ProgressEvent reported before ffmpeg was stopped, None if it never reported any
+        :type last_progress: mediaprocessor.converter.progress.ProgressEvent
+        """
+        super(FFMpegStallError, self).__init__(message, cmd, output, details=message, pid=pid)
+        self.last_progress = last_progress
+
+    def __repr__(self):
+        return f'<FFMpegStallError error={self.message}, pid={self.pid}, last_progress={self.last_progress}>'
+
+
+class FFMpegCancelledError(FFMpegConvertError):
+    """Raised by a conversion that was cancelled through its ConversionJob."""
+    pass
+
+
 class FFMpeg(object):
     """
     FFMPeg wrapper object, takes care of calling the ffmpeg binaries,
@@ -60,15 +84,17 @@ class FFMpeg(object):
     >>> f = FFMpeg()
     """
     DEFAULT_JPEG_QUALITY = 4
+    STDERR_LINES = 200
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, probe_cache: ProbeCache = None):
         """
         Initialize a new FFMpeg wrapper object. Optional parameters specify
-        the paths to ffmpeg and ffprobe utilities.
+        the paths to ffmpeg and ffprobe utilities, and a ProbeCache used to avoid
+        probing the same file twice.
         """
 
         def which(name):
-            path = os.environ.get_parser('PATH', os.defpath)
+            path = os.environ.get('PATH', os.defpath)
             for d in path.split(':'):
                 fpath = os.path.join(d, name)
                 if os.path.exists(fpath) and os.access(fpath, os.X_OK):
@@ -88,6 +114,7 @@ class FFMpeg(object):
 
         self.ffmpeg_path = ffmpeg_path
         self.ffprobe_path = ffprobe_path
+        self.probe_cache = probe_cache
 
         if not os.path.exists(self.ffmpeg_path):
             raise FFMpegError("ffmpeg binary not found: " + self.ffmpeg_path)
@@ -95,50 +122,44 @@ class FFMpeg(object):
         if not os.path.exists(self.ffprobe_path):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
-        self.hwaccels = []
-
-        self.encoders = []
-        self.decoders = []
+        self.hwaccels = frozenset()
+        self.encoders = frozenset()
+        self.decoders = frozenset()
+        self.muxers = frozenset()
+        self.filters = frozenset()
 
         self._getcapabilities()
 
     def _getcapabilities(self):
-
-        p = self._spawn([self.ffmpeg_path, '-v', 0, '-encoders'])
-        stdout, _ = p.communicate()
-        stdout = stdout.decode(console_encoding, errors='ignore')
-
-        start = False
-        for line in stdout.split('\n'):
-            theline = line.strip()
-            if theline == '------':
-                start = True
-                continue
-            if start:
-                try:
-                    codectype, codecname, *_ = re.split(r' ', theline)
-                except ValueError:
-                    pass
-                if codectype[0] in ['V', 'A', 'S']:
-                    self.encoders.append(codecname)
-
-        p = self._spawn([self.ffmpeg_path, '-v', 0, '-decoders'])
-        stdout, _ = p.communicate()
-        stdout = stdout.decode(console_encoding, errors='ignore')
-
-        start = False
-        for line in stdout.split('\n'):
-            theline = line.strip()
-            if theline == '------':
-                start = True
-                continue
-            if start:
-                try:
-                    codectype, codecname, *_ = re.split(r' ', theline)
-                except ValueError:
-                    pass
-                if codectype[0] in ['V', 'A', 'S']:
-                    self.decoders.append(codecname)
+        """
+        Finds out which encoders, decoders, hwaccels, muxers and filters the ffmpeg binary supports. The result is
+        cached in memory and on disk, keyed on the binary itself, so ffmpeg is only queried when it changes.
+        """
+        cache = CapabilityCache()
+        capabilities = cache.get(self.ffmpeg_path)
+
+        if capabilities is None:
+            queries = {'encoders': Capabilities.parse_codecs,
+                       'decoders': Capabilities.parse_codecs,
+                       'hwaccels': Capabilities.parse_hwaccels,
+                       'muxers': Capabilities.parse_muxers,
+                       'filters': Capabilities.parse_filters}
+
+            # Spawn all the queries at once, they are independent from each other.
+            processes = {k: self._spawn([self.ffmpeg_path, '-v', 0, '-hide_banner', f'-{k}']) for k in queries}
+            found = {}
+            for k, p in processes.items():
+                stdout, _ = p.communicate()
+                found[k] = queries[k](stdout.decode(console_encoding, errors='ignore'))
+
+            capabilities = Capabilities(**found)
+            cache.put(self.ffmpeg_path, capabilities)
+
+        self.encoders = capabilities.encoders
+        self.decoders = capabilities.decoders
+        self.hwaccels = capabilities.hwaccels
+        self.muxers = capabilities.muxers
+        self.filters = capabilities.filters
 
     @staticmethod
     def _spawn(cmds):
@@ -164,16 +185,31 @@ class FFMpeg(object):
         if not os.path.exists(fname):
             raise FileNotFoundError
 
-        p = self._spawn([self.ffprobe_path,
-                         '-show_format', '-show_streams', '-hide_banner', '-print_format', 'json', fname])
+        if self.probe_cache:
+            stdout_data = self.probe_cache.get(fname)
+            if stdout_data is not None:
+                return FFprobeParser(stdout_data, file_path=fname)
+
+        st = os.stat(fname)
+        p = self._spawn(self.probe_commands(fname))
         stdout_data, _ = p.communicate()
+        return self._probed(fname, stdout_data, p.returncode, st)
+
+    def probe_commands(self, fname) -> list:
+        return [self.ffprobe_path, '-show_format', '-show_streams', '-hide_banner', '-print_format', 'json', fname]
+
+    def _probed(self, fname, stdout_data: bytes, returncode, st=None) -> FFprobeParser:
+        """:param st: os.stat of fname taken before ffprobe ran, see ProbeCache.put"""
         stdout_data = stdout_data.decode(console_encoding, errors='ignore')
         parser = FFprobeParser(stdout_data)
 
+        if self.probe_cache and returncode == 0:
+            self.probe_cache.put(fname, stdout_data, st)
+
         return parser
 
     def generate_commands(self, source_container, target_container, mapping, encoder_factory, preopts=None,
-                          postopts=None):
+                          postopts=None, threads=None, metadata=None, cover=None):
         """
 
         :param source_container:
@@ -184,35 +220,328 @@ class FFMpeg(object):
         :type mapping: list
         :param encoder_factory:
         :type encoder_factory: converter.encoders.EncoderFactory
-        :param timeout:
         :param preopts:
         :param postopts:
+        :param threads: threads ffmpeg may use, see thread_args. None leaves it up to ffmpeg
+        :param metadata: global metadata of the output, see tag_args
+        :param cover: image to add to the output as its cover, see tag_args
         :return: list
         """
 
         cmds = [self.ffmpeg_path,
                 '-i',
                 source_container.file_path]
+        if cover:
+            cmds.extend(['-i', cover])
 
         if preopts:
             cmds.extend(preopts)
 
+        streams = []
         for source_index, target_index in mapping:
-            source_stream = source_container.streams[source_index]
-            target_stream = target_container.streams[target_index]  # type: converter.streams.Stream
-            cmds.extend(['-map', f'0:{source_index}'])
+            streams.extend(['-map', f'0:{source_index}'])
+            streams.extend(self.stream_args(source_container, target_container, source_index, target_index,
+                                            encoder_factory))
+        cmds.extend(streams)
+        cmds.extend(self.tag_args(metadata, cover, len(target_container.video_streams)))
+        cmds.extend(self.thread_args(threads, streams))
+
+        cmds.extend(['-f', target_container.format])
+        cmds.extend(self.format_args(target_container))
+
+        if postopts:
+            cmds.extend(postopts)
+
+        cmds.extend(['-y', target_container.file_path])
+
+        return cmds
+
+    @staticmethod
+    def stream_args(source_container, target_container, source_index, target_index, encoder_factory,
+                    copy=False, stream_number=None) -> list:
+        """
+        Encoder arguments turning a stream of the source into a stream of the target.
+        :param copy: copy the stream whatever the encoder factory picks, only setting its metadata
+        :param stream_number: number of the stream among the output streams of its kind, defaults to its number in
+        the target
+        :return: list
+        """
+        source_stream = source_container.streams[source_index]
+        target_stream = target_container.streams[target_index]  # type: converter.streams.Stream
+        if copy:
+            encoder = {'video': VideoCopy, 'audio': AudioCopy, 'subtitle': SubtitleCopy}[target_stream.kind]()
+        else:
             encoder = encoder_factory.get_encoder(source_stream, target_stream)
 
-            if 'copy' in encoder.codec_name:
-                encoder.add_option(*target_stream.options.metadata_options())
-                if target_stream.options.has_option(Language):
-                    encoder.add_option(target_stream.options.get_unique_option(Language))
-            else:
-                encoder.add_option(*target_stream.options)
+        if 'copy' in encoder.codec_name:
+            encoder.add_option(*target_stream.options.metadata_options())
+            if target_stream.options.has_option(Language):
+                encoder.add_option(target_stream.options.get_unique_option(Language))
+        else:
+            encoder.add_option(*target_stream.options)
 
-            cmds.extend(encoder.parse(target_container.relative_stream_number(target_stream.uid)))
+        if stream_number is None:
+            stream_number = target_container.relative_stream_number(target_stream.uid)
+        return encoder.parse(stream_number)
+
+    @staticmethod
+    def format_args(target_container) -> list:
+        """Options of the muxer of the target, see Container.format_options."""
+        args = []
+        for key, value in target_container.format_options.items():
+            args.extend([f'-{key}', str(value)])
+        return args
+
+    @staticmethod
+    def tee_slave(target_container, select) -> str:
+        """
+        Output of the tee muxer writing target_container, with the streams of the tee at the indexes in select. tee
+        reads its argument with av_get_token twice, once to split the outputs at |, once more for the options
+        between brackets: values are quoted when they contain a quote, a backslash, : or ], then the whole output,
+        path included, is escaped.
+        """
+        options = [('f', target_container.format)] + list(target_container.format_options.items())
+        options.append(('select', ','.join(str(i) for i in select)))
+        quoted = []
+        for key, value in options:
+            value = str(value)
+            if not value or value.strip() != value or any(c in value for c in "\\':]"):
+                value = "'" + value.replace("'", "'\\''") + "'"
+            quoted.append(f'{key}={value}')
+
+        slave = re.sub(r"([\\'|])", r'\\\1', f"[{':'.join(quoted)}]{target_container.file_path}")
+        # Whitespace at the end of a token is dropped unless it is escaped
+        trimmed = slave.rstrip()
+        return trimmed + ''.join('\\' + c for c in slave[len(trimmed):])
+
+    @staticmethod
+    def faststart_options(mode, target_container, duration=None, rates=None) -> dict:
+        """
+        Muxer options writing the moov atom of an mp4 before its media data, so that no second pass has to move it.
+        movflags has ffmpeg move the moov itself once the file is written, which still reads and writes the file
+        again, within ffmpeg. reserve leaves room for the moov at the start of the file instead, so that the file is
+        written once. ffmpeg fails on the trailer, and the encode is lost, if the room is too small, so it is sized
+        for the worst case of the sample tables: every sample of the streams in its own chunk, with its own size,
+        duration, composition offset and sync sample entries. Without a duration, reserve falls back to movflags.
+        :param mode: off, movflags or reserve
+        :param duration: duration of the source, in seconds
+        :param rates: frames per second of the video streams of the target, samples per second of its audio
+        streams, by index of the stream in the target (see Stream.rate). Unknown rates are taken as 60 frames and
+        48000 samples per second.
+        :return: dict
+        """
+        if mode not in ['movflags', 'reserve'] or target_container.format not in ['mp4', 'mov']:
+            return {}
+        if mode == 'reserve' and duration:
+            rates = rates or {}
+            size = 0
+            for index, stream in enumerate(target_container.streams):
+                if stream.kind == 'video':
+                    # stsz, stts, ctts, stss, stsc and co64 entries for every frame
+                    size += (rates.get(index) or 60) * 44
+                elif stream.kind == 'audio':
+                    # stsz, stts, stsc and co64 entries for every packet, which hold at least 960 samples
+                    size += (rates.get(index) or 48000) / 960 * 32
+                else:
+                    # A few cues per second at most, and the empty samples between them
+                    size += 4 * 32
+            return {'moov_size': int(duration * size * 1.1) + 262144}
+        return {'movflags': '+faststart'}
+
+    @staticmethod
+    def tag_args(metadata=None, cover=None, stream_number=0, cover_input=1) -> list:
+        """
+        Output options tagging the output while it is muxed, so that it does not have to be rewritten afterwards.
+        :param metadata: dict of global metadata, with the keys of the muxer, e.g. title or show for mp4
+        :param cover: path to an image, added as an attached picture (covr in mp4)
+        :param stream_number: number of the cover among the video streams of the output
+        :param cover_input: index of the cover among the inputs of the command
+        :return: list
+        """
+        args = []
+        if cover:
+            args.extend(['-map', f'{cover_input}:0', f'-c:v:{stream_number}', 'copy',
+                         f'-disposition:v:{stream_number}', 'attached_pic'])
+        for key, value in (metadata or {}).items():
+            args.extend(['-metadata', f'{key}={value}'])
+        return args
+
+    @staticmethod
+    def thread_args(threads, stream_args: list) -> list:
+        """
+        Output options limiting an ffmpeg output to threads threads: the encoders' and the filters' thread counts,
+        and the thread pools of libx264 and libx265, which size them on the number of CPUs otherwise.
+        :param threads: number of threads, None or 0 for no limit
+        :param stream_args: the encoder arguments of the output, to find out which encoders it uses
+        :return: list
+        """
+        if not threads:
+            return []
+
+        args = ['-threads', str(threads), '-filter_threads', str(threads)]
+        if 'libx264' in stream_args:
+            args.extend(['-x264-params', f'threads={threads}'])
+        if 'libx265' in stream_args:
+            args.extend(['-x265-params', f'pools={threads}'])
+        return args
+
+    def generate_multi_commands(self, source_container, targets, threads=None) -> list:
+        """
+        Single command line producing several targets from the same source, so that the source is read and decoded
+        once. When the tee muxer is available and the targets need the same encoded stream (same source stream,
+        same encoder arguments), the stream is encoded once and tee sends it to every target that selects it.
+        Otherwise, and whenever a target has preopts or postopts that could not be attributed to a single tee slave,
+        the command simply has one output per target.
+        :param source_container: the source, common to all targets
+        :type source_container: converter.containers.Container
+        :param targets: list of (target_container, mapping, encoder_factory, preopts, postopts) tuples
+        :param threads: threads the whole command may use, shared between the outputs when there are several
+        :return: list
+        """
+        cmds = [self.ffmpeg_path, '-i', source_container.file_path]
+
+        # Streams of all targets, those that would come out identical only once.
+        keys = []
+        union = []
+        selects = []
+        for target_container, mapping, encoder_factory, _, _ in targets:
+            select = []
+            for source_index, target_index in mapping:
+                key = (source_index,
+                       tuple(self.stream_args(source_container, target_container, source_index, target_index,
+                                              encoder_factory, stream_number=0)))
+                if key not in keys:
+                    keys.append(key)
+                    union.append((target_container, source_index, target_index, encoder_factory))
+                select.append(keys.index(key))
+            selects.append(select)
+
+        # Sharing a copied stream saves nothing, tee is only worth it for encoded ones.
+        encoded = [i for i, (_, args) in enumerate(keys) if args[1] != 'copy']
+        shared = sum(1 for select in selects for i in select if i in encoded) - len(encoded)
+        use_tee = ('tee' in self.muxers and shared > 0 and
+                   not any(preopts or postopts for _, _, _, preopts, postopts in targets))
+
+        if not use_tee:
+            if threads:
+                threads = max(threads // len(targets), 1)
+            for target_container, mapping, encoder_factory, preopts, postopts in targets:
+                if preopts:
+                    cmds.extend(preopts)
+                streams = []
+                for source_index, target_index in mapping:
+                    streams.extend(['-map', f'0:{source_index}'])
+                    streams.extend(self.stream_args(source_container, target_container, source_index, target_index,
+                                                    encoder_factory))
+                cmds.extend(streams)
+                cmds.extend(self.thread_args(threads, streams))
+                cmds.extend(['-f', target_container.format])
+                cmds.extend(self.format_args(target_container))
+                if postopts:
+                    cmds.extend(postopts)
+                cmds.extend(['-y', target_container.file_path])
+            return cmds
+
+        counters = {}
+        streams = []
+        for target_container, source_index, target_index, encoder_factory in union:
+            kind = target_container.streams[target_index].kind
+            number = counters.get(kind, 0)
+            counters[kind] = number + 1
+            streams.extend(['-map', f'0:{source_index}'])
+            streams.extend(self.stream_args(source_container, target_container, source_index, target_index,
+                                            encoder_factory, stream_number=number))
+        cmds.extend(streams)
+        cmds.extend(self.thread_args(threads, streams))
+
+        slaves = [self.tee_slave(target_container, select)
+                  for (target_container, _, _, _, _), select in zip(targets, selects)]
+
+        # The muxers behind tee cannot ask the encoders for global headers themselves.
+        cmds.extend(['-flags', '+global_header', '-f', 'tee', '-y', '|'.join(slaves)])
+
+        return cmds
+
+    def keyframes(self, fname, stream='v:0') -> list:
+        """
+        Timestamps, in seconds, of the keyframes of a stream. Only packet headers are read, nothing is decoded.
+        :param fname: path to the file to examine
+        :param stream: ffprobe stream specifier
+        """
+        p = self._spawn([self.ffprobe_path, '-v', 'error', '-select_streams', stream,
+                         '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', fname])
+        stdout_data, _ = p.communicate()
+
+        keyframes = []
+        for line in stdout_data.decode(console_encoding, errors='ignore').splitlines():
+            pts, _, flags = line.partition(',')
+            if 'K' not in flags:
+                continue
+            try:
+                keyframes.append(float(pts))
+            except ValueError:
+                # pts_time is N/A for some packets
+                continue
+
+        return sorted(keyframes)
+
+    def generate_chunk_commands(self, source_container, target_container, mapping, encoder_factory, start, end,
+                                chunk_path, threads=None, preopts=None):
+        """
+        Command line encoding the video streams of the mapping between start and end (in seconds, None for the end of
+        the file) to chunk_path. start should be a keyframe, so that input seeking is exact.
+        :return: list
+        """
+        cmds = [self.ffmpeg_path, '-ss', f'{start:.6f}', '-i', source_container.file_path]
+
+        if preopts:
+            cmds.extend(preopts)
+
+        streams = []
+        for source_index, target_index in mapping:
+            if target_container.streams[target_index].kind != 'video':
+                continue
+            streams.extend(['-map', f'0:{source_index}'])
+            streams.extend(self.stream_args(source_container, target_container, source_index, target_index,
+                                            encoder_factory))
+        cmds.extend(streams)
+        cmds.extend(self.thread_args(threads, streams))
+
+        if end is not None:
+            cmds.extend(['-t', f'{end - start:.6f}'])
+
+        cmds.extend(['-f', 'matroska', '-y', chunk_path])
+
+        return cmds
+
+    def generate_concat_commands(self, source_container, target_container, mapping, encoder_factory, concat_list,
+                                 preopts=None, postopts=None):
+        """
+        Command line joining the chunks listed in concat_list (a concat demuxer script) into the target. The video
+        streams are copied from the chunks, the other streams of the mapping come from the source.
+        :return: list
+        """
+        cmds = [self.ffmpeg_path,
+                '-f', 'concat', '-safe', '0', '-i', concat_list,
+                '-i', source_container.file_path]
+
+        if preopts:
+            cmds.extend(preopts)
+
+        video = 0
+        for source_index, target_index in mapping:
+            if target_container.streams[target_index].kind == 'video':
+                cmds.extend(['-map', f'0:{video}'])
+                cmds.extend(self.stream_args(source_container, target_container, source_index, target_index,
+                                             encoder_factory, copy=True))
+                video += 1
+            else:
+                cmds.extend(['-map', f'1:{source_index}'])
+                cmds.extend(self.stream_args(source_container, target_container, source_index, target_index,
+                                             encoder_factory))
 
         cmds.extend(['-f', target_container.format])
+        cmds.extend(self.format_args(target_container))
 
         if postopts:
             cmds.extend(postopts)
@@ -221,84 +550,124 @@ class FFMpeg(object):
 
         return cmds
 
-    def convert2(self, cmds: list):
-        def seconds(hours, minutes, seconds):
-            return (int(hours) * 60 + int(minutes)) * 60 + int(seconds)
+    def start(self, cmds: list, duration=None, timeout=None, min_speed=None, min_speed_window=60,
+              outputs=None) -> ConversionJob:
+        """
+        Starts an ffmpeg command line, as produced by generate_commands, and returns a handle on it. Iterating over
+        the handle drives the conversion and yields ProgressEvents, the handle can be cancelled from any thread.
+        Progress is read from ffmpeg's -progress channel on stdout, stderr is drained separately and only its
+        last lines are kept to report errors.
+        A Watchdog stops ffmpeg, and FFMpegStallError is raised, if it reports no progress for timeout seconds or
+        runs slower than min_speed for min_speed_window seconds.
+        :param cmds: ffmpeg command line
+        :param duration: duration of the input in seconds, taken from ffmpeg's output if not provided
+        :param timeout: seconds without progress before ffmpeg is stopped, None or 0 to wait forever
+        :param min_speed: minimum speed, as a multiple of real time, None or 0 to disable
+        :param min_speed_window: seconds ffmpeg may run under min_speed before being stopped
+        :param outputs: files written by the command, removed if the job is cancelled. Defaults to the last argument
+        of the command line.
+        """
+        cmds = [cmds[0], '-nostats', '-progress', 'pipe:1'] + list(cmds[1:])
+        if outputs is None:
+            outputs = [cmds[-1]]
 
         try:
             p = self._spawn(cmds)
         except OSError:
             raise FFMpegError('Error while calling ffmpeg binary')
 
-        yielded = False
-        buf = ''
-        total_output = ''
-        pat = re.compile('time=(\d{2}):(\d{2}):(\d{2})\.\d{2}')
-        duration = re.compile('Duration: (\d{2}):(\d{2}):(\d{2})\.\d{2}')
-        while True:
+        job = ConversionJob(p, cmds, outputs)
+        job.events = self._follow(job, duration, timeout, min_speed, min_speed_window)
+        return job
 
-            ret = p.stderr.read(10)
+    def convert2(self, cmds: list, duration=None, timeout=None, min_speed=None, min_speed_window=60):
+        """
+        Runs an ffmpeg command line and yields ProgressEvents. See start, which also gives a handle on the job.
+        """
+        yield from self.start(cmds, duration=duration, timeout=timeout, min_speed=min_speed,
+                              min_speed_window=min_speed_window)
 
-            if not ret:
-                # For small or very fast jobs, ffmpeg may never output a '\r'.  When EOF is reached, yield if we haven't yet.
-                if not yielded:
-                    yielded = True
-                    yield 10
-                break
+    def _follow(self, job: ConversionJob, duration, timeout, min_speed, min_speed_window):
+        p = job.process
 
-            try:
-                ret = ret.decode(console_encoding)
-            except UnicodeDecodeError:
-                try:
-                    ret = ret.decode(console_encoding, errors="ignore")
-                except:
-                    pass
-
-
-            total_output += ret
-
-            buf += ret
-            if '\r' in buf:
-                line, buf = buf.split('\r', 1)
-                d = duration.findall(line)
-                if len(d) > 0:
-                    ds = seconds(*d[0])
-
-                t = pat.findall(line)
-                if len(t) > 0:
-                    ts = seconds(*t[0])
+        stderr = StderrRing(p.stderr, max_lines=self.STDERR_LINES, encoding=console_encoding)
+        stderr.start()
+        parser = ProgressParser()
+
+        watchdog = None
+        if timeout or min_speed:
+            watchdog = Watchdog(p, stall_timeout=timeout, min_speed=min_speed, min_speed_window=min_speed_window)
+            watchdog.start()
+
+        yielded = False
+        try:
+            while True:
+                data = p.stdout.read1(65536)
+                if not data:
+                    break
+
+                for block in parser.feed(data):
+                    event = ProgressEvent.from_block(block, duration or stderr.duration, p.pid)
+                    if watchdog:
+                        watchdog.notify(event)
                     yielded = True
-                    yield ts / ds
+                    yield event
+        except GeneratorExit:
+            # The caller stopped listening, nobody will read ffmpeg's output anymore.
+            job.cancel(graceful=False)
+            raise
+        finally:
+            p.wait()
+            if watchdog:
+                watchdog.stop()
+            stderr.join()
+            job.close()
+
+        self._check_exit(job, stderr, watchdog)
+
+        if not yielded:
+            # For small or very fast jobs, ffmpeg may never report any progress.
+            yield ProgressEvent(fraction=1.0, pid=p.pid, finished=True)
+
+    @staticmethod
+    def _check_exit(job, stderr: StderrRing, watchdog=None):
+        """Raises the error matching how ffmpeg exited, if it did not succeed."""
+        cmds = job.cmds
+        cmd = ' '.join(cmds)
 
-        p.communicate()  # wait for process to exit
+        if job.cancelled:
+            # The cancelling thread may still be waiting on the process, do not leave the partial outputs behind.
+            job.remove_outputs()
+            raise FFMpegCancelledError('Cancelled', cmd, stderr.text, pid=job.pid)
 
-        if total_output == '':
+        if watchdog and watchdog.tripped:
+            raise FFMpegStallError(watchdog.reason, cmd, stderr.text, last_progress=watchdog.last_progress,
+                                   pid=job.pid)
+
+        if stderr.empty:
             raise FFMpegError('Error while calling ffmpeg binary')
 
-        cmd = ' '.join(cmds)
-        if '\n' in total_output:
-            line = total_output.split('\n')[-2]
-
-            if line.startswith('Received signal'):
-                # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
-            if line.startswith('Error while '):
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
-            if not yielded:
-                raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-
-        if p.returncode != 0:
+        line = stderr.last_line
+        inputs = [cmds[i + 1] for i, c in enumerate(cmds[:-1]) if c == '-i']
+
+        if line.startswith('Received signal'):
+            # Received signal 15: terminating.
+            raise FFMpegConvertError(line.split(':')[0], cmd, stderr.text, pid=job.pid)
+        for infile in inputs:
+            if line.startswith(infile + ': '):
+                raise FFMpegConvertError('Encoding error', cmd, stderr.text, line[len(infile) + 2:], pid=job.pid)
+        if line.startswith('Error while '):
+            raise FFMpegConvertError('Encoding error', cmd, stderr.text, line, pid=job.pid)
+
+        if job.returncode != 0:
+            lines = stderr.lines
             try:
-                e = total_output.split('\n')
-                i = e.index('Stream mapping:')
-                m = e[i-2:i]
+                i = lines.index('Stream mapping:')
+                m = '\n'.join(lines[i - 2:i])
             except ValueError:
-                m = ''
+                m = stderr.text
 
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     m, pid=p.pid)
+            raise FFMpegConvertError('Exited with code %d' % job.returncode, cmd, m, line, pid=job.pid)
 
     def convert(self, infile, outfile, opts, timeout=10, preopts=None, postopts=None):
         """
@@ -310,20 +679,16 @@ class FFMpeg(object):
         of currently processed part of the file (ie. at which second in the
         content is the conversion process currently).
 
-        The optional timeout argument specifies how long should the operation
-        be blocked in case ffmpeg gets stuck and doesn't report back. See
-        the documentation in Converter.convert() for more details about this
-        option.
+        The optional timeout argument specifies how many seconds ffmpeg may
+        go without reporting progress before it is stopped and an
+        FFMpegStallError raised, see convert2.
 
         >>> conv = FFMpeg().convert('test.ogg', '/tmp/output.mp3',
         ...    ['-acodec libmp3lame', '-vn'])
-        >>> for timecode in conv:
+        >>> for event in conv:
         ...    pass # can be used to inform the user about conversion progress
 
         """
-        if os.name == 'nt':
-            timeout = 0
-
         if not os.path.exists(infile):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
@@ -344,91 +709,6 @@ class FFMpeg(object):
             cmds.extend(postopts)
         cmds.extend(['-y', outfile])
 
-        if timeout:
-            def on_sigalrm(*_):
-                signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                raise Exception('timed out while waiting for ffmpeg')
-
-            signal.signal(signal.SIGALRM, on_sigalrm)
-
-        try:
-            p = self._spawn(cmds)
-        except OSError:
-            raise FFMpegError('Error while calling ffmpeg binary')
-
-        yielded = False
-        buf = ''
-        total_output = ''
-        pat = re.compile(r'time=([0-9.:]+) ')
-
-        while True:
-            if timeout:
-                signal.alarm(timeout)
-
-            ret = p.stderr.read(10)
-
-            if timeout:
-                signal.alarm(0)
-
-            if not ret:
-                # For small or very fast jobs, ffmpeg may never output a '\r'.  When EOF is reached, yield if we haven't yet.
-                if not yielded:
-                    yielded = True
-                    yield 10
-                break
-
-            try:
-                ret = ret.decode(console_encoding)
-            except UnicodeDecodeError:
-                try:
-                    ret = ret.decode(console_encoding, errors="ignore")
-                except:
-                    pass
-
-            total_output += ret
-            buf += ret
-            if '\r' in buf:
-                line, buf = buf.split('\r', 1)
-
-                tmp = pat.findall(line)
-                if len(tmp) == 1:
-                    timespec = tmp[0]
-                    if ':' in timespec:
-                        timecode = 0
-                        for part in timespec.split(':'):
-                            timecode = 60 * timecode + float(part)
-                    else:
-                        timecode = float(tmp[0])
-                    yielded = True
-                    yield timecode
-
-        if timeout:
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
-
-        p.communicate()  # wait for process to exit
-
-        if total_output == '':
-            raise FFMpegError('Error while calling ffmpeg binary')
-
-        cmd = ' '.join(cmds)
-        if '\n' in total_output:
-            line = total_output.split('\n')[-2]
-
-            if line.startswith('Received signal'):
-                # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
-            if line.startswith(infile + ': '):
-                err = line[len(infile) + 2:]
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
-            if line.startswith('Error while '):
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
-            if not yielded:
-                raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+        yield from self.convert2(cmds, timeout=timeout)
 
         return outfile
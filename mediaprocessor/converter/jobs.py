@@ -0,0 +1,170 @@
+"""
+Module converter.jobs.py
+Handles on running ffmpeg processes. A ConversionJob can be cancelled from any thread, and every running job is
+known to the process-wide registry so that a host shutting down can stop all of its children cleanly.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ConversionJob(object):
+    """
+    A running ffmpeg process. Iterating over the job drives it and yields ProgressEvents, see FFMpeg.start.
+    """
+    quit_timeout = 10
+    term_timeout = 5
+
+    def __init__(self, process, cmds: list, outputs=None, registry=None):
+        """
+        :param process: the ffmpeg subprocess.Popen
+        :param cmds: the ffmpeg command line
+        :param outputs: files written by ffmpeg, removed if the job is cancelled
+        :param registry: JobRegistry the job belongs to, defaults to the process-wide one
+        """
+        self.process = process
+        self.cmds = cmds
+        self.outputs = list(outputs or [])
+        self.cancelled = False
+        self.events = iter(())
+        self.registry = registry if registry is not None else JobRegistry.default()
+        self.registry.register(self)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        return self.process.poll()
+
+    @property
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+    def __iter__(self):
+        return self.events
+
+    def wait(self, timeout=None) -> bool:
+        """Waits for ffmpeg to exit, returns False if it is still running after timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.process.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def cancel(self, graceful=True) -> bool:
+        """
+        Stops ffmpeg and removes the partial outputs. A graceful cancel first asks ffmpeg to quit by sending q on its
+        stdin, then sends SIGTERM after quit_timeout seconds, and SIGKILL after another term_timeout seconds.
+        Otherwise ffmpeg is killed straight away. Whoever iterates over the job gets an FFMpegCancelledError.
+        :param graceful: whether to give ffmpeg a chance to exit on its own
+        :return: True if ffmpeg is gone
+        """
+        if not self.running:
+            # Finished already, there is nothing partial to remove.
+            return True
+
+        self.cancelled = True
+        log.info('Cancelling ffmpeg (pid %s)', self.pid)
+        try:
+            if graceful:
+                try:
+                    self.process.stdin.write(b'q')
+                    self.process.stdin.flush()
+                except (OSError, ValueError):
+                    pass
+                if not self.wait(self.quit_timeout):
+                    self.process.terminate()
+                    if not self.wait(self.term_timeout):
+                        self.process.kill()
+            else:
+                self.process.kill()
+        except OSError:
+            # Exited in the meantime
+            pass
+
+        gone = self.wait(self.term_timeout)
+        if gone:
+            self.remove_outputs()
+        return gone
+
+    def remove_outputs(self):
+        for output in self.outputs:
+            try:
+                os.remove(output)
+                log.debug('Removed partial output %s', output)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.exception('Could not remove partial output %s', output)
+
+    def close(self):
+        self.registry.unregister(self)
+
+
+class JobRegistry(object):
+    """
+    Keeps track of the running ConversionJobs of the process. install_signal_handlers() makes SIGTERM (and SIGINT)
+    cancel every job gracefully before the process exits.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self._jobs = set()
+        # Reentrant: the signal handler runs on the main thread, possibly while register or unregister holds it
+        self._lock = threading.RLock()
+        self._previous_handlers = {}
+
+    @classmethod
+    def default(cls):
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def register(self, job: ConversionJob):
+        with self._lock:
+            self._jobs.add(job)
+
+    def unregister(self, job: ConversionJob):
+        with self._lock:
+            self._jobs.discard(job)
+
+    @property
+    def jobs(self) -> list:
+        with self._lock:
+            return list(self._jobs)
+
+    def cancel_all(self, graceful=True):
+        """Cancels every running job, in parallel so that the deadlines do not add up, and waits for them."""
+        threads = [threading.Thread(target=job.cancel, args=(graceful,), daemon=True) for job in self.jobs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def install_signal_handlers(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """
+        Makes the given signals drain every running job before the previous handler runs. Must be called from the
+        main thread.
+        """
+        for signum in signals:
+            self._previous_handlers[signum] = signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        log.warning('Received signal %s, cancelling %s running job(s)', signum, len(self.jobs))
+        self.cancel_all(graceful=True)
+
+        previous = self._previous_handlers.get(signum, signal.SIG_DFL)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
@@ -545,11 +545,26 @@ class UnsupportedOption(Exception):
 
 class Options(object):
     """A list-like object that contains options. This is the common object that hosts the options for streams
-    and encoders."""
+    and encoders.
+    The options are indexed by class, so that looking an option up, or replacing it in unique mode, does not scan the
+    whole collection: streams of large containers are compared and rebuilt many times per file."""
+
+    __slots__ = ('unique', '_index', '_names', '_options')
 
     def __init__(self, unique=False):
-        self.options = []
         self.unique = unique
+        # Options by class, in the order the classes were added. In unique mode every bucket holds a single option.
+        self._index = {}
+        # Class of each option name, lowercase, for get_option_by_name
+        self._names = {}
+        # All the options in insertion order, rebuilt from the index when None
+        self._options = []
+
+    @property
+    def options(self) -> list:
+        if self._options is None:
+            self._options = [bucket[0] for bucket in self._index.values()]
+        return self._options
 
     def add_option(self, opt):
         """
@@ -565,13 +580,17 @@ class Options(object):
         :return: None
         """
 
-        if issubclass(opt.__class__, IStreamOption) and opt.value is not None:
+        if isinstance(opt, IStreamOption) and opt.value is not None:
+            cls = opt.__class__
+            self._names.setdefault(cls.__name__.lower(), cls)
             if not self.unique:
-                self.options.append(opt)
+                self._index.setdefault(cls, []).append(opt)
+                self._options.append(opt)
             else:
-                opts = [o for o in self.options if o.__class__ != opt.__class__]
-                opts.append(opt)
-                self.options = opts[:]
+                # The replaced option goes to the end, as if it had been removed and added again
+                self._index.pop(cls, None)
+                self._index[cls] = [opt]
+                self._options = None
         else:
             pass
             # log.debug('Option %s was rejected because of None value', str(opt))
@@ -591,16 +610,10 @@ class Options(object):
 
     def get_option(self, option):
         """Method to get the all option objects that matches a specific type."""
-        for opt in self.options:
-            if opt.__class__ == option:
-                yield opt
+        yield from self._index.get(option, ())
 
     def get_option_by_name(self, option_name):
-        for opt in self.options:
-            if opt.__class__.__name__.lower() == option_name.lower():
-                return opt
-
-        return None
+        return self.get_unique_option(self._names.get(option_name.lower()))
 
     # def del_option(self, option):
     #    for opt in self.options:
@@ -609,17 +622,14 @@ class Options(object):
 
     def get_unique_option(self, option):
         """Method to get the first option object that matches a specific type."""
-        for opt in self.options:
-            if option == opt.__class__:
-                return opt
+        bucket = self._index.get(option)
+        return bucket[0] if bucket else None
 
     def has_option(self, opt):
 
         o = opt if isclass(opt) else opt.__class__
 
-        if o in [option.__class__ for option in self.options]:
-            return True
-        return False
+        return o in self._index
 
     def incompatible_options(self, other):
         if not isinstance(other, Options):
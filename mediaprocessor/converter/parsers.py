@@ -11,10 +11,17 @@ console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
 
 class FFprobeParser(object):
 
-    def __init__(self, jsonoutput):
+    def __init__(self, jsonoutput, file_path=None):
+        """
+        :param jsonoutput: output of ffprobe -show_format -show_streams -print_format json
+        :param file_path: path of the probed file, overrides the one recorded by ffprobe. Useful when the output
+        comes from a cache and the file may have been renamed since.
+        """
         output = json.loads(jsonoutput)
         self._streams = output['streams']
         self._format = output['format']
+        if file_path:
+            self._format['filename'] = file_path
 
     @property
     def streams(self):
@@ -28,6 +35,20 @@ class FFprobeParser(object):
     def file_path(self):
         return os.path.abspath(self._format['filename'])
 
+    @property
+    def duration(self):
+        try:
+            return float(self._format['duration'])
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def start_time(self):
+        try:
+            return float(self._format['start_time'])
+        except (KeyError, ValueError):
+            return None
+
     def pix_fmt(self, index) -> PixFmt:
         return PixFmt(self.streams[index].get('pix_fmt', ''))
 
@@ -73,5 +94,25 @@ class FFprobeParser(object):
     def profile(self, index) -> Profile:
         return Profile(self.streams[index].get('profile', ''))
 
+    def rate(self, index) -> Union[float, None]:
+        """Frames per second of a video stream, samples per second of an audio stream, None if unknown."""
+        stream = self.streams[index]
+        if stream.get('codec_type') == 'audio':
+            try:
+                return float(stream['sample_rate']) or None
+            except (KeyError, ValueError):
+                return None
+
+        # The average rate, r_frame_rate is the base rate of the timestamps, far higher for variable frame rates.
+        for key in ['avg_frame_rate', 'r_frame_rate']:
+            num, _, den = stream.get(key, '').partition('/')
+            try:
+                rate = float(num) / float(den or 1)
+            except (ValueError, ZeroDivisionError):
+                continue
+            if rate > 0:
+                return rate
+        return None
+
     def codec_type(self, index: Union[int, str]) -> Union[str, None]:
         return self.streams[index].get('codec_type', None)
@@ -0,0 +1,239 @@
+"""
+Module converter.progress.py
+Reads what a running ffmpeg reports. Progress comes from the machine-readable -progress channel as key=value blocks,
+stderr is only kept, bounded, so that errors can be reported.
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class ProgressParser(object):
+    """
+    Incremental parser for the output of ffmpeg -progress. Data is fed as it arrives, in chunks of any size, and
+    every complete block (terminated by a progress=continue or progress=end line) is returned as a dict of bytes.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._block = {}
+
+    def feed(self, data: bytes) -> list:
+        blocks = []
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            key, sep, value = line.partition(b'=')
+            if not sep:
+                continue
+            key = key.strip()
+            value = value.strip()
+            self._block[key] = value
+            if key == b'progress':
+                blocks.append(self._block)
+                self._block = {}
+        return blocks
+
+    @staticmethod
+    def out_time(block: dict):
+        """Position of the encoder in the output, in seconds, or None if ffmpeg did not report it yet."""
+        # out_time_ms is really in microseconds, out_time_us only exists in recent ffmpeg versions.
+        value = block.get(b'out_time_us', block.get(b'out_time_ms'))
+        try:
+            return int(value) / 1000000
+        except (TypeError, ValueError):
+            return None
+
+
+class ProgressEvent(object):
+    """
+    Snapshot of a running conversion.
+    out_time: position in the output, in seconds
+    fraction: share of the job done, between 0 and 1, None if the duration of the input is unknown
+    fps: frames encoded per second
+    speed: encoding speed as a multiple of real time
+    bitrate: current output bitrate, in kbit/s
+    total_size: bytes written to the output so far
+    eta: estimated seconds left
+    pid: pid of the ffmpeg process
+    finished: True for the last event of a conversion
+    """
+    __slots__ = ('out_time', 'fraction', 'fps', 'speed', 'bitrate', 'total_size', 'eta', 'pid', 'finished')
+
+    def __init__(self, out_time=None, fraction=None, fps=None, speed=None, bitrate=None, total_size=None, eta=None,
+                 pid=None, finished=False):
+        self.out_time = out_time
+        self.fraction = fraction
+        self.fps = fps
+        self.speed = speed
+        self.bitrate = bitrate
+        self.total_size = total_size
+        self.eta = eta
+        self.pid = pid
+        self.finished = finished
+
+    @classmethod
+    def from_block(cls, block: dict, duration=None, pid=None):
+        """
+        Builds an event from a block returned by ProgressParser.
+        :param block: dict of bytes as reported by ffmpeg -progress
+        :param duration: duration of the input in seconds, if known
+        :param pid: pid of the ffmpeg process
+        """
+        out_time = ProgressParser.out_time(block)
+        speed = _number(block.get(b'speed'), b'x')
+
+        fraction = None
+        eta = None
+        if out_time is not None and duration:
+            fraction = min(out_time / duration, 1.0)
+            if speed:
+                eta = max(duration - out_time, 0) / speed
+
+        total_size = _number(block.get(b'total_size'))
+
+        return cls(out_time=out_time,
+                   fraction=fraction,
+                   fps=_number(block.get(b'fps')),
+                   speed=speed,
+                   bitrate=_number(block.get(b'bitrate'), b'kbits/s'),
+                   total_size=int(total_size) if total_size is not None else None,
+                   eta=eta,
+                   pid=pid,
+                   finished=block.get(b'progress') == b'end')
+
+    def __float__(self):
+        return self.fraction or 0.0
+
+    def __repr__(self):
+        return ('<ProgressEvent ' + ', '.join(f'{k}={getattr(self, k)}' for k in self.__slots__) + '>')
+
+
+def _number(value, suffix=b''):
+    if value is None:
+        return None
+    try:
+        return float(value[:-len(suffix)] if suffix and value.endswith(suffix) else value)
+    except ValueError:
+        # ffmpeg reports N/A until it knows
+        return None
+
+
+class ProgressBroadcaster(object):
+    """
+    Delivers ProgressEvents to subscribers, each at most once every interval seconds. The last event of a
+    conversion is always delivered. Exceptions raised by subscribers are logged and otherwise ignored, a broken
+    progress display should not stop a conversion.
+    """
+
+    def __init__(self, interval=1.0):
+        """
+        :param interval: default minimum number of seconds between two deliveries to the same subscriber
+        """
+        self.interval = interval
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback, interval=None):
+        """
+        Registers callback, which will be called with ProgressEvents.
+        :param callback: callable taking a ProgressEvent
+        :param interval: minimum number of seconds between two calls, defaults to the broadcaster's interval
+        :return: a token to pass to unsubscribe
+        """
+        with self._lock:
+            token = object()
+            self._subscribers[token] = [callback, self.interval if interval is None else interval, None]
+            return token
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def publish(self, event: ProgressEvent):
+        now = time.monotonic()
+        with self._lock:
+            due = []
+            for subscriber in self._subscribers.values():
+                callback, interval, last = subscriber
+                if event.finished or last is None or now - last >= interval:
+                    subscriber[2] = now
+                    due.append(callback)
+
+        for callback in due:
+            try:
+                callback(event)
+            except Exception:
+                log.exception('Progress subscriber %s failed', callback)
+
+
+class StderrRing(threading.Thread):
+    """
+    Drains a stderr pipe in the background, keeping only its last max_lines lines. The duration of the first input
+    is picked up on the way, for callers that do not know it in advance.
+    """
+    max_line_length = 4096
+    _duration = re.compile(rb'Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)')
+
+    def __init__(self, stream, max_lines=200, encoding='utf-8'):
+        super(StderrRing, self).__init__(daemon=True)
+        self.stream = stream
+        self.encoding = encoding
+        self.duration = None
+        self._lines = deque(maxlen=max_lines)
+        self._received = False
+        self._partial = b''
+
+    def run(self):
+        try:
+            while True:
+                data = self.stream.read1(65536) if hasattr(self.stream, 'read1') else self.stream.read(65536)
+                if not data:
+                    break
+                self.feed(data)
+        except (OSError, ValueError):
+            log.debug('stderr pipe closed')
+        self.close()
+
+    def feed(self, data: bytes):
+        """Adds data read from stderr, for readers that drain the pipe themselves instead of starting the thread."""
+        self._received = True
+        lines = re.split(rb'[\r\n]', self._partial + data)
+        self._partial = lines.pop()[-self.max_line_length:]
+        for line in lines:
+            if line:
+                self._add(line)
+
+    def close(self):
+        """Keeps the last line, if it was not terminated, once stderr is closed."""
+        if self._partial:
+            self._add(self._partial)
+            self._partial = b''
+
+    def _add(self, line: bytes):
+        if self.duration is None:
+            m = self._duration.search(line)
+            if m:
+                hours, minutes, seconds = m.groups()
+                self.duration = (int(hours) * 60 + int(minutes)) * 60 + float(seconds)
+        self._lines.append(line[:self.max_line_length].decode(self.encoding, errors='replace'))
+
+    @property
+    def empty(self) -> bool:
+        return not self._received
+
+    @property
+    def lines(self) -> list:
+        return list(self._lines)
+
+    @property
+    def last_line(self) -> str:
+        return self._lines[-1] if self._lines else ''
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self._lines)
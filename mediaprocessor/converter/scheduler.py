@@ -0,0 +1,133 @@
+"""
+Module converter.scheduler.py
+Shares the cores of the machine between the ffmpeg processes of the program. Left alone, every ffmpeg sizes its
+thread pools on the number of CPUs, so a few conversions running at the same time oversubscribe the machine badly.
+A CoreScheduler owns a budget of cores, admits jobs when there are cores left for them, tells each one how many
+threads it may use, and hands the cores of finished jobs to the ones waiting.
+"""
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class CoreAllocation(object):
+    """
+    Cores granted to a job by a CoreScheduler. Releasing the allocation, or leaving it as a context manager, gives
+    the cores back.
+    """
+
+    def __init__(self, scheduler, threads: int):
+        self.scheduler = scheduler
+        self.threads = threads
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return f'<CoreAllocation threads={self.threads}, released={self.released}>'
+
+
+class CoreScheduler(object):
+    """
+    Process-wide core budget. The budget is split evenly between slots jobs, or between the jobs running and waiting
+    if there are more, and a job is admitted once at least min_threads cores are free. Jobs waiting are admitted in
+    the order they asked, and their share is recomputed every time a job finishes.
+    A running ffmpeg cannot change its thread count, so rebalancing only applies to the jobs that start afterwards.
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, budget=0, slots=1):
+        """
+        :param budget: number of cores to share, 0 for every CPU of the machine
+        :param slots: number of jobs expected to run at the same time
+        """
+        self.budget = budget or os.cpu_count() or 1
+        self.slots = max(slots, 1)
+        self._allocations = set()
+        self._waiting = []
+        self._condition = threading.Condition()
+
+    @classmethod
+    def shared(cls, budget=0, slots=1):
+        """Returns a process-wide instance for these settings, so that every job draws from the same budget."""
+        key = (budget, slots)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(budget, slots=slots)
+            return cls._shared[key]
+
+    @property
+    def used(self) -> int:
+        with self._condition:
+            return sum(a.threads for a in self._allocations)
+
+    @property
+    def free(self) -> int:
+        return self.budget - self.used
+
+    @property
+    def running(self) -> int:
+        with self._condition:
+            return len(self._allocations)
+
+    def share(self) -> int:
+        """Cores a job would be given right now, if it asked for as many as possible."""
+        with self._condition:
+            return self._share()
+
+    def _share(self) -> int:
+        jobs = max(self.slots, len(self._allocations) + max(len(self._waiting), 1))
+        return max(self.budget // jobs, 1)
+
+    def acquire(self, want=None, min_threads=1, timeout=None) -> CoreAllocation:
+        """
+        Waits until the job can be admitted and allocates its cores.
+        :param want: maximum number of threads the job can use, None for its fair share of the budget
+        :param min_threads: number of free cores the job needs to start, capped to the budget
+        :param timeout: seconds to wait for cores, None to wait forever
+        :return: a CoreAllocation, None if there were still not enough free cores after timeout seconds
+        """
+        min_threads = min(max(min_threads, 1), self.budget)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    free = self.budget - sum(a.threads for a in self._allocations)
+                    if self._waiting[0] is ticket and free >= min_threads:
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+
+                threads = max(min(free, self._share(), want or self.budget), min_threads)
+                allocation = CoreAllocation(self, threads)
+                self._allocations.add(allocation)
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+        log.debug('Allocated %d of %d cores, %d job(s) running', threads, self.budget, len(self._allocations))
+        return allocation
+
+    def release(self, allocation: CoreAllocation):
+        with self._condition:
+            self._allocations.discard(allocation)
+            self._condition.notify_all()
+        log.debug('Released %d cores', allocation.threads)
@@ -18,6 +18,8 @@ class Stream(ABC):
         self._options = Options(unique=True)
         self.stream_format = None
         self.supported_options = []
+        # Frames per second of a video stream, samples per second of an audio stream, as ffprobe reports them
+        self.rate = None
         self._uid = uuid.uuid4()
 
     @property
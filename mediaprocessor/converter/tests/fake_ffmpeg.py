@@ -0,0 +1,139 @@
+"""
+Stand-in for the ffmpeg and ffprobe binaries, used by the tests. install() writes small ffmpeg and ffprobe wrappers
+into a directory, both of which run this file. Behaviour of a conversion is controlled through environment variables:
+FAKE_FFMPEG_STEPS (number of progress reports), FAKE_FFMPEG_DELAY (seconds between reports), FAKE_FFMPEG_SPEED
+(reported speed), FAKE_FFMPEG_EXIT (exit code), FAKE_FFMPEG_FAIL_ONCE (path of a marker file: the first conversion
+whose output matches FAKE_FFMPEG_FAIL_MATCH fails and creates it) and FAKE_FFMPEG_LOG (file every command line is
+appended to, as json).
+"""
+import json
+import os
+import stat
+import sys
+import threading
+import time
+
+ENCODERS = """Encoders:
+ V..... = Video
+ A..... = Audio
+ S..... = Subtitle
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+ V....D libx265              libx265 H.265 / HEVC (codec hevc)
+ A....D aac                  AAC (Advanced Audio Coding)
+ A....D ac3                  ATSC A/52A (AC-3)
+ S..... mov_text             3GPP Timed Text subtitle
+ S..... ass                  ASS (Advanced SubStation Alpha) subtitle
+"""
+
+MUXERS = """File formats:
+ D. = Demuxing supported
+ .E = Muxing supported
+ --
+  E mp4             MP4 (MPEG-4 Part 14)
+  E matroska        Matroska
+  E tee             Multiple muxer tee
+"""
+
+DURATION = 10.0
+KEYFRAME_INTERVAL = 2.0
+
+
+def install(directory: str):
+    """Writes ffmpeg and ffprobe wrappers in directory and returns their paths."""
+    paths = []
+    for name in ['ffmpeg', 'ffprobe']:
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {name} "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        paths.append(path)
+    return paths
+
+
+def ffprobe(args):
+    fname = args[-1]
+    if '-show_entries' in args:
+        # Packet listing, a keyframe every KEYFRAME_INTERVAL seconds at 24 fps
+        for frame in range(int(DURATION * 24)):
+            pts = frame / 24
+            print(f'{pts:.6f},{"K_" if pts % KEYFRAME_INTERVAL == 0 else "__"}')
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'output.json')) as f:
+        output = json.load(f)
+    output['format']['filename'] = fname
+    output['format']['duration'] = str(DURATION)
+    print(json.dumps(output))
+
+
+def ffmpeg(args):
+    for query, output in [('-encoders', ENCODERS), ('-decoders', ENCODERS), ('-muxers', MUXERS),
+                          ('-hwaccels', 'Hardware acceleration methods:\n'), ('-filters', 'Filters:\n')]:
+        if query in args:
+            print(output)
+            return 0
+
+    if os.getenv('FAKE_FFMPEG_LOG'):
+        with open(os.getenv('FAKE_FFMPEG_LOG'), 'a') as f:
+            f.write(json.dumps(args) + '\n')
+
+    steps = int(os.getenv('FAKE_FFMPEG_STEPS', '5'))
+    delay = float(os.getenv('FAKE_FFMPEG_DELAY', '0'))
+    code = int(os.getenv('FAKE_FFMPEG_EXIT', '0'))
+    speed = os.getenv('FAKE_FFMPEG_SPEED', '2.0')
+
+    progress = sys.stdout if 'pipe:1' in args else None
+    sys.stderr.write('ffmpeg version fake\n')
+    sys.stderr.write(f"Input #0, matroska,webm, from '{args[args.index('-i') + 1]}':\n")
+    sys.stderr.write('  Duration: 00:00:10.00, start: 0.000000, bitrate: 2052 kb/s\n')
+    sys.stderr.write('Stream mapping:\n')
+    sys.stderr.flush()
+
+    output = args[-1]
+    if args[args.index('-i') - 1] == 'concat':
+        with open(args[args.index('-i') + 1]) as f:
+            for line in f:
+                chunk = line.strip()[len("file '"):-1].replace("'\\''", "'")
+                if not os.path.exists(chunk):
+                    sys.stderr.write(f'{chunk}: No such file or directory\n')
+                    return 1
+
+    marker = os.getenv('FAKE_FFMPEG_FAIL_ONCE')
+    if marker and not os.path.exists(marker) and os.getenv('FAKE_FFMPEG_FAIL_MATCH', '') in output:
+        open(marker, 'w').close()
+        sys.stderr.write('Error while decoding stream #0:0\n')
+        return 1
+
+    with open(output, 'wb') as f:
+        f.write(b'\0' * 1024)
+
+    # Like ffmpeg, quit when q is received on stdin
+    def wait_for_quit():
+        if sys.stdin.read(1) == 'q':
+            sys.stderr.write('[q] command received. Exiting.\n')
+            os._exit(0)
+
+    threading.Thread(target=wait_for_quit, daemon=True).start()
+
+    for i in range(1, steps + 1):
+        time.sleep(delay)
+        if progress:
+            out_time = int(DURATION * 1000000 * i / steps)
+            progress.write(f'frame={i * 24}\nfps=24.0\nbitrate=2000.0kbits/s\ntotal_size={i * 1024}\n'
+                           f'out_time_us={out_time}\nout_time_ms={out_time}\nspeed={speed}x\n'
+                           f'progress={"end" if i == steps else "continue"}\n')
+            progress.flush()
+
+    if code:
+        sys.stderr.write(f'Error while processing the decoded data for stream #0:0\n')
+    return code
+
+
+if __name__ == '__main__':
+    program, arguments = sys.argv[1], sys.argv[2:]
+    if program == 'ffprobe':
+        ffprobe(arguments)
+        sys.exit(0)
+    sys.exit(ffmpeg(arguments))
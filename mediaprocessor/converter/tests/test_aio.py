@@ -0,0 +1,126 @@
+import asyncio
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+from mediaprocessor.converter.aio import AsyncFFMpeg, iterate_in_thread
+from mediaprocessor.converter.ffmpeg import FFMpegCancelledError, FFMpegConvertError, FFMpegStallError
+from mediaprocessor.converter.tests.test_ffmpeg import FFMpegTestCase
+
+
+class TestAsyncFFMpeg(FFMpegTestCase):
+    def setUp(self):
+        super(TestAsyncFFMpeg, self).setUp()
+        self.affmpeg = AsyncFFMpeg(self.ffmpeg)
+
+    async def collect(self, events):
+        return [event async for event in events]
+
+    def test_probe(self):
+        parser = asyncio.run(self.affmpeg.probe(self.infile))
+        self.assertEqual(parser.container_format, self.ffmpeg.probe(self.infile).container_format)
+        self.assertEqual(len(parser.streams), len(self.ffmpeg.probe(self.infile).streams))
+
+    def test_progress(self):
+        events = asyncio.run(self.collect(self.affmpeg.convert2(self.command())))
+        progress = [event.fraction for event in events]
+        self.assertEqual(len(progress), 5)
+        self.assertEqual(progress[-1], 1.0)
+        self.assertTrue(events[-1].finished)
+        self.assertTrue(os.path.exists(self.outfile))
+
+    def test_error(self):
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_EXIT': '1'}):
+            with self.assertRaises(FFMpegConvertError) as e:
+                asyncio.run(self.collect(self.affmpeg.convert2(self.command())))
+        self.assertIn('Error while', e.exception.details)
+
+    def test_stall(self):
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '5', 'FAKE_FFMPEG_STEPS': '3'}):
+            with self.assertRaises(FFMpegStallError):
+                asyncio.run(self.collect(self.affmpeg.convert2(self.command(), timeout=0.5)))
+
+    def test_cancel(self):
+        async def cancelled():
+            job = await self.affmpeg.start(self.command())
+            events = []
+            async for event in job:
+                events.append(event)
+                asyncio.ensure_future(job.cancel())
+            return events
+
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '1', 'FAKE_FFMPEG_STEPS': '30'}):
+            with self.assertRaises(FFMpegCancelledError):
+                asyncio.run(cancelled())
+        self.assertFalse(os.path.exists(self.outfile))
+
+    def test_task_cancelled(self):
+        # Several conversions on one loop, the one whose task is cancelled is stopped and cleaned up
+        async def convert(events):
+            async for event in events:
+                events_seen.append(event)
+
+        async def main():
+            with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '0.5', 'FAKE_FFMPEG_STEPS': '30'}):
+                jobs = [await self.affmpeg.start(self.command()), await self.affmpeg.start(self.command())]
+            tasks = [asyncio.ensure_future(convert(job)) for job in jobs]
+            await asyncio.sleep(1)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return jobs
+
+        events_seen = []
+        jobs = asyncio.run(main())
+        self.assertTrue(events_seen)
+        self.assertFalse(any(job.running for job in jobs))
+        self.assertFalse(os.path.exists(self.outfile))
+
+    def test_iterate_in_thread(self):
+        async def main():
+            return [i async for i in iterate_in_thread(iter(range(5)))]
+        self.assertEqual(asyncio.run(main()), list(range(5)))
+
+    def test_iterate_in_thread_cancelled(self):
+        # The task is cancelled while next runs in the executor: the job is cancelled, then the generator closed
+        class Job(object):
+            def __init__(self):
+                self.stop = threading.Event()
+                self.closed = False
+                self.events = self._run()
+
+            def __iter__(self):
+                return self.events
+
+            def cancel(self, graceful=True):
+                self.stop.set()
+
+            def _run(self):
+                try:
+                    yield 0
+                    self.stop.wait(10)
+                    yield 1
+                finally:
+                    self.closed = True
+
+        async def main(job):
+            task = asyncio.ensure_future(consume(job))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        async def consume(job):
+            async for _ in iterate_in_thread(job):
+                pass
+
+        job = Job()
+        started = time.monotonic()
+        asyncio.run(main(job))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertTrue(job.stop.is_set())
+        self.assertTrue(job.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
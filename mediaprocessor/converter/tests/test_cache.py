@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from mediaprocessor.converter.cache import Capabilities, CapabilityCache, ProbeCache
+
+ENCODERS = """Encoders:
+ V..... = Video
+ A..... = Audio
+ S..... = Subtitle
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+ A....D aac                  AAC (Advanced Audio Coding)
+ S..... mov_text             3GPP Timed Text subtitle
+"""
+
+MUXERS = """File formats:
+ D. = Demuxing supported
+ .E = Muxing supported
+ --
+  E 3g2             3GP2 (3GPP2 file format)
+ D  aa              Audible AA format files
+ DE matroska,webm   Matroska / WebM
+"""
+
+FILTERS = """Filters:
+  T.. = Timeline support
+  A = Audio input/output
+  | = Source or sink filter
+ ... abench            A->A       Benchmark part of a filtergraph.
+ TSC scale             V->V       Scale the input video size and/or convert the image format.
+"""
+
+HWACCELS = """Hardware acceleration methods:
+vdpau
+cuda
+
+"""
+
+
+class TestCapabilities(unittest.TestCase):
+    def test_parsers(self):
+        self.assertEqual(Capabilities.parse_codecs(ENCODERS), ['libx264', 'aac', 'mov_text'])
+        self.assertEqual(Capabilities.parse_muxers(MUXERS), ['3g2', 'matroska', 'webm'])
+        self.assertEqual(Capabilities.parse_filters(FILTERS), ['abench', 'scale'])
+        self.assertEqual(Capabilities.parse_hwaccels(HWACCELS), ['vdpau', 'cuda'])
+
+
+class TestCapabilityCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.binary = os.path.join(self.tmp.name, 'ffmpeg')
+        with open(self.binary, 'w') as f:
+            f.write('#!/bin/sh\n')
+        CapabilityCache.clear_memory()
+
+    def tearDown(self):
+        CapabilityCache.clear_memory()
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        cache = CapabilityCache(self.tmp.name)
+        self.assertIsNone(cache.get(self.binary))
+        cache.put(self.binary, Capabilities(encoders=['libx264'], muxers=['mp4']))
+
+        # A fresh process only has the on-disk copy
+        CapabilityCache.clear_memory()
+        capabilities = CapabilityCache(self.tmp.name).get(self.binary)
+        self.assertIn('libx264', capabilities.encoders)
+        self.assertIn('mp4', capabilities.muxers)
+
+    def test_binary_change_invalidates(self):
+        cache = CapabilityCache(self.tmp.name)
+        cache.put(self.binary, Capabilities(encoders=['libx264']))
+        with open(self.binary, 'a') as f:
+            f.write('# upgraded\n')
+        self.assertIsNone(cache.get(self.binary))
+
+
+class TestProbeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.media = []
+        for i in range(3):
+            path = os.path.join(self.tmp.name, f'{i}.mkv')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(1024))
+            self.media.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hit_and_miss(self):
+        cache = ProbeCache(self.tmp.name, content_hash=True)
+        self.assertIsNone(cache.get(self.media[0]))
+        cache.put(self.media[0], '{"streams": [], "format": {}}')
+        self.assertEqual(cache.get(self.media[0]), '{"streams": [], "format": {}}')
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 1})
+
+    def test_invalidation(self):
+        cache = ProbeCache(self.tmp.name)
+        cache.put(self.media[0], '{}')
+        with open(self.media[0], 'ab') as f:
+            f.write(b'more')
+        self.assertIsNone(cache.get(self.media[0]))
+
+    def test_changed_while_probed(self):
+        # A probe of the previous version of the file is not stored
+        cache = ProbeCache(self.tmp.name)
+        st = os.stat(self.media[0])
+        with open(self.media[0], 'ab') as f:
+            f.write(b'more')
+        cache.put(self.media[0], '{}', st)
+        self.assertIsNone(cache.get(self.media[0]))
+        cache.put(self.media[0], '{}', os.stat(self.media[0]))
+        self.assertEqual(cache.get(self.media[0]), '{}')
+
+    def test_lru_eviction(self):
+        cache = ProbeCache(self.tmp.name, max_entries=2)
+        cache.put(self.media[0], '0')
+        cache.put(self.media[1], '1')
+        cache.get(self.media[0])
+        cache.put(self.media[2], '2')
+        self.assertEqual(cache.get(self.media[0]), '0')
+        self.assertIsNone(cache.get(self.media[1]))
+        self.assertEqual(cache.get(self.media[2]), '2')
+
+
+if __name__ == '__main__':
+    unittest.main()
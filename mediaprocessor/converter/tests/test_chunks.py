@@ -0,0 +1,113 @@
+import json
+import os
+import time
+import unittest
+from unittest import mock
+from mediaprocessor.converter.chunks import ChunkedConversion, split_at_keyframes
+from mediaprocessor.converter.ffmpeg import FFMpegConvertError
+from mediaprocessor.converter.tests.test_ffmpeg import FFMpegTestCase
+
+
+class TestSplit(unittest.TestCase):
+    def test_split_at_keyframes(self):
+        keyframes = [0.5, 2.0, 4.0, 6.0, 8.0]
+        self.assertEqual(split_at_keyframes(keyframes, 10, 3), [(0.0, 4.0), (4.0, 6.0), (6.0, None)])
+        # Never more chunks than keyframes
+        self.assertEqual(split_at_keyframes([0.0, 5.0], 10, 8), [(0.0, 5.0), (5.0, None)])
+        self.assertEqual(split_at_keyframes([], 10, 3), [(0.0, None)])
+        # Keyframe timestamps of a container that does not start at 0 (MPEG-TS), the segments start at 0
+        keyframes = [2.0, 3.5, 5.5, 7.5, 9.5]
+        self.assertEqual(split_at_keyframes(keyframes, 10, 3, start_time=1.5),
+                         [(0.0, 4.0), (4.0, 6.0), (6.0, None)])
+
+
+class TestChunkedConversion(FFMpegTestCase):
+    def setUp(self):
+        super(TestChunkedConversion, self).setUp()
+        self.log = os.path.join(self.tmp.name, 'commands.log')
+
+        self.source_container = self.source()
+        self.target_container = self.target(self.source_container, 'mp4', self.outfile)
+        self.factory = self.encoder_factory()
+        self.segments = split_at_keyframes(self.ffmpeg.keyframes(self.infile), self.source_container.duration, 3)
+
+    def conversion(self, retries=1):
+        return ChunkedConversion(self.ffmpeg, self.source_container, self.target_container, [(0, 0), (2, 1)], self.factory,
+                                 self.segments, threads=2, retries=retries)
+
+    def commands(self):
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def leftovers(self):
+        return [f for f in os.listdir(self.tmp.name) if f.startswith('.chunks-')]
+
+    def test_encode(self):
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_LOG': self.log}):
+            events = list(self.conversion())
+
+        progress = [event.fraction for event in events]
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+        self.assertTrue(events[-1].finished)
+
+        commands = self.commands()
+        self.assertEqual(len(commands), 4)
+        chunks, concat = commands[:3], commands[3]
+        self.assertEqual(sorted(c[c.index('-ss') + 1] for c in chunks), ['0.000000', '4.000000', '6.000000'])
+        for c in chunks:
+            self.assertIn('libx265', c)
+            self.assertEqual(c[c.index('-threads') + 1], '2')
+            self.assertNotIn('0:2', c)
+        self.assertEqual(concat[concat.index('-i') - 4:concat.index('-i')], ['-f', 'concat', '-safe', '0'])
+        self.assertIn('1:2', concat)
+
+        self.assertTrue(os.path.exists(self.outfile))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_retry(self):
+        env = {'FAKE_FFMPEG_LOG': self.log,
+               'FAKE_FFMPEG_FAIL_ONCE': os.path.join(self.tmp.name, 'failed'),
+               'FAKE_FFMPEG_FAIL_MATCH': 'chunk0001'}
+        with mock.patch.dict(os.environ, env):
+            list(self.conversion(retries=1))
+        self.assertEqual(len(self.commands()), 5)
+        self.assertTrue(os.path.exists(self.outfile))
+
+    def test_failure(self):
+        env = {'FAKE_FFMPEG_FAIL_ONCE': os.path.join(self.tmp.name, 'failed'),
+               'FAKE_FFMPEG_FAIL_MATCH': 'chunk0001'}
+        with mock.patch.dict(os.environ, env):
+            with self.assertRaises(FFMpegConvertError):
+                list(self.conversion(retries=0))
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_failure_while_others_report(self):
+        # A failed chunk stops the conversion, without waiting for the other chunks, which keep reporting progress
+        env = {'FAKE_FFMPEG_FAIL_ONCE': os.path.join(self.tmp.name, 'failed'),
+               'FAKE_FFMPEG_FAIL_MATCH': 'chunk0001',
+               'FAKE_FFMPEG_DELAY': '0.05', 'FAKE_FFMPEG_STEPS': '200'}
+        started = time.monotonic()
+        with mock.patch.dict(os.environ, env):
+            with self.assertRaises(FFMpegConvertError):
+                list(self.conversion(retries=0))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_close(self):
+        # Closing the progress mid-encode stops the chunks without waiting for them to finish
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '0.05', 'FAKE_FFMPEG_STEPS': '200'}):
+            conversion = self.conversion()
+            events = iter(conversion)
+            next(events)
+            started = time.monotonic()
+            events.close()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertTrue(conversion.cancelled)
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertEqual(self.leftovers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import os
+import signal
+import tempfile
+import unittest
+from unittest import mock
+from mediaprocessor.converter.cache import CapabilityCache
+import threading
+from mediaprocessor.converter.containers import ContainerFactory, Container
+from mediaprocessor.converter.encoders import Encoders, EncoderFactory
+from mediaprocessor.converter.formats import FormatFactory
+from mediaprocessor.converter.options import Disposition, Options
+from mediaprocessor.converter.streams import VideoStream, AudioStream
+from mediaprocessor.converter.ffmpeg import FFMpeg, FFMpegCancelledError, FFMpegConvertError, FFMpegStallError
+from mediaprocessor.converter.jobs import JobRegistry
+from mediaprocessor.converter.progress import ProgressBroadcaster, ProgressEvent, ProgressParser
+from mediaprocessor.converter.watchdog import Watchdog
+from mediaprocessor.converter.tests import fake_ffmpeg
+
+
+class TestProgressParser(unittest.TestCase):
+    def test_split_blocks(self):
+        parser = ProgressParser()
+        data = b'frame=1\nout_time_us=500000\nprogress=continue\nframe=2\nout_time_us=1000000\nprogress=end\n'
+        blocks = []
+        # Feed byte by byte, ffmpeg gives no guarantee on how the pipe is chunked.
+        for i in range(len(data)):
+            blocks.extend(parser.feed(data[i:i + 1]))
+
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(blocks[0][b'frame'], b'1')
+        self.assertEqual(ProgressParser.out_time(blocks[1]), 1.0)
+        self.assertEqual(blocks[1][b'progress'], b'end')
+
+
+class TestProgressBroadcaster(unittest.TestCase):
+    def test_throttling(self):
+        broadcaster = ProgressBroadcaster(interval=3600)
+        received = []
+        broadcaster.subscribe(received.append)
+        unthrottled = []
+        broadcaster.subscribe(unthrottled.append, interval=0)
+
+        for i in range(10):
+            broadcaster.publish(ProgressEvent(fraction=i / 10))
+        broadcaster.publish(ProgressEvent(fraction=1.0, finished=True))
+
+        self.assertEqual([e.fraction for e in received], [0.0, 1.0])
+        self.assertEqual(len(unthrottled), 11)
+
+
+def get_token(buf, term) -> tuple:
+    """(token, rest of buf) like libavutil's av_get_token."""
+    out, end, p = '', 0, len(buf) - len(buf.lstrip(' \n\t\r'))
+    while p < len(buf) and buf[p] not in term:
+        c = buf[p]
+        p += 1
+        if c == '\\' and p < len(buf):
+            out += buf[p]
+            p += 1
+            end = len(out)
+        elif c == "'":
+            while p < len(buf) and buf[p] != "'":
+                out += buf[p]
+                p += 1
+            if p < len(buf):
+                p += 1
+                end = len(out)
+        else:
+            out += c
+    while len(out) > end and out[-1] in ' \n\t\r':
+        out = out[:-1]
+    return out, buf[p:]
+
+
+def parse_tee(arg) -> list:
+    """[(options, path)] of the outputs of a tee muxer argument, read the way libavformat's tee.c does."""
+    slaves = []
+    while arg:
+        slave, arg = get_token(arg, '|')
+        arg = arg[1:] if arg.startswith('|') else arg
+        options = {}
+        rest = slave[1:]
+        while True:
+            key, _, rest = rest.partition('=')
+            options[key], rest = get_token(rest, ':]')
+            closing, rest = rest[0], rest[1:]
+            if closing == ']':
+                break
+        slaves.append((options, rest))
+    return slaves
+
+
+class FFMpegTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {'MEDIAPROCESSOR_CACHE_DIR': self.tmp.name})
+        self.env.start()
+        CapabilityCache.clear_memory()
+        ffmpeg_path, ffprobe_path = fake_ffmpeg.install(self.tmp.name)
+        self.ffmpeg = FFMpeg(ffmpeg_path, ffprobe_path)
+        self.infile = os.path.join(self.tmp.name, 'input.mkv')
+        self.outfile = os.path.join(self.tmp.name, 'output.mp4')
+        with open(self.infile, 'wb') as f:
+            f.write(b'\0' * 1024)
+
+    def tearDown(self):
+        self.env.stop()
+        CapabilityCache.clear_memory()
+        self.tmp.cleanup()
+
+    def command(self):
+        return [self.ffmpeg.ffmpeg_path, '-i', self.infile, '-map', '0:0', '-c:v:0', 'copy', '-f', 'mp4',
+                '-y', self.outfile]
+
+    def source(self):
+        return ContainerFactory.container_from_parser(self.ffmpeg.probe(self.infile))
+
+    @staticmethod
+    def target(source, fmt, path, video='hevc'):
+        """A target with a video stream in the video format, and a copy of the second audio stream of source."""
+        target = Container(fmt, path)
+        target.add_stream(VideoStream(FormatFactory.get_format(video)))
+        audio = AudioStream(FormatFactory.get_format('ac3'))
+        audio.add_options(*source.streams[2].options)
+        target.add_stream(audio)
+        return target
+
+    def encoder_factory(self):
+        encoders = Encoders(self.ffmpeg)
+        return EncoderFactory(encoders, {c.codec_name: Options() for c in encoders.supported_codecs})
+
+
+class TestConvert(FFMpegTestCase):
+    def test_capabilities(self):
+        self.assertIn('libx264', self.ffmpeg.encoders)
+        self.assertIn('tee', self.ffmpeg.muxers)
+
+    def test_progress(self):
+        events = list(self.ffmpeg.convert2(self.command()))
+        progress = [event.fraction for event in events]
+        self.assertEqual(len(progress), 5)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+        self.assertTrue(events[-1].finished)
+        self.assertEqual(events[0].speed, 2.0)
+        self.assertEqual(events[0].bitrate, 2000.0)
+        self.assertEqual(events[0].total_size, 1024)
+        self.assertEqual(events[0].eta, 4.0)
+        self.assertTrue(os.path.exists(self.outfile))
+
+    def test_error(self):
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_EXIT': '1'}):
+            with self.assertRaises(FFMpegConvertError) as e:
+                list(self.ffmpeg.convert2(self.command()))
+        self.assertIn('Error while', e.exception.details)
+
+    def test_multiple_targets(self):
+        source = self.source()
+        mkv = os.path.join(self.tmp.name, 'output.mkv')
+        factory = self.encoder_factory()
+        targets = [(self.target(source, 'mp4', self.outfile), [(0, 0), (2, 1)], factory, None, None),
+                   (self.target(source, 'matroska', mkv), [(0, 0), (2, 1)], factory, None, None)]
+
+        # The video is encoded once and shared through tee
+        cmds = self.ffmpeg.generate_multi_commands(source, targets)
+        self.assertEqual(cmds.count('libx265'), 1)
+        self.assertEqual(cmds[-3:-1], ['tee', '-y'])
+        self.assertEqual(cmds[-1], f"[f=mp4:select=0,1]{self.outfile}|[f=matroska:select=0,1]{mkv}")
+
+        # Different encodes, one output per target
+        targets[1] = (self.target(source, 'matroska', mkv, video='h264'), [(0, 0), (2, 1)], factory, None, None)
+        cmds = self.ffmpeg.generate_multi_commands(source, targets)
+        self.assertNotIn('tee', cmds)
+        self.assertEqual(cmds.count('-i'), 1)
+        self.assertEqual([cmds[i + 1] for i, c in enumerate(cmds) if c == '-y'], [self.outfile, mkv])
+
+    def test_tee_escaping(self):
+        # The tee muxer reads the paths and the options back unchanged
+        source = self.source()
+        odd = self.target(source, 'mp4', os.path.join(self.tmp.name, "Ocean's [Eleven] | 2001\\.mp4 "))
+        odd.format_options.update({'movflags': '+faststart', 'brand': "it's:odd]"})
+        mkv = self.target(source, 'matroska', os.path.join(self.tmp.name, 'output.mkv'))
+        arg = FFMpeg.tee_slave(odd, [0, 2]) + '|' + FFMpeg.tee_slave(mkv, [1])
+        self.assertEqual(parse_tee(arg),
+                         [({'f': 'mp4', 'movflags': '+faststart', 'brand': "it's:odd]", 'select': '0,2'},
+                           odd.file_path),
+                          ({'f': 'matroska', 'select': '1'}, mkv.file_path)])
+
+    def test_disposition_copied(self):
+        # Fixing the dispositions of a target leaves those of the source, and of any other target, alone
+        source = self.source()
+        target = self.target(source, 'mp4', self.outfile)
+        target.fix_disposition()
+        self.assertEqual(target.streams[1].options.get_unique_option(Disposition).value['default'], 1)
+        self.assertEqual(source.streams[2].options.get_unique_option(Disposition).value['default'], 0)
+
+
+    def test_threads(self):
+        source = self.source()
+        target = self.target(source, 'mp4', self.outfile)
+        cmds = self.ffmpeg.generate_commands(source, target, [(0, 0), (2, 1)], self.encoder_factory(), threads=3)
+        self.assertEqual(cmds[cmds.index('-threads'):cmds.index('-f')],
+                         ['-threads', '3', '-filter_threads', '3', '-x265-params', 'pools=3'])
+
+        cmds = self.ffmpeg.generate_commands(source, target, [(0, 0), (2, 1)], self.encoder_factory())
+        self.assertNotIn('-threads', cmds)
+
+    def test_tags(self):
+        source = self.source()
+        target = self.target(source, 'mp4', self.outfile)
+        cover = os.path.join(self.tmp.name, 'poster.jpg')
+        cmds = self.ffmpeg.generate_commands(source, target, [(0, 0), (2, 1)], self.encoder_factory(),
+                                             metadata={'title': 'Pilot', 'media_type': '10'}, cover=cover)
+        self.assertEqual(cmds[1:5], ['-i', self.infile, '-i', cover])
+        start = cmds.index('1:0') - 1
+        self.assertEqual(cmds[start:cmds.index('-f')],
+                         ['-map', '1:0', '-c:v:1', 'copy', '-disposition:v:1', 'attached_pic',
+                          '-metadata', 'title=Pilot', '-metadata', 'media_type=10'])
+
+    def test_faststart(self):
+        source = self.source()
+        target = self.target(source, 'mp4', self.outfile)
+        self.assertEqual(FFMpeg.faststart_options('off', target, 100), {})
+        self.assertEqual(FFMpeg.faststart_options('movflags', target, 100), {'movflags': '+faststart'})
+        self.assertEqual(FFMpeg.faststart_options('reserve', target, None), {'movflags': '+faststart'})
+        # One video and one audio stream for an hour, the tables of every sample in their own chunk
+        self.assertEqual(FFMpeg.faststart_options('reserve', target, 3600),
+                         {'moov_size': int(3600 * (60 * 44 + 50 * 32) * 1.1) + 262144})
+        rates = {0: source.streams[0].rate, 1: source.streams[2].rate}
+        self.assertEqual(rates, {0: 24000 / 1001, 1: 48000})
+        self.assertEqual(FFMpeg.faststart_options('reserve', target, 3600, rates),
+                         {'moov_size': int(3600 * (24000 / 1001 * 44 + 50 * 32) * 1.1) + 262144})
+
+        target.format_options.update(FFMpeg.faststart_options('movflags', target))
+        cmds = self.ffmpeg.generate_commands(source, target, [(0, 0), (2, 1)], self.encoder_factory())
+        self.assertEqual(cmds[cmds.index('-f'):], ['-f', 'mp4', '-movflags', '+faststart', '-y', self.outfile])
+
+        mkv = os.path.join(self.tmp.name, 'output.mkv')
+        factory = self.encoder_factory()
+        targets = [(target, [(0, 0), (2, 1)], factory, None, None),
+                   (self.target(source, 'matroska', mkv), [(0, 0), (2, 1)], factory, None, None)]
+        cmds = self.ffmpeg.generate_multi_commands(source, targets)
+        self.assertTrue(cmds[-1].startswith("[f=mp4:movflags=+faststart:select="))
+
+
+class TestWatchdog(FFMpegTestCase):
+    def test_stall(self):
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '0.2', 'FAKE_FFMPEG_STEPS': '3'}):
+            events = list(self.ffmpeg.convert2(self.command(), timeout=5))
+        self.assertEqual(len(events), 3)
+
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '5', 'FAKE_FFMPEG_STEPS': '3'}):
+            with self.assertRaises(FFMpegStallError) as e:
+                list(self.ffmpeg.convert2(self.command(), timeout=0.5))
+        self.assertIsNone(e.exception.last_progress)
+
+    def test_too_slow(self):
+        env = {'FAKE_FFMPEG_DELAY': '0.1', 'FAKE_FFMPEG_STEPS': '100', 'FAKE_FFMPEG_SPEED': '0.1'}
+        with mock.patch.dict(os.environ, env):
+            with self.assertRaises(FFMpegStallError) as e:
+                list(self.ffmpeg.convert2(self.command(), min_speed=0.5, min_speed_window=0.5))
+        self.assertEqual(e.exception.last_progress.speed, 0.1)
+
+    def test_join(self):
+        # The Thread methods still work once the watchdog has stopped
+        process = mock.Mock(**{'poll.return_value': None})
+        watchdog = Watchdog(process, stall_timeout=60)
+        watchdog.start()
+        watchdog.stop()
+        watchdog.join(5)
+        self.assertFalse(watchdog.is_alive())
+        self.assertFalse(watchdog.tripped)
+
+
+class TestCancel(FFMpegTestCase):
+    def run_cancelled(self, graceful):
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '1', 'FAKE_FFMPEG_STEPS': '30'}):
+            job = self.ffmpeg.start(self.command())
+        self.assertIn(job, JobRegistry.default().jobs)
+
+        events = []
+        with self.assertRaises(FFMpegCancelledError):
+            for event in job:
+                events.append(event)
+                threading.Thread(target=job.cancel, args=(graceful,)).start()
+
+        self.assertEqual(len(events), 1)
+        self.assertFalse(job.running)
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertNotIn(job, JobRegistry.default().jobs)
+
+    def test_graceful(self):
+        self.run_cancelled(graceful=True)
+
+    def test_kill(self):
+        self.run_cancelled(graceful=False)
+
+    def test_cancel_finished(self):
+        job = self.ffmpeg.start(self.command())
+        list(job)
+        self.assertTrue(job.cancel())
+        self.assertTrue(os.path.exists(self.outfile))
+
+    def test_signal_while_registering(self):
+        # The signal handler runs on the main thread, which may be holding the registry's lock
+        registry = JobRegistry()
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_DELAY': '1', 'FAKE_FFMPEG_STEPS': '30'}):
+            job = self.ffmpeg.start(self.command())
+        registry.register(job)
+        previous = mock.Mock()
+        registry._previous_handlers[signal.SIGTERM] = previous
+        with registry._lock:
+            registry._on_signal(signal.SIGTERM, None)
+        previous.assert_called_once_with(signal.SIGTERM, None)
+        self.assertFalse(job.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -79,6 +79,33 @@ class TestOptions(unittest.TestCase):
 
         self.assertEqual(o1, o2)
 
+    def test_lookups(self):
+        # A replaced option goes to the end, the others keep their order
+        o = Options(unique=True)
+        o.add_option(PixFmt('yuv420p'))
+        o.add_option(Height(800))
+        o.add_option(Width(1920))
+        o.add_option(PixFmt('yuv420p10le'))
+        o.add_option(Bitrate(None))
+        self.assertEqual([str(opt) for opt in o], ['Height: 800', 'Width: 1920', 'PixFmt: yuv420p10le'])
+        self.assertEqual(o.get_unique_option(PixFmt), PixFmt('yuv420p10le'))
+        self.assertEqual(o.get_option_by_name('HEIGHT'), Height(800))
+        self.assertIsNone(o.get_unique_option(Bitrate))
+        self.assertIsNone(o.get_option_by_name('bitrate'))
+        self.assertTrue(o.has_option(Width) and o.has_option(Width(1280)))
+        self.assertFalse(o.has_option(Bitrate))
+
+        # Without unique, options of the same class are all kept, in the order they were added
+        o = Options()
+        o.add_option(Height(1500))
+        o.add_option(PixFmt('yuv420p'))
+        o.add_option(Height(800))
+        self.assertEqual(o.options, [Height(1500), PixFmt('yuv420p'), Height(800)])
+        self.assertEqual(list(o.get_option(Height)), [Height(1500), Height(800)])
+        self.assertEqual(o.get_unique_option(Height), Height(1500))
+        self.assertEqual(o.get_option_by_name('height'), Height(1500))
+        self.assertEqual(list(o.get_option(Width)), [])
+
     def test_subset(self):
         pass
 
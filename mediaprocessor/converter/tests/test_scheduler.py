@@ -0,0 +1,47 @@
+import threading
+import unittest
+from mediaprocessor.converter.scheduler import CoreScheduler
+
+
+class TestCoreScheduler(unittest.TestCase):
+    def test_shares(self):
+        scheduler = CoreScheduler(budget=8, slots=2)
+        first = scheduler.acquire()
+        second = scheduler.acquire(want=2)
+        self.assertEqual(first.threads, 4)
+        self.assertEqual(second.threads, 2)
+        self.assertEqual(scheduler.free, 2)
+
+        second.release()
+        # Never more than the budget
+        third = scheduler.acquire(want=16)
+        self.assertEqual(third.threads, 4)
+        self.assertEqual(scheduler.free, 0)
+
+    def test_admission(self):
+        scheduler = CoreScheduler(budget=4, slots=1)
+        first = scheduler.acquire()
+        self.assertEqual(first.threads, 4)
+        self.assertIsNone(scheduler.acquire(timeout=0.1))
+
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(scheduler.acquire(min_threads=2)))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertEqual(admitted, [])
+
+        # The cores of a finished job go to the one waiting
+        first.release()
+        waiter.join(5)
+        self.assertEqual(admitted[0].threads, 4)
+
+    def test_context_manager(self):
+        scheduler = CoreScheduler(budget=2)
+        with scheduler.acquire() as allocation:
+            self.assertEqual(scheduler.running, 1)
+        self.assertTrue(allocation.released)
+        self.assertEqual(scheduler.free, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
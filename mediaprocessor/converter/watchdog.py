@@ -0,0 +1,98 @@
+"""
+Module converter.watchdog.py
+Watches a running ffmpeg process from a separate thread and stops it when it stalls. Unlike SIGALRM, this works
+whichever thread the conversion runs in.
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Watchdog(threading.Thread):
+    """
+    Stops a process if it reports no progress for stall_timeout seconds, or if its speed stays below min_speed for
+    min_speed_window seconds. The process is sent SIGTERM first, and SIGKILL if it is still alive grace seconds later.
+    The reader of the process feeds the watchdog with notify(), and checks tripped once the process has exited.
+    """
+
+    def __init__(self, process, stall_timeout=None, min_speed=None, min_speed_window=60, grace=10):
+        """
+        :param process: the subprocess.Popen to watch
+        :param stall_timeout: seconds without progress after which the process is stopped, None to disable
+        :param min_speed: speed, as a multiple of real time, under which the process is considered stalled
+        :param min_speed_window: seconds the speed has to stay under min_speed before the process is stopped
+        :param grace: seconds between SIGTERM and SIGKILL
+        """
+        super(Watchdog, self).__init__(daemon=True)
+        self.process = process
+        self.stall_timeout = stall_timeout
+        self.min_speed = min_speed
+        self.min_speed_window = min_speed_window
+        self.grace = grace
+
+        self.reason = None
+        self.last_progress = None
+        self._last_time = time.monotonic()
+        self._slow_since = None
+        self._halt = threading.Event()
+
+        periods = [p for p in [stall_timeout, min_speed_window if min_speed else None] if p]
+        self._poll = min([1.0] + [p / 4 for p in periods])
+
+    @property
+    def tripped(self) -> bool:
+        return self.reason is not None
+
+    def notify(self, event):
+        """
+        Records a ProgressEvent of the watched process.
+        :type event: mediaprocessor.converter.progress.ProgressEvent
+        """
+        now = time.monotonic()
+        self.last_progress = event
+        self._last_time = now
+        if self.min_speed and event.speed is not None and event.speed < self.min_speed:
+            if self._slow_since is None:
+                self._slow_since = now
+        else:
+            self._slow_since = None
+
+    def stop(self):
+        """Stops watching, to be called once the process has exited."""
+        self._halt.set()
+
+    def run(self):
+        while not self._halt.wait(self._poll):
+            if self.process.poll() is not None:
+                return
+
+            reason = self.check()
+            if reason:
+                self.trip(reason)
+                return
+
+    def check(self):
+        """Returns why the process should be stopped, None if it is doing fine."""
+        now = time.monotonic()
+        if self.stall_timeout and now - self._last_time > self.stall_timeout:
+            return f'No progress for {self.stall_timeout} seconds'
+        if self._slow_since is not None and now - self._slow_since > self.min_speed_window:
+            return f'Speed below {self.min_speed}x for {self.min_speed_window} seconds'
+        return None
+
+    def trip(self, reason):
+        self.reason = reason
+        log.error('Stopping ffmpeg (pid %s): %s', self.process.pid, reason)
+        try:
+            self.process.terminate()
+            deadline = time.monotonic() + self.grace
+            while self.process.poll() is None and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                log.error('ffmpeg (pid %s) did not terminate, killing it', self.process.pid)
+                self.process.kill()
+        except OSError:
+            # Already gone
+            pass
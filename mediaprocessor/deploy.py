@@ -0,0 +1,175 @@
+"""
+Module deploy.py
+Copies and moves the converted files to their destinations with the cheapest primitive the filesystems allow: a
+hardlink when both ends are on the same filesystem and sharing the inode is acceptable, a reflink (FICLONE) on
+filesystems that share extents (btrfs, xfs with reflink=1...), copy_file_range, which copies in the kernel, and a
+plain streaming copy as the last resort. Moves are renames, or a copy and a delete across devices.
+Destinations are written under a hidden name in their directory, then renamed, so that a partial file is never seen
+under the final name.
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+STREAM = 'stream'
+RENAME = 'rename'
+
+# ioctl(FICLONE), see linux/fs.h
+_FICLONE = 0x40049409
+# Bytes per copy_file_range call, and buffer of the streaming copy
+_RANGE_CHUNK = 1 << 28
+_STREAM_CHUNK = 1 << 23
+
+# What the filesystems answer when they do not support a primitive
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK,
+                errno.EBADF)
+
+
+class DeployError(Exception):
+    pass
+
+
+def _temporary(dst) -> str:
+    directory, name = os.path.split(dst)
+    return os.path.join(directory, '.' + name + '.deploying')
+
+
+def _reflink(src, dst) -> bool:
+    try:
+        fcntl.ioctl(dst, _FICLONE, src)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        return False
+    return True
+
+
+def _copy_range(src, dst, size) -> int:
+    """
+    Copies src to dst with copy_file_range, returns the bytes copied, which are fewer than size if the kernel
+    refused to copy between those files.
+    """
+    copied = 0
+    if not hasattr(os, 'copy_file_range'):
+        return 0
+    while copied < size:
+        try:
+            n = os.copy_file_range(src, dst, min(size - copied, _RANGE_CHUNK), copied, copied)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            break
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _stream(src, dst, offset, size) -> int:
+    """
+    Copies src to dst from offset on through a buffer. The source is read ahead, and the pages already copied are
+    dropped from the page cache, so that copying a large file does not evict everything else.
+    """
+    advise = hasattr(os, 'posix_fadvise')
+    if advise:
+        os.posix_fadvise(src, offset, 0, os.POSIX_FADV_SEQUENTIAL)
+    buffer = bytearray(_STREAM_CHUNK)
+    view = memoryview(buffer)
+    position = offset
+    while True:
+        n = os.preadv(src, [buffer], position) if hasattr(os, 'preadv') else _pread_into(src, buffer, position)
+        if n == 0:
+            break
+        written = 0
+        while written < n:
+            written += os.pwrite(dst, view[written:n], position + written)
+        if advise:
+            os.posix_fadvise(src, position, n, os.POSIX_FADV_DONTNEED)
+        position += n
+    if advise and position > offset:
+        os.fdatasync(dst)
+        os.posix_fadvise(dst, offset, position - offset, os.POSIX_FADV_DONTNEED)
+    if position < size:
+        raise DeployError(f'Unexpected end of file after {position} bytes of {size}')
+    return position - offset
+
+
+def _pread_into(src, buffer, position) -> int:
+    data = os.pread(src, len(buffer), position)
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def _copy_data(src_path, dst_path) -> tuple:
+    """Copies the content of src_path to a new dst_path, returns (primitive, bytes copied)."""
+    with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+        src, dst = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(src).st_size
+        if _reflink(src, dst):
+            return REFLINK, 0
+
+        copied = _copy_range(src, dst, size)
+        if copied and copied >= size:
+            return COPY_FILE_RANGE, copied
+        return (COPY_FILE_RANGE if copied else STREAM), copied + _stream(src, dst, copied, size)
+
+
+def copy_file(src, dst, hardlink=False) -> dict:
+    """
+    Copies a file with its permissions and times, like shutil.copy2, with the cheapest primitive available.
+    :param src: path of the file to copy
+    :param dst: path of the copy, replaced if it exists
+    :param hardlink: whether the copy can be a hardlink, the two paths then share their inode: a change to one is
+    seen in the other
+    :return: dict with the primitive used and the bytes copied through the page cache, 0 for hardlinks and reflinks
+    """
+    tmp = _temporary(dst)
+    if hardlink:
+        try:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.link(src, tmp)
+            os.replace(tmp, dst)
+            log.debug('Hardlinked %s to %s', src, dst)
+            return {'primitive': HARDLINK, 'bytes': 0}
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    try:
+        primitive, copied = _copy_data(src, tmp)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    log.debug('Copied %s to %s with %s, %d bytes', src, dst, primitive, copied)
+    return {'primitive': primitive, 'bytes': copied}
+
+
+def move_file(src, dst) -> dict:
+    """
+    Moves a file, by renaming it, or by copying it with copy_file and deleting the source if dst is on another
+    filesystem.
+    :return: dict with the primitive used and the bytes copied, see copy_file
+    """
+    try:
+        os.replace(src, dst)
+        return {'primitive': RENAME, 'bytes': 0}
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    result = copy_file(src, dst)
+    os.remove(src)
+    return result
@@ -0,0 +1,182 @@
+"""
+Module jobqueue.py
+Files waiting to be processed, and how far the processing of each one went, kept in SQLite so that a program that
+stops, or crashes, picks its work up again when it restarts. Files the program wrote itself are remembered too, so
+that they are not mistaken for new input.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class JobQueue(object):
+    """
+    Persistent FIFO of files to process. A file is pending until a worker takes it, running while it is processed,
+    then done or failed. Files seen again with the same size and mtime are not queued twice.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    OUTPUT = 'output'
+
+    def __init__(self, path):
+        """
+        :param path: path to the SQLite database, created if needed
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'path TEXT PRIMARY KEY, status TEXT, size INTEGER, mtime_ns INTEGER, '
+                         'added REAL, updated REAL, error TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, added)')
+
+    def add(self, path: str) -> bool:
+        """
+        Queues path, unless it is an output of the program or was already queued in the same state.
+        :return: True if the file was queued
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT status, size, mtime_ns FROM jobs WHERE path=?', (path,)).fetchone()
+            if row is not None:
+                status, size, mtime_ns = row
+                if status == self.OUTPUT or (size, mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    return False
+            self._db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                             (path, self.PENDING, st.st_size, st.st_mtime_ns, now, now))
+        log.info('Queued %s', path)
+        return True
+
+    def take(self, limit=1) -> list:
+        """Marks up to limit pending files as running and returns them, oldest first."""
+        with self._lock:
+            paths = [r[0] for r in self._db.execute('SELECT path FROM jobs WHERE status=? ORDER BY added LIMIT ?',
+                                                     (self.PENDING, limit))]
+            self._db.executemany('UPDATE jobs SET status=?, updated=? WHERE path=?',
+                                 [(self.RUNNING, time.time(), p) for p in paths])
+        return paths
+
+    def finish(self, path: str, ok=True, error=None):
+        with self._lock:
+            self._db.execute('UPDATE jobs SET status=?, updated=?, error=? WHERE path=?',
+                             (self.DONE if ok else self.FAILED, time.time(), error, path))
+
+    def mark_output(self, path: str):
+        """Remembers path as written by the program, it will never be queued."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, NULL, NULL, ?, ?, NULL)',
+                             (path, self.OUTPUT, time.time(), time.time()))
+
+    def recover(self) -> int:
+        """Puts the files that were running when the program stopped back in the queue, returns how many."""
+        with self._lock:
+            cursor = self._db.execute('UPDATE jobs SET status=?, updated=? WHERE status=?',
+                                      (self.PENDING, time.time(), self.RUNNING))
+            return cursor.rowcount
+
+    def status(self, path: str):
+        with self._lock:
+            row = self._db.execute('SELECT status FROM jobs WHERE path=?', (path,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM jobs WHERE status=?', (self.PENDING,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Journal(object):
+    """
+    Where each file got to in the VideoProcessor state machine, kept in SQLite so that a crash does not throw away
+    hours of encoding. Every state reached is saved together with the plan of the conversion and the working files
+    (with their sizes), so that a restart can check them and carry on from the last completed state. Files that
+    reached the end of the machine are forgotten.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the SQLite database, created if needed, it may be shared with a JobQueue
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS journal ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, targets TEXT, state TEXT, '
+                         'plan TEXT, work_files TEXT, updated REAL)')
+
+    def save(self, path: str, state: str, targets: list, plan, work_files: dict):
+        """
+        Records that path reached state.
+        :param plan: anything json can store describing the conversion, a different plan means a different output
+        :param work_files: working files by target, their sizes are recorded along
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Deleted, there is nothing to resume anymore
+            self.forget(path)
+            return
+
+        files = {}
+        for target, work_file in work_files.items():
+            try:
+                files[target] = [work_file, os.path.getsize(work_file)]
+            except OSError:
+                files[target] = [work_file, None]
+
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (path, st.st_size, st.st_mtime_ns, json.dumps(targets), state, json.dumps(plan),
+                              json.dumps(files), time.time()))
+
+    def load(self, path: str, targets: list):
+        """
+        Returns the last state saved for path, as a dict with state, plan and work_files (target: [path, size]),
+        or None if there is none, or if the file or the targets changed since.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, targets, state, plan, work_files FROM journal '
+                                   'WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, saved_targets, state, plan, work_files = row
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if (size, mtime_ns) != (st.st_size, st.st_mtime_ns) or json.loads(saved_targets) != list(targets):
+            log.info('%s changed since it was journaled, starting over', path)
+            self.forget(path)
+            return None
+
+        return {'state': state, 'plan': json.loads(plan), 'work_files': json.loads(work_files)}
+
+    def forget(self, path: str):
+        with self._lock:
+            self._db.execute('DELETE FROM journal WHERE path=?', (path,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
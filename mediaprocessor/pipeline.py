@@ -0,0 +1,223 @@
+"""
+Module pipeline.py
+Pipelined batch processing. Instead of taking each file through the whole state machine before starting the next,
+every step is a stage with its own pool of threads and a bounded queue in front of it: files are probed and their
+tags fetched while an earlier file is encoded, and deployed while a later one is. A slow stage fills its queue and
+holds the stages before it back, so memory and disk use stay bounded.
+"""
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage(object):
+    """A step of a Pipeline: func is called with each item by workers threads, depth items wait in front of it."""
+
+    def __init__(self, name, func, workers=1, depth=2):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.depth = max(depth, 1)
+
+
+class Pipeline(object):
+    """
+    Runs items through stages, in order. An item that raises in a stage leaves the pipeline with the error recorded,
+    the others carry on. Items are PipelineItems, whatever the stages need is kept on them.
+    """
+
+    def __init__(self, stages, report=None):
+        """
+        :param stages: list of Stage
+        :param report: callable taking every PipelineItem when it leaves the pipeline
+        """
+        self.stages = stages
+        self.report = report
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """
+        Stops feeding the pipeline. Items already in it finish the stage they are in and leave, with a Cancelled
+        error. Running conversions are not interrupted, see VideoProcessor.cancel.
+        """
+        self.cancelled.set()
+
+    def run(self, items) -> list:
+        """
+        Feeds items to the first stage as it has room for them, and waits until all of them are through.
+        :param items: iterable of PipelineItem, consumed lazily
+        :return: the items, in the order they left the pipeline
+        """
+        queues = [queue.Queue(maxsize=stage.depth) for stage in self.stages]
+        finished = queue.Queue()
+        threads = []
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+
+        def work(i):
+            stage = self.stages[i]
+            while True:
+                item = queues[i].get()
+                if item is _DONE:
+                    break
+
+                if item.error is None and self.cancelled.is_set():
+                    item.error = 'Cancelled'
+                if item.error is None:
+                    started = time.monotonic()
+                    try:
+                        stage.func(item)
+                    except Exception as e:
+                        log.exception('%s failed for %s', stage.name, item.path)
+                        item.error = str(e) or e.__class__.__name__
+                    item.timings[stage.name] = time.monotonic() - started
+
+                if item.error is None and i + 1 < len(self.stages):
+                    queues[i + 1].put(item)
+                else:
+                    finished.put(item)
+
+            # The last worker of a stage tells the next one nothing else is coming.
+            with lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                if i + 1 < len(self.stages):
+                    for _ in range(self.stages[i + 1].workers):
+                        queues[i + 1].put(_DONE)
+                else:
+                    finished.put(_DONE)
+
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                t = threading.Thread(target=work, args=(i,), name=f'{stage.name}-{n}', daemon=True)
+                t.start()
+                threads.append(t)
+
+        def feed():
+            for item in items:
+                if self.cancelled.is_set():
+                    break
+                queues[0].put(item)
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+
+        feeder = threading.Thread(target=feed, name='feeder', daemon=True)
+        feeder.start()
+
+        results = []
+        while True:
+            item = finished.get()
+            if item is _DONE:
+                break
+            item.finished = time.monotonic()
+            results.append(item)
+            if self.report:
+                self.report(item)
+
+        feeder.join()
+        for t in threads:
+            t.join()
+        return results
+
+
+class PipelineItem(object):
+    """A file going through a Pipeline."""
+
+    def __init__(self, path, tagging_info=None):
+        self.path = path
+        self.tagging_info = tagging_info
+        self.vp = None
+        self.error = None
+        self.timings = {}
+        self.started = time.monotonic()
+        self.finished = None
+
+    def result(self) -> dict:
+        """The item as a result of cli.process_file, with the time spent in each stage."""
+        return {'path': self.path,
+                'state': self.vp.state if self.vp else None,
+                'status': 'ok' if self.error is None else 'failed',
+                'error': self.error,
+                'outputs': self.vp.deployed_files if self.vp else [],
+                'rewritten': self.vp.rewritten_bytes if self.vp else 0,
+                'deployed': self.vp.deploy_reports if self.vp else [],
+                'seconds': (self.finished or time.monotonic()) - self.started,
+                'stages': dict(self.timings)}
+
+
+class VideoPipeline(Pipeline):
+    """
+    The VideoProcessor state machine as a Pipeline, with the stages
+    prepare: probes the file and plans the conversion (build_machine)
+    fetch: waits for the tags, looked up in the background since prepare, and the artwork
+    encode: converts the file
+    tag, postprocess: as in start_machine
+    deploy: deploys, deletes the original, notifies and finishes
+    """
+    stage_names = ('prepare', 'fetch', 'encode', 'tag', 'postprocess', 'deploy')
+
+    def __init__(self, targets, config, settings=None, notify=None, processor_configs=None, journal=None,
+                 report=None):
+        """
+        :param targets: target containers, e.g. ['mp4']
+        :param config: a configuration loaded by CfgMgr
+        :param settings: workers and depth of each stage, by stage name, defaults to the Pipeline section of config
+        :param notify: applications to notify, see VideoProcessor
+        :param processor_configs: ProcessorConfigs by target, built from config if not given
+        :param journal: Journal recording the state of every file
+        """
+        from mediaprocessor.processor.processor import ProcessorConfig
+
+        self.targets = targets
+        self.config = config
+        self.notify = notify
+        self.journal = journal
+        self.processor_configs = processor_configs or {t: ProcessorConfig.shared(config, t) for t in targets}
+
+        settings = settings if settings is not None else config.get('Pipeline', {})
+        stages = []
+        for name in self.stage_names:
+            stage_settings = settings.get(name, {})
+            stages.append(Stage(name, getattr(self, name), workers=stage_settings.get('workers', 1),
+                                depth=stage_settings.get('depth', 2)))
+        super(VideoPipeline, self).__init__(stages, report=report)
+
+    def run(self, files, tagging_info=None) -> list:
+        """
+        :param files: iterable of paths, consumed lazily
+        :param tagging_info: dict of tagging info by path, see VideoProcessor
+        :return: results, see PipelineItem.result
+        """
+        tagging_info = tagging_info or {}
+        items = (PipelineItem(path, tagging_info.get(path)) for path in files)
+        return [item.result() for item in super(VideoPipeline, self).run(items)]
+
+    def prepare(self, item):
+        from mediaprocessor.Videoprocessor import build_machine
+        item.vp = build_machine(item.path, self.targets, self.config, tagging_info=item.tagging_info,
+                                notify=self.notify, processor_configs=self.processor_configs, journal=self.journal)
+
+    def fetch(self, item):
+        if item.vp.state in ['initialised', 'processed'] and item.vp.has_tag_info():
+            item.vp.fetch_tags()
+
+    def encode(self, item):
+        item.vp.process()
+
+    def tag(self, item):
+        item.vp.tag()
+
+    def postprocess(self, item):
+        item.vp.postprocess()
+
+    def deploy(self, item):
+        item.vp.deploy()
+        item.vp.delete()
+        item.vp.refresh()
+        item.vp.finish()
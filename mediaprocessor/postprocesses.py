@@ -1,22 +1,300 @@
-from mediaprocessor import helpers
+"""
+Module postprocesses.py
+Steps run on the converted files before they are deployed. Mostly moving the moov atom of mp4 files to the front,
+so that they can be played while they are downloaded: relocate_moov does it without copying the media data through
+Python, and without copying it at all where the filesystem can share extents.
+"""
+from mediaprocessor.helpers.helpers import breakdown
+import errno
+import fcntl
 import logging
+import mmap
 import os
+import shutil
+import struct
 log = logging.getLogger(__name__)
 
+# Atoms that can contain the chunk offset tables, those are the only ones relocate_moov descends into.
+_OFFSET_PATH = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+# ioctl(FICLONERANGE), see linux/fs.h
+_FICLONERANGE = 0x4020940d
+_BLOCK = 4096
+
+
+def atoms(path):
+    """
+    Yields the top level atoms of an mp4 file, as (type, offset, size) tuples, reading only their headers.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+            elif size == 0:
+                # Runs to the end of the file
+                size = file_size - offset
+            if size < 8:
+                log.warning('Invalid atom at offset %d of %s', offset, path)
+                return
+            yield kind.decode('latin-1'), offset, size
+            offset += size
+
+
+def is_faststart(path) -> bool:
+    """Whether the moov atom of an mp4 file comes before its media data."""
+    for kind, _, _ in atoms(path):
+        if kind == 'moov':
+            return True
+        if kind == 'mdat':
+            return False
+    return False
+
+
+class RelocationError(Exception):
+    pass
+
+
+def _children(data: bytes, start: int, end: int):
+    """Yields (type, header size, offset, size) of the atoms in data[start:end]."""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise RelocationError(f'Invalid {kind!r} atom at offset {offset}')
+        yield kind, header, offset, size
+        offset += size
+
+
+def _patch(data: bytes, start: int, end: int, shift, co64: bool) -> bytes:
+    """
+    Copy of the atoms in data[start:end] with every chunk offset moved by shift(offset). With co64, stco tables are
+    turned into co64 ones, and the sizes of the atoms containing them are updated.
+    """
+    out = []
+    for kind, header, offset, size in _children(data, start, end):
+        body = offset + header
+        if kind in _OFFSET_PATH:
+            payload = _patch(data, body, offset + size, shift, co64)
+            out.append(_atom(kind, payload))
+        elif kind in (b'stco', b'co64'):
+            version_flags, count = struct.unpack_from('>II', data, body)
+            wide = kind == b'co64'
+            offsets = struct.unpack_from(f'>{count}{"Q" if wide else "I"}', data, body + 8)
+            offsets = [o + shift(o) for o in offsets]
+            if co64 or wide:
+                table = struct.pack(f'>II{count}Q', version_flags, count, *offsets)
+                out.append(_atom(b'co64', table))
+            else:
+                if offsets and max(offsets) > 0xffffffff:
+                    raise RelocationError('Chunk offsets overflow stco')
+                out.append(_atom(b'stco', struct.pack(f'>II{count}I', version_flags, count, *offsets)))
+        elif kind == b'cmov':
+            raise RelocationError('Compressed moov atoms are not supported')
+        else:
+            out.append(data[offset:offset + size])
+    return b''.join(out)
+
+
+def _atom(kind: bytes, payload: bytes) -> bytes:
+    if len(payload) + 8 > 0xffffffff:
+        return struct.pack('>I4sQ', 1, kind, len(payload) + 16) + payload
+    return struct.pack('>I4s', len(payload) + 8, kind) + payload
+
+
+def _clone(src, dst, src_offset, dst_offset, length) -> bool:
+    """Shares the extents of a block aligned range of src with dst (reflink), returns False if not supported."""
+    try:
+        fcntl.ioctl(dst, _FICLONERANGE, struct.pack('=qQQQ', src, src_offset, length, dst_offset))
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EBADF):
+            raise
+        return False
+    return True
+
+
+def _move(src, dst, src_offset, dst_offset, length) -> tuple:
+    """
+    Puts a range of src at dst_offset in dst, reflinking the blocks it can when both offsets have the same alignment.
+    :return: (bytes copied, bytes cloned)
+    """
+    if (dst_offset - src_offset) % _BLOCK == 0:
+        lead = min(-src_offset % _BLOCK, length)
+        aligned = (length - lead) - (length - lead) % _BLOCK
+        if aligned and _clone(src, dst, src_offset + lead, dst_offset + lead, aligned):
+            copied = _copy(src, dst, src_offset, dst_offset, lead)
+            end = lead + aligned
+            copied += _copy(src, dst, src_offset + end, dst_offset + end, length - end)
+            return copied, aligned
+    return _copy(src, dst, src_offset, dst_offset, length), 0
+
+
+def _copy(src, dst, src_offset, dst_offset, length) -> int:
+    """
+    Copies a range of src to dst in the kernel: copy_file_range, which may share extents itself, else sendfile,
+    else read and write. Returns the bytes copied.
+    """
+    copied = 0
+    if not length:
+        return 0
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    while copied < length:
+        n = 0
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src, dst, length - copied, src_offset + copied, dst_offset + copied)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                use_copy_file_range = False
+                continue
+        else:
+            os.lseek(dst, dst_offset + copied, os.SEEK_SET)
+            try:
+                n = os.sendfile(dst, src, src_offset + copied, min(length - copied, 1 << 30))
+            except OSError:
+                data = os.pread(src, min(length - copied, 1 << 20), src_offset + copied)
+                n = os.write(dst, data)
+        if n == 0:
+            raise RelocationError('Unexpected end of file')
+        copied += n
+    return copied
+
+
+def relocate_moov(inputfile, outputfile=None) -> dict:
+    """
+    Moves the moov atom of an mp4 file before its media data. The top level atoms and the moov are read through
+    mmap, the chunk offsets of the moov are moved by the room it takes at the front (stco tables become co64 ones
+    if they would overflow), and the other atoms are moved in the kernel. A free atom pads the moov so that the
+    media data keeps its alignment to filesystem blocks, which lets it be reflinked where the filesystem supports
+    it, instead of copied.
+    :param inputfile: path to the mp4 file
+    :param outputfile: where to write the result, inputfile is replaced if None
+    :return: dict with the bytes written (moov and copied data) and cloned (reflinked), None if moov was already
+    at the front
+    """
+    with open(inputfile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        top = list(_children(data, 0, len(data)))
+        kinds = [kind for kind, _, _, _ in top]
+        if b'moov' not in kinds or b'mdat' not in kinds:
+            raise RelocationError(f'{inputfile} has no moov or no mdat atom')
+        moov = top[kinds.index(b'moov')]
+        first_mdat = top[kinds.index(b'mdat')]
+        if moov[2] < first_mdat[2]:
+            return None
+
+        _, moov_header, moov_offset, moov_size = moov
+        head = [a for a in top if a[2] < first_mdat[2]]
+        rest = [a for a in top if a[2] >= first_mdat[2] and a is not moov]
+        head_size = sum(a[3] for a in head)
+
+        co64 = False
+        while True:
+            payload = _patch(data, moov_offset + moov_header, moov_offset + moov_size, lambda o: 0, co64)
+            new_moov = _atom(b'moov', payload)
+            padding = -len(new_moov) % _BLOCK
+            if 0 < padding < 8:
+                padding += _BLOCK
+            inserted = len(new_moov) + padding
+            # The atoms before the media data stay, the ones up to the original moov move by what was inserted, those
+            # after it by that minus the old moov.
+            shift = (lambda o: 0 if o < head_size else inserted if o < moov_offset else inserted - moov_size)
+            try:
+                new_moov = _atom(b'moov', _patch(data, moov_offset + moov_header, moov_offset + moov_size, shift,
+                                                 co64))
+                break
+            except RelocationError:
+                if co64:
+                    raise
+                co64 = True
+        free = _atom(b'free', b'\0' * (padding - 8)) if padding else b''
+
+        temporary = outputfile or inputfile + '.QTFS'
+        written = len(new_moov) + len(free)
+        cloned = 0
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            src = f.fileno()
+            position = 0
+            for _, _, offset, size in head:
+                written += _copy(src, fd, offset, position, size)
+                position += size
+            os.pwrite(fd, new_moov + free, position)
+            position += len(new_moov) + len(free)
+            for _, _, offset, size in rest:
+                copied, shared = _move(src, fd, offset, position, size)
+                written += copied
+                cloned += shared
+                position += size
+            os.ftruncate(fd, position)
+        except Exception:
+            os.close(fd)
+            os.remove(temporary)
+            raise
+        os.close(fd)
+        shutil.copymode(inputfile, temporary)
+
+    if outputfile is None:
+        os.replace(temporary, inputfile)
+    log.info('Moved moov of %s to the front, %d bytes written, %d bytes reflinked', inputfile, written, cloned)
+    return {'written': written, 'cloned': cloned}
+
+
+class MoovRelocator(object):
+    """Moves the moov atom of mp4 files to the front with relocate_moov."""
+    supported_extensions = ['.mp4', '.m4v', '.mov']
+    name = 'relocate'
+
+    @classmethod
+    def process(cls, inputfile) -> int:
+        """:return: number of bytes written"""
+        if not os.path.exists(inputfile):
+            raise IOError(f'{inputfile} does not exist')
+        if breakdown(inputfile)['extension'] not in cls.supported_extensions:
+            return 0
+
+        result = relocate_moov(inputfile)
+        if result is None:
+            log.info('MOOV atom of %s is already at the start of the file.', inputfile)
+            return 0
+        return result['written']
+
 
 class QtFastStart(object):
     supported_extensions = ['.mp4']
     name = 'qtfs'
 
     @classmethod
-    def process(cls, inputfile):
-        pathelements = helpers.breakdown(inputfile)
+    def process(cls, inputfile) -> int:
+        """
+        Moves the moov atom of inputfile to the front, unless it is there already (see Containers.faststart). This is
+        done by relocate_moov, the qtfaststart library is only used for the files it cannot handle.
+        :return: number of bytes written
+        """
+        pathelements = breakdown(inputfile)
         temp_ext = '.QTFS'
 
         if not os.path.exists(inputfile):
             raise IOError(f'{inputfile} does not exist')
 
         if pathelements['extension'] in cls.supported_extensions:
+            if is_faststart(inputfile):
+                log.info('MOOV atom of %s is already at the start of the file.', inputfile)
+                return 0
+
+            try:
+                return MoovRelocator.process(inputfile)
+            except RelocationError as e:
+                log.warning('%s, falling back to qtfaststart', e)
+
             from qtfaststart import processor, exceptions
 
             log.info("Relocating MOOV atom to start of file.")
@@ -31,13 +309,16 @@ class QtFastStart(object):
             except exceptions.FastStartException:
                 log.warning("QT FastStart did not run - perhaps moov atom was at the start already.")
 
-            if outputfile:
+            if os.path.exists(outputfile):
+                written = os.path.getsize(outputfile)
                 os.remove(inputfile)
                 os.rename(outputfile, inputfile)
+                return written
+        return 0
 
 
 class PostProcessorFactory(object):
-    supported_post_processors = [QtFastStart]
+    supported_post_processors = [QtFastStart, MoovRelocator]
 
     @classmethod
     def get_post_processors(cls, post_processors: list):
@@ -1,4 +1,5 @@
 from mediaprocessor.configuration_mod import configuration
+from mediaprocessor.configuration_mod.model import compile_config
 from mediaprocessor.converter.optionbuilder import OptionBuilder
 from mediaprocessor.converter.containers import ContainerFactory, Container
 from mediaprocessor.converter.streams import AudioStream
@@ -8,7 +9,16 @@ from mediaprocessor.converter.formats import FormatFactory
 import sys
 import os
 import logging
+import asyncio
+import threading
+from functools import partial
+from types import MappingProxyType
 from mediaprocessor.converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError
+from mediaprocessor.converter.cache import ProbeCache
+from mediaprocessor.converter.progress import ProgressBroadcaster
+from mediaprocessor.converter.chunks import ChunkedConversion, split_at_keyframes
+from mediaprocessor.converter.scheduler import CoreScheduler
+from mediaprocessor.converter.aio import AsyncFFMpeg, iterate_in_thread
 
 # log = logging.getLogger()
 # log.setLevel(logging.DEBUG)
@@ -29,31 +39,100 @@ log = logging.getLogger(__name__)
 """
 
 
+async def acquire_cores(scheduler, want=None):
+    """CoreScheduler.acquire without blocking the loop. If the caller is cancelled, the cores are given back."""
+    future = asyncio.get_running_loop().run_in_executor(None, partial(scheduler.acquire, want=want))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda f: f.exception() is None and f.result().release())
+        raise
+
+
 class ProcessorConfig(object):
+    """
+    What the Processors of a target need from a configuration, compiled once: the ffmpeg wrapper, the stream
+    templates and defaults, the encoders and their options. A ProcessorConfig cannot be changed once built, so that
+    the Processors of every file, in any thread, can share it, see shared.
+    The freeze is shallow: its attributes cannot be set and its collections are read-only, but the Options and the
+    options they hold, as well as the ConfigObj in config, are the same objects for every Processor. They must not be
+    changed: copy an option, or build a new one, to change it for a file (see Container.set_dispo).
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
     def __init__(self, config, target):
         self.config = config
         self.target = target
+        settings = compile_config(config)
+        self.settings = settings
+        ffmpeg = settings.ffmpeg
+        container = settings.containers[target]
+
+        self._audio_languages = tuple(Language(lng) for lng in settings.languages.audio)
+        self._subtitle_languages = tuple(Language(lng) for lng in settings.languages.subtitle)
 
-        self._audio_languages = [Language(lng) for lng in self.config['Languages']['audio']]
-        self._subtitle_languages = [Language(lng) for lng in self.config['Languages']['subtitle']]
+        probe_cache = None
+        if ffmpeg.probe_cache:
+            probe_cache = ProbeCache.shared(max_entries=ffmpeg.probe_cache_size, content_hash=ffmpeg.probe_cache_hash)
 
-        self.ffmpeg = FFMpeg(self.config['FFMPEG']['ffmpeg'], self.config['FFMPEG']['ffprobe'])
-        self.ignore = {'video': self.config['Containers'][self.target]['video'].get('prefer_copy', False),
-                       'audio': self.config['Containers'][self.target]['audio'].get('prefer_copy', False),
-                       'subtitle': self.config['Containers'][self.target]['subtitle'].get('prefer_copy', False)}
+        self.ffmpeg = FFMpeg(ffmpeg.ffmpeg, ffmpeg.ffprobe, probe_cache=probe_cache)
+        self.ignore = MappingProxyType({'video': container.video.prefer_copy,
+                                        'audio': container.audio.prefer_copy,
+                                        'subtitle': container.subtitle.prefer_copy})
 
-        self.audio_create_tracks = [FormatFactory.get_format(fmt)
-                                    for fmt in
-                                    self.config['Containers'][self.target]['audio']['force_create_tracks'] if fmt]
+        self.audio_create_tracks = tuple(FormatFactory.get_format(fmt)
+                                         for fmt in container.audio.force_create_tracks if fmt)
 
-        self._defaults = self.load_defaults()
+        self._defaults = MappingProxyType(self.load_defaults())
         self.program_encoders = Encoders(self.ffmpeg)
-        self._stream_formats = self.load_stream_formats()
-        self.encoders_defaults = self.load_encoders()
-        self.preferred_encoders = self.config['PreferredEncoders']
+        self._stream_formats = MappingProxyType(self.load_stream_formats())
+        self.encoders_defaults = MappingProxyType(self.load_encoders())
+        self.preferred_encoders = settings.preferred_encoders
         self.encoder_factory = EncoderFactory(self.program_encoders, self.encoders_defaults, self.preferred_encoders)
-        self.preopts = self.config['Containers'][self.target]['preopts']
-        self.postopts = self.config['Containers'][self.target]['postopts']
+        self.preopts = container.preopts
+        self.postopts = container.postopts
+        self.faststart = container.faststart
+        self.progress_interval = ffmpeg.progress_interval
+        self.stall_timeout = ffmpeg.stall_timeout
+        self.min_speed = ffmpeg.min_speed
+        self.min_speed_window = ffmpeg.min_speed_window
+        self.core_budget = ffmpeg.core_budget or os.cpu_count() or 1
+        self.scheduler = CoreScheduler.shared(self.core_budget, slots=ffmpeg.concurrent_jobs)
+        threads = str(ffmpeg.threads)
+        self.threads = int(threads) if threads.isdigit() and int(threads) > 0 else None
+        self.chunked = ffmpeg.chunked
+        self.chunk_threads = ffmpeg.chunk_threads
+        self.chunk_min_duration = ffmpeg.chunk_min_duration
+        self.chunk_retries = ffmpeg.chunk_retries
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'ProcessorConfig is immutable, cannot set {name}')
+        super(ProcessorConfig, self).__setattr__(name, value)
+
+    @classmethod
+    def shared(cls, config, target):
+        """
+        Returns a process-wide ProcessorConfig for the settings of config and target, built the first time it is
+        asked for. Worker processes forked afterwards inherit it, and share its memory until they write to it.
+        """
+        key = (compile_config(config).digest, target)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(config, target)
+            return cls._shared[key]
+
+    @classmethod
+    def _config_changed(cls, path, previous, current):
+        """Drops the profiles of the previous version of a configuration file, see CfgMgr.subscribe."""
+        digest = compile_config(previous).digest
+        if digest == compile_config(current).digest:
+            return
+        with cls._shared_lock:
+            for key in [k for k in cls._shared if k[0] == digest]:
+                del cls._shared[key]
 
     @property
     def defaults(self):
@@ -77,18 +156,18 @@ class ProcessorConfig(object):
             _options = Options()
 
             try:
-                str_format = self.config['Containers'][self.target][k]['default_format']
+                str_format = getattr(self.settings.containers[self.target], k).default_format
                 fmt = FormatFactory.get_format(str_format)
             except IndexError:
                 log.critical('There are no default options in accepted_track_formats')
                 raise Exception('No default options')
 
-            if str_format in self.config['StreamFormats']:
+            if str_format in self.settings.stream_formats:
                 fmt = FormatFactory.get_format(str_format)
-                for opt_name, opt_value in self.config['StreamFormats'][fmt.name].items():
+                for opt_name, opt_value in self.settings.stream_formats[fmt.name].items():
                     option = OptionFactory.get_option(opt_name)
                     if option:
-                        if isinstance(opt_value, list) and len(opt_value) > 0:
+                        if isinstance(opt_value, tuple) and len(opt_value) > 0:
                             _options.add_option(option(opt_value[0]))
                         else:
                             _options.add_option(option(opt_value))
@@ -103,15 +182,15 @@ class ProcessorConfig(object):
         templates = {}
         for k in ['video', 'audio', 'subtitle']:
 
-            for str_format in self.config['Containers'][self.target][k].get('accepted_track_formats', []):
+            for str_format in getattr(self.settings.containers[self.target], k).accepted_track_formats:
                 fmt = FormatFactory.get_format(str_format)
-                if fmt.name in self.config['StreamFormats']:
+                if fmt.name in self.settings.stream_formats:
                     _options = Options()
 
-                    for opt_name, opt_value in self.config['StreamFormats'][fmt.name].items():
+                    for opt_name, opt_value in self.settings.stream_formats[fmt.name].items():
                         option = OptionFactory.get_option(opt_name)
                         if option:
-                            if isinstance(opt_value, list):
+                            if isinstance(opt_value, tuple):
                                 for v in opt_value:
                                     _options.add_option(option(v))
                             else:
@@ -127,20 +206,23 @@ class ProcessorConfig(object):
         for encoder in self.program_encoders.supported_codecs:
 
             _options = Options()
-            if encoder.codec_name in self.config['EncoderOptions']:
-                for k, v in self.config['EncoderOptions'][encoder.codec_name].items():
+            if encoder.codec_name in self.settings.encoder_options:
+                for k, v in self.settings.encoder_options[encoder.codec_name].items():
                     _option = OptionFactory.get_option(k)
                     if _option:
-                        _options.add_option(_option(v))
+                        _options.add_option(_option(list(v) if isinstance(v, tuple) else v))
 
             encs[encoder.codec_name] = _options
 
         return encs
 
 
+configuration.CfgMgr.subscribe(ProcessorConfig._config_changed)
+
+
 class Processor(object):
 
-    def __init__(self, config, input_file, output_file, target):
+    def __init__(self, config, input_file, output_file, target, source_container=None, processor_config=None):
         """
         Creates a target source_container from the inputfile, taking into account the configuration
         :param config: a configuration object
@@ -149,14 +231,20 @@ class Processor(object):
         :type input_file: os.path.abspath
         :param target: the target source_container to create
         :type target: str
+        :param source_container: the input file, already probed, it is probed otherwise
+        :type source_container: Container
+        :param processor_config: the ProcessorConfig of config for this target, if one was built already
+        :type processor_config: ProcessorConfig
         """
-        self.config = ProcessorConfig(config, target)
+        self.config = processor_config or ProcessorConfig.shared(config, target)
         if os.path.exists(input_file):
             self.infile = input_file
         else:
             raise FileNotFoundError
 
-        self.source_container = ContainerFactory.container_from_parser(self.config.ffmpeg.probe(self.infile))
+        if source_container is None:
+            source_container = ContainerFactory.container_from_parser(self.config.ffmpeg.probe(self.infile))
+        self.source_container = source_container
 
         self.target_container = Container(target, output_file)
 
@@ -164,8 +252,31 @@ class Processor(object):
         self.options = []
 
         self.ob = OptionBuilder(self.source_container, self.target_container)
+        self.progress = ProgressBroadcaster(self.config.progress_interval)
+        self.job = None
+        self._planned = False
+        # Tags written by ffmpeg while muxing, see FFMpeg.tag_args. tags_muxed tells whether the conversion did.
+        self.metadata = None
+        self.cover = None
+        self.tags_muxed = False
+
+    def subscribe(self, callback, interval=None):
+        """
+        Registers callback to receive the ProgressEvents of the conversion, at most once every interval seconds.
+        See ProgressBroadcaster.subscribe.
+        """
+        return self.progress.subscribe(callback, interval)
 
-    def process(self, cmd_only=False):
+    def unsubscribe(self, token):
+        self.progress.unsubscribe(token)
+
+    def plan(self):
+        """
+        Builds the target container and the mapping of the source streams to it. Only done once.
+        """
+        if self._planned:
+            return
+        self._planned = True
 
         self.ob.generate_target_container(self.config.stream_formats,
                                           self.config.defaults,
@@ -176,25 +287,130 @@ class Processor(object):
         if self.config.audio_create_tracks:
             self.add_extra_streams()
         self.target_container.fix_disposition()
+        rates = {t: self.source_container.streams[s].rate for s, t in self.ob.mapping}
+        self.target_container.format_options.update(
+            FFMpeg.faststart_options(self.config.faststart, self.target_container, self.source_container.duration,
+                                     rates))
         self.ob.print_mapping(self.source_container, self.target_container, self.ob.mapping)
-        commandline = self.config.ffmpeg.generate_commands(self.source_container,
-                                                           self.target_container,
-                                                           self.ob.mapping,
-                                                           self.config.encoder_factory,
-                                                           preopts=self.config.preopts,
-                                                           postopts=self.config.postopts)
 
-        log.debug('FFmpeg command:\n %s', ' '.join(commandline))
-
-        if not cmd_only:
+    def process(self, cmd_only=False):
+        """
+        Plans the conversion and, unless cmd_only is set, runs it. Yields ProgressEvents, which are also
+        published to subscribers.
+        """
+        self.plan()
+        if cmd_only:
+            commandline = self.generate_commands(self.config.threads)
+            log.debug('FFmpeg command:\n %s', ' '.join(commandline))
+            return
+
+        # Waits for the scheduler to admit the job, the cores are given back once ffmpeg has exited.
+        with self.config.scheduler.acquire(want=self.config.threads) as allocation:
             try:
-
-                for p in self.config.ffmpeg.convert2(commandline):
-                    yield p
+                self.job = self.chunked_conversion(allocation.threads)
+                if self.job is None:
+                    self.tags_muxed = bool(self.metadata or self.cover)
+                    commandline = self.generate_commands(allocation.threads)
+                    log.debug('FFmpeg command:\n %s', ' '.join(commandline))
+                    self.job = self.config.ffmpeg.start(
+                        commandline,
+                        duration=self.source_container.duration,
+                        timeout=self.config.stall_timeout,
+                        min_speed=self.config.min_speed,
+                        min_speed_window=self.config.min_speed_window,
+                        outputs=[self.target_container.file_path])
+                for event in self.job:
+                    self.progress.publish(event)
+                    yield event
 
             except (FFMpegError, FFMpegConvertError) as e:
                 raise e
 
+    async def process_async(self):
+        """
+        process for asyncio: ffmpeg runs through AsyncFFMpeg, and a chunked conversion, which has threads of its own,
+        is followed from an executor. Cancelling the task iterating over it stops the conversion.
+        """
+        self.plan()
+        loop = asyncio.get_running_loop()
+        with await acquire_cores(self.config.scheduler, want=self.config.threads) as allocation:
+            self.job = await loop.run_in_executor(None, self.chunked_conversion, allocation.threads)
+            if self.job is not None:
+                events = iterate_in_thread(self.job)
+            else:
+                self.tags_muxed = bool(self.metadata or self.cover)
+                commandline = self.generate_commands(allocation.threads)
+                log.debug('FFmpeg command:\n %s', ' '.join(commandline))
+                self.job = await AsyncFFMpeg(self.config.ffmpeg).start(
+                    commandline,
+                    duration=self.source_container.duration,
+                    timeout=self.config.stall_timeout,
+                    min_speed=self.config.min_speed,
+                    min_speed_window=self.config.min_speed_window,
+                    outputs=[self.target_container.file_path])
+                events = self.job
+            async for event in events:
+                self.progress.publish(event)
+                yield event
+
+    def generate_commands(self, threads=None) -> list:
+        return self.config.ffmpeg.generate_commands(self.source_container,
+                                                    self.target_container,
+                                                    self.ob.mapping,
+                                                    self.config.encoder_factory,
+                                                    preopts=self.config.preopts,
+                                                    postopts=self.config.postopts,
+                                                    threads=threads,
+                                                    metadata=self.metadata,
+                                                    cover=self.cover)
+
+    def chunked_conversion(self, cores=None):
+        """
+        Plans a chunked encode of the video, see converter.chunks. The number of chunks is the cores allocated to the
+        job divided by the threads given to each chunk, limited so that chunks are at least chunk_min_duration
+        seconds long.
+        :param cores: cores allocated to the job, defaults to the whole core budget
+        :return: a ChunkedConversion, or None if chunked encoding is disabled or pointless for this file
+        """
+        duration = self.source_container.duration
+        if not self.config.chunked or not duration:
+            return None
+
+        video = [(s, t) for s, t in self.ob.mapping if self.target_container.streams[t].kind == 'video']
+        if all(self.source_container.streams[s] == self.target_container.streams[t] for s, t in video):
+            # Nothing to encode, or the video is copied
+            return None
+
+        chunks = min((cores or self.config.core_budget) // max(self.config.chunk_threads, 1),
+                     int(duration // max(self.config.chunk_min_duration, 1)))
+        if chunks < 2:
+            return None
+
+        segments = split_at_keyframes(self.config.ffmpeg.keyframes(self.infile, stream=str(video[0][0])),
+                                      duration, chunks, start_time=self.source_container.start_time or 0.0)
+        if len(segments) < 2:
+            return None
+
+        log.info('Encoding %s in %d chunks', self.infile, len(segments))
+        return ChunkedConversion(self.config.ffmpeg, self.source_container, self.target_container, self.ob.mapping,
+                                 self.config.encoder_factory, segments,
+                                 threads=self.config.chunk_threads,
+                                 retries=self.config.chunk_retries,
+                                 preopts=self.config.preopts,
+                                 postopts=self.config.postopts,
+                                 timeout=self.config.stall_timeout,
+                                 min_speed=self.config.min_speed,
+                                 min_speed_window=self.config.min_speed_window)
+
+    def cancel(self, graceful=True):
+        """
+        Cancels the running conversion, if any, and removes its partial output. See ConversionJob.cancel.
+        :return: True if no ffmpeg is running anymore
+        """
+        if self.job:
+            return self.job.cancel(graceful)
+        return True
+
     def suitable_language(self, stream):
 
         if stream.options.get_unique_option(Language) in self.config.audio_languages:
@@ -294,3 +510,122 @@ class Processor(object):
 
         except:
             return None
+
+
+class MultiProcessor(object):
+    """
+    Processes a video file into several target containers with a single ffmpeg, so that the source is decoded once,
+    and encoded once for the streams the targets have in common, see FFMpeg.generate_multi_commands. Each target has
+    its own Processor, and so its own configuration and mapping. With a single target, this is the same as running
+    its Processor, chunked encoding included.
+    """
+
+    def __init__(self, config, input_file, outputs, processor_configs=None):
+        """
+        :param config: a configuration object
+        :type config: ConfigObj
+        :param input_file: path to the input file
+        :param outputs: list of (target, output_file) tuples
+        :param processor_configs: ProcessorConfigs of config already built, by target
+        """
+        processor_configs = processor_configs or {}
+        self.processors = {}
+        source_container = None
+        for target, output_file in outputs:
+            processor = Processor(config, input_file, output_file, target, source_container=source_container,
+                                  processor_config=processor_configs.get(target))
+            source_container = processor.source_container
+            self.processors[target] = processor
+
+        self.first = next(iter(self.processors.values()))
+        self.progress = ProgressBroadcaster(self.first.config.progress_interval)
+        self.job = None
+
+    @property
+    def source_container(self):
+        return self.first.source_container
+
+    @property
+    def target_containers(self) -> dict:
+        return {target: processor.target_container for target, processor in self.processors.items()}
+
+    def subscribe(self, callback, interval=None):
+        """See Processor.subscribe"""
+        return self.progress.subscribe(callback, interval)
+
+    def unsubscribe(self, token):
+        self.progress.unsubscribe(token)
+
+    def process(self, cmd_only=False):
+        """
+        Plans the conversion of every target and, unless cmd_only is set, runs it. Yields ProgressEvents, which are
+        also published to subscribers.
+        """
+        if len(self.processors) == 1:
+            self.job = self.first
+            for event in self.first.process(cmd_only):
+                self.progress.publish(event)
+                yield event
+            return
+
+        config = self.first.config
+        if cmd_only:
+            log.debug('FFmpeg command:\n %s', ' '.join(self.commandline(threads=config.threads)))
+            return
+
+        with config.scheduler.acquire(want=config.threads) as allocation:
+            commandline = self.commandline(threads=allocation.threads)
+            log.debug('FFmpeg command:\n %s', ' '.join(commandline))
+            self.job = config.ffmpeg.start(commandline,
+                                           duration=self.source_container.duration,
+                                           timeout=config.stall_timeout,
+                                           min_speed=config.min_speed,
+                                           min_speed_window=config.min_speed_window,
+                                           outputs=[ctn.file_path for ctn in self.target_containers.values()])
+            for event in self.job:
+                self.progress.publish(event)
+                yield event
+
+    async def process_async(self):
+        """process for asyncio, see Processor.process_async"""
+        if len(self.processors) == 1:
+            self.job = self.first
+            async for event in self.first.process_async():
+                self.progress.publish(event)
+                yield event
+            return
+
+        config = self.first.config
+        with await acquire_cores(config.scheduler, want=config.threads) as allocation:
+            commandline = self.commandline(threads=allocation.threads)
+            log.debug('FFmpeg command:\n %s', ' '.join(commandline))
+            self.job = await AsyncFFMpeg(config.ffmpeg).start(
+                commandline,
+                duration=self.source_container.duration,
+                timeout=config.stall_timeout,
+                min_speed=config.min_speed,
+                min_speed_window=config.min_speed_window,
+                outputs=[ctn.file_path for ctn in self.target_containers.values()])
+            async for event in self.job:
+                self.progress.publish(event)
+                yield event
+
+    def commandline(self, threads=None) -> list:
+        """
+        Plans every target and returns the ffmpeg command line producing them. With a single target, this is the
+        command line of its Processor when it is not chunked.
+        """
+        for processor in self.processors.values():
+            processor.plan()
+        if len(self.processors) == 1:
+            return self.first.generate_commands(threads)
+
+        targets = [(processor.target_container, processor.ob.mapping, processor.config.encoder_factory,
+                    processor.config.preopts, processor.config.postopts) for processor in self.processors.values()]
+        return self.first.config.ffmpeg.generate_multi_commands(self.source_container, targets, threads=threads)
+
+    def cancel(self, graceful=True):
+        """See Processor.cancel"""
+        if self.job:
+            return self.job.cancel(graceful)
+        return True
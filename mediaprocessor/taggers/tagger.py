@@ -33,6 +33,17 @@ class TaggerFactory(object):
         else:
             return None
 
+    @classmethod
+    def get_mux_metadata(cls, tagger: str, tags, is_hd=False):
+        """
+        The tags as metadata for ffmpeg to write while muxing, see FFMpeg.tag_args.
+        :return: dict, None if the tagger cannot tag through ffmpeg
+        """
+        tagger_class = cls.Taggers.get(tagger)
+        if tagger_class and hasattr(tagger_class, 'mux_metadata'):
+            return tagger_class.mux_metadata(tags, is_hd=is_hd)
+        return None
+
 
 class MP4Tagger(ITagger):
     supported_containers = ['mp4']
@@ -103,6 +114,27 @@ class MP4Tagger(ITagger):
         MP4(self.mp4_path).delete(self.mp4_path)
         self.video.save()
 
+    @classmethod
+    def mux_metadata(cls, tags, is_hd=False) -> dict:
+        """
+        What writetags writes, with the names ffmpeg's mp4 muxer gives the same atoms. The iTunMOVI atom (cast,
+        writers, directors) has no ffmpeg equivalent and is left out.
+        """
+        metadata = {'description': tags.description,
+                    'synopsis': tags.long_description,
+                    'genre': tags.genre,
+                    'title': tags.title,
+                    'show': tags.show,
+                    'episode_id': tags.title,
+                    'network': tags.network,
+                    'disc': tags.season_total,
+                    'album': f'{tags.show}, Season {tags.season_total}',
+                    'episode_sort': tags.episode_number,
+                    'track': f'{tags.episode_number}/{tags.season_total}',
+                    'hd_video': cls.setHD(is_hd)[0],
+                    'media_type': 10 if tags.season_number else 9}
+        return {key: str(value) for key, value in metadata.items() if value}
+
     def settag(self, tag, tagdata=None) -> None:
 
         if tag in MP4Tagger.tag_table and tagdata:
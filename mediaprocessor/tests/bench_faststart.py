@@ -0,0 +1,77 @@
+"""
+Benchmark of relocate_moov against the qtfaststart library, on a synthetic mp4 of several GB whose moov is at the
+end. Not part of the test suite, run it with
+    python -m mediaprocessor.tests.bench_faststart --size 4 --directory /path/on/the/filesystem/to/test
+Reflinks are only used on filesystems that support them (btrfs, xfs with reflink=1...), elsewhere the data is
+copied in the kernel.
+"""
+import argparse
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from mediaprocessor.postprocesses import is_faststart, relocate_moov
+
+CHUNK = 1 << 20
+
+
+def atom(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', len(payload) + 8, kind) + payload
+
+
+def write_synthetic(path, size):
+    """ftyp, an mdat of size bytes in 1 MiB chunks, then a moov with a co64 entry per chunk."""
+    ftyp = atom(b'ftyp', b'isom\0\0\2\0isomiso2')
+    chunks = size // CHUNK
+    block = os.urandom(CHUNK)
+    with open(path, 'wb') as f:
+        f.write(ftyp)
+        f.write(struct.pack('>I4sQ', 1, b'mdat', chunks * CHUNK + 16))
+        for _ in range(chunks):
+            f.write(block)
+
+        base = len(ftyp) + 16
+        co64 = atom(b'co64', struct.pack(f'>II{chunks}Q', 0, chunks, *[base + i * CHUNK for i in range(chunks)]))
+        stbl = atom(b'stbl', atom(b'stsd', b'\0' * 8) + co64)
+        trak = atom(b'trak', atom(b'tkhd', b'\0' * 84) + atom(b'mdia', atom(b'minf', stbl)))
+        f.write(atom(b'moov', atom(b'mvhd', b'\0' * 100) + trak))
+
+
+def timed(func, *args):
+    os.sync()
+    started = time.perf_counter()
+    result = func(*args)
+    os.sync()
+    return time.perf_counter() - started, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=4, help='size of the synthetic file, in GB')
+    parser.add_argument('--directory', default=None, help='where to write the files, defaults to the temp directory')
+    args = parser.parse_args(argv)
+
+    from qtfaststart import processor
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmp:
+        source = os.path.join(tmp, 'source.mp4')
+        write_synthetic(source, int(args.size * (1 << 30)))
+        print(f'{os.path.getsize(source) / (1 << 30):.2f} GB synthetic file in {tmp}')
+
+        qtfs = os.path.join(tmp, 'qtfaststart.mp4')
+        seconds, _ = timed(processor.process, source, qtfs)
+        print(f'qtfaststart    {seconds:8.2f}s  {os.path.getsize(qtfs)} bytes written')
+        os.remove(qtfs)
+
+        relocated = os.path.join(tmp, 'relocated.mp4')
+        seconds, result = timed(relocate_moov, source, relocated)
+        assert is_faststart(relocated)
+        print(f'relocate_moov  {seconds:8.2f}s  {result["written"]} bytes written, {result["cloned"]} reflinked')
+
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
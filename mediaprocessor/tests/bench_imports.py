@@ -0,0 +1,55 @@
+"""
+Import time of the modules the command runs on, measured with python -X importtime in fresh interpreters. Not part of
+the test suite, run it with
+    python -m mediaprocessor.tests.bench_imports --budget 250
+Exits with status 1 if the import of a module takes more than the budget, in milliseconds, on the best of the runs.
+The metadata lookups (fetchers), the taggers and the refreshers are only imported when they are used, see
+test_imports for the modules that must stay out of a cold start.
+"""
+import argparse
+import subprocess
+import sys
+
+MODULES = ['mediaprocessor.cli', 'mediaprocessor.Videoprocessor']
+
+
+def importtime(module=None) -> list:
+    """
+    (cumulative microseconds, self microseconds, name) of every module imported by importing module, or by the
+    interpreter's own start if None.
+    """
+    done = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}' if module else 'pass'],
+                          capture_output=True, text=True, check=True)
+    timings = []
+    for line in done.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative_us), int(self_us), name.strip()))
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=250, help='milliseconds allowed for each module')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module, the best run counts')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args(argv)
+
+    startup = {name for _, _, name in importtime()}
+    over = False
+    for module in args.modules:
+        runs = [importtime(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda timings: timings[-1][0])
+        total = best[-1][0] / 1000
+        print(f'{module}: {total:.1f} ms (budget {args.budget:.0f} ms)')
+        imported = [timing for timing in best[:-1] if timing[2] not in startup]
+        for cumulative, _, name in sorted(imported, reverse=True)[:args.top]:
+            print(f'    {cumulative / 1000:8.1f} ms  {name}')
+        over = over or total > args.budget
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Benchmark of the Options lookups on which the planning of a conversion runs, over a synthetic container with many
+streams. Not part of the test suite, run it with
+    python -m mediaprocessor.tests.bench_options --streams 60 --runs 20
+Builds the source container, the target container with OptionBuilder.generate_target_container, and runs the lookups
+of Processor.add_extra_streams on the audio streams. The best of the runs counts.
+"""
+import argparse
+import time
+
+from mediaprocessor.converter.containers import Container
+from mediaprocessor.converter.formats import FormatFactory
+from mediaprocessor.converter.optionbuilder import OptionBuilder
+from mediaprocessor.converter.options import Options, Bitrate, Channels, Disposition, Height, Language, Level, \
+    PixFmt, Profile, Tag, Width
+from mediaprocessor.converter.streams import StreamFactory
+
+LANGUAGES = ['eng', 'fre', 'ger', 'spa', 'ita', 'jpn', 'por', 'rus', 'chi', 'kor']
+
+
+def stream(name, *options):
+    s = StreamFactory.create_stream(FormatFactory.get_format(name))
+    s.add_options(*options)
+    return s
+
+
+def source_container(streams) -> Container:
+    """One h264 stream, then audio and subtitle streams in turn, in several languages."""
+    container = Container('matroska', 'source.mkv')
+    container.add_stream(stream('h264', PixFmt('yuv420p'), Bitrate(8000), Height(1080), Width(1920), Level(4.1),
+                                Profile('high'), Disposition({'default': 1})))
+    for i in range(streams - 1):
+        language = Language(LANGUAGES[i // 2 % len(LANGUAGES)])
+        if i % 2:
+            container.add_stream(stream('subrip', language, Disposition({'default': 0}), Tag('text')))
+        else:
+            container.add_stream(stream('ac3' if i % 4 else 'aac', language, Channels(6 if i % 4 else 2),
+                                        Bitrate(384 if i % 4 else 128), Disposition({'default': 0}), Tag('audio')))
+    return container
+
+
+def templates() -> dict:
+    """Stream templates with several accepted values per option, as ProcessorConfig.load_stream_formats builds them."""
+    values = {'h264': [PixFmt('yuv420p'), PixFmt('yuv420p10le'), Level(4.0), Level(4.1), Profile('main'),
+                       Profile('high')],
+              'aac': [Channels(2), Channels(6), Bitrate(256)],
+              'subrip': [Tag('text')]}
+    formats = {}
+    for name, options in values.items():
+        template = Options()
+        for option in options:
+            template.add_option(option)
+        formats[FormatFactory.get_format(name)] = template
+    return formats
+
+
+def plan(streams):
+    source = source_container(streams)
+    builder = OptionBuilder(source, Container('mp4', 'target.mp4'))
+    aac = FormatFactory.get_format('aac')
+    defaults = {'video': (FormatFactory.get_format('h264'), Options()),
+                'audio': (aac, templates()[aac]),
+                'subtitle': (FormatFactory.get_format('mov_text'), Options())}
+    builder.generate_target_container(templates(), defaults, [Language(lng) for lng in LANGUAGES],
+                                      [Language(lng) for lng in LANGUAGES])
+
+    # The candidates of Processor.add_extra_streams
+    for lng in LANGUAGES:
+        sorted(filter(lambda s: s.options.get_unique_option(Language) == Language(lng), source.audio_streams),
+               key=lambda s: (s.stream_format.score, s.options.get_unique_option(Channels).value,
+                              s.options.get_unique_option(Bitrate)), reverse=True)
+    return builder
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, nargs='+', default=[10, 60, 200], help='streams of the containers')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    for streams in args.streams:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            builder = plan(streams)
+            timings.append(time.perf_counter() - start)
+        print(f'{streams} streams: {min(timings) * 1000:.2f} ms per plan, {len(builder.mapping)} streams mapped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from mediaprocessor.cli import WorkerPids, interrupt_workers, iter_files, summary
+
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class TestIterFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for name in ['a.mkv', 'b.txt', os.path.join('season', 'c.mp4'), os.path.join('season', 'd.MKV')]:
+            path = os.path.join(self.tmp.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def names(self, paths, **kwargs):
+        return [os.path.relpath(f, self.tmp.name) for f in iter_files(paths, **kwargs)]
+
+    def test_directory(self):
+        self.assertEqual(self.names([self.tmp.name]), ['a.mkv', os.path.join('season', 'c.mp4'),
+                                                       os.path.join('season', 'd.MKV')])
+        self.assertEqual(self.names([self.tmp.name], recursive=False), ['a.mkv'])
+
+    def test_files_and_globs(self):
+        # Explicit files whatever their extension, and never twice
+        self.assertEqual(self.names([os.path.join(self.tmp.name, 'b.txt'), os.path.join(self.tmp.name, '*.mkv'),
+                                     os.path.join(self.tmp.name, 'a.mkv'), os.path.join(self.tmp.name, 'missing')]),
+                         ['b.txt', 'a.mkv'])
+
+    def test_summary(self):
+        results = [{'path': 'a.mkv', 'state': 'finished', 'status': 'ok', 'error': None, 'seconds': 1.0},
+                   {'path': 'b.mkv', 'state': 'initialised', 'status': 'failed', 'error': 'boom', 'seconds': 0.5}]
+        text = summary(results, 2.0)
+        self.assertIn('boom', text)
+        self.assertTrue(text.endswith('2 file(s), 1 ok, 1 failed in 2.0s'))
+
+
+class TestInterruptWorkers(unittest.TestCase):
+    def test_interrupt(self):
+        started = time.monotonic()
+        pids = WorkerPids()
+        with ProcessPoolExecutor(max_workers=2, initializer=pids.report) as executor:
+            futures = [executor.submit(nap, 60) for _ in range(2)]
+            time.sleep(1)
+            self.assertEqual(len(list(pids)), 2)
+            interrupt_workers(pids)
+            for future in futures:
+                with self.assertRaises(KeyboardInterrupt):
+                    future.result(10)
+        self.assertLess(time.monotonic() - started, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import dataclasses
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from mediaprocessor.configuration_mod.configuration import CfgMgr
+from mediaprocessor.configuration_mod.model import compile_config
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config')
+
+
+class TestConfigModel(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.ini')
+        shutil.copy(os.path.join(CONFIG_DIR, 'defaults.ini'), self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def load(self, overrides=None):
+        conf = CfgMgr()
+        conf.configdir = self.tmp.name
+        conf.load('test.ini', overrides=overrides)
+        return conf
+
+    def test_compile(self):
+        conf = self.load()
+        model = conf.model
+        self.assertIs(compile_config(conf.cfg), model)
+        self.assertEqual(model.ffmpeg.chunk_retries, conf.cfg['FFMPEG']['chunk_retries'])
+        self.assertEqual(model.containers['mp4'].video.accepted_track_formats,
+                         tuple(conf.cfg['Containers']['mp4']['video']['accepted_track_formats']))
+        self.assertEqual(compile_config(CfgMgr().defaultconfig).containers['mp4'].audio.force_create_tracks, ())
+        self.assertEqual(dict(model.refreshers['plex'].options), dict(conf.cfg['Refreshers']['plex']))
+
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            model.file.move_to = '/tmp'
+        with self.assertRaises(TypeError):
+            model.containers['avi'] = None
+
+    def test_loaded_once(self):
+        conf = self.load()
+        self.assertIs(self.load().cfg, conf.cfg)
+        overridden = self.load({'FFMPEG': {'chunked': True}})
+        self.assertIsNot(overridden.cfg, conf.cfg)
+        self.assertNotEqual(overridden.model.digest, conf.model.digest)
+
+        # A change to the file is picked up
+        with open(self.path, 'a') as f:
+            f.write('\n')
+        os.utime(self.path, ns=(0, 0))
+        reloaded = self.load()
+        self.assertIsNot(reloaded.cfg, conf.cfg)
+        self.assertEqual(reloaded.model.digest, conf.model.digest)
+
+    def change(self, old, new):
+        with open(self.path) as f:
+            content = f.read()
+        self.assertIn(old, content)
+        with open(self.path, 'w') as f:
+            f.write(content.replace(old, new))
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+    def test_reload_event(self):
+        events = []
+        token = CfgMgr.subscribe(lambda *args: events.append(args))
+        self.addCleanup(CfgMgr.unsubscribe, token)
+
+        first = self.load().cfg
+        self.assertEqual(events, [])
+        self.change('chunk_retries = 1', 'chunk_retries = 3')
+        second = self.load().cfg
+        self.assertEqual(second['FFMPEG']['chunk_retries'], 3)
+        # Whoever had the first version keeps it
+        self.assertEqual(first['FFMPEG']['chunk_retries'], 1)
+        self.assertEqual(events, [(os.path.abspath(self.path), first, second)])
+
+    def test_invalid_change(self):
+        first = self.load().cfg
+        self.change('chunk_retries = 1', 'chunk_retries = many')
+        self.assertIs(self.load().cfg, first)
+        # The invalid version is not read again until the file changes
+        with mock.patch.object(CfgMgr, '_load', side_effect=AssertionError('read again')):
+            self.assertIs(self.load().cfg, first)
+        # A file that was never valid is still an error
+        conf = CfgMgr()
+        conf.configdir = self.tmp.name
+        shutil.copy(self.path, os.path.join(self.tmp.name, 'other.ini'))
+        with self.assertRaises(Exception):
+            conf.load('other.ini')
+        self.change('chunk_retries = many', 'chunk_retries = 3')
+        self.assertEqual(self.load().cfg['FFMPEG']['chunk_retries'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
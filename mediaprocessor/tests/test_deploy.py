@@ -0,0 +1,93 @@
+import errno
+import os
+import tempfile
+import unittest
+from unittest import mock
+from mediaprocessor import deploy
+
+
+class TestDeploy(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'movie.mp4')
+        self.data = os.urandom(3 * deploy._STREAM_CHUNK // 2 + 17)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        os.utime(self.src, (1000000000, 1000000000))
+        self.dst = os.path.join(self.tmp.name, 'out', 'movie.mp4')
+        os.mkdir(os.path.dirname(self.dst))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assertCopied(self, path):
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.stat(path).st_mtime, 1000000000)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_hardlink(self):
+        result = deploy.copy_file(self.src, self.dst, hardlink=True)
+        self.assertEqual(result, {'primitive': deploy.HARDLINK, 'bytes': 0})
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+
+    def test_copy(self):
+        # reflink or copy_file_range, depending on the filesystem
+        result = deploy.copy_file(self.src, self.dst)
+        self.assertIn(result['primitive'], [deploy.REFLINK, deploy.COPY_FILE_RANGE, deploy.STREAM])
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        self.assertCopied(self.dst)
+
+    def test_fallbacks(self):
+        # Without reflinks nor copy_file_range, the streaming copy does it all
+        refused = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with mock.patch('fcntl.ioctl', side_effect=refused), mock.patch('os.copy_file_range', side_effect=refused):
+            result = deploy.copy_file(self.src, self.dst, hardlink=False)
+        self.assertEqual(result, {'primitive': deploy.STREAM, 'bytes': len(self.data)})
+        self.assertCopied(self.dst)
+
+    def test_partial_copy_file_range(self):
+        # The streaming copy takes over where copy_file_range stopped
+        real = os.copy_file_range
+        calls = []
+
+        def once(*args):
+            if calls:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            calls.append(args)
+            return real(args[0], args[1], 1000, *args[3:])
+
+        with mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, '')), \
+                mock.patch('os.copy_file_range', side_effect=once):
+            result = deploy.copy_file(self.src, self.dst)
+        self.assertEqual(result, {'primitive': deploy.COPY_FILE_RANGE, 'bytes': len(self.data)})
+        self.assertCopied(self.dst)
+
+    def test_failure_cleans_up(self):
+        with mock.patch('mediaprocessor.deploy._copy_data', side_effect=OSError(errno.ENOSPC, 'No space')):
+            with self.assertRaises(OSError):
+                deploy.copy_file(self.src, self.dst)
+        self.assertEqual(os.listdir(os.path.dirname(self.dst)), [])
+
+    def test_move(self):
+        self.assertEqual(deploy.move_file(self.src, self.dst), {'primitive': deploy.RENAME, 'bytes': 0})
+        self.assertFalse(os.path.exists(self.src))
+        self.assertCopied(self.dst)
+
+    def test_move_across_devices(self):
+        real = os.replace
+
+        def replace(src, dst):
+            if src == self.src:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return real(src, dst)
+
+        with mock.patch('os.replace', side_effect=replace):
+            result = deploy.move_file(self.src, self.dst)
+        self.assertNotEqual(result['primitive'], deploy.RENAME)
+        self.assertFalse(os.path.exists(self.src))
+        self.assertCopied(self.dst)
+
+
+if __name__ == '__main__':
+    unittest.main()
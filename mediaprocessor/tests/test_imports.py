@@ -0,0 +1,31 @@
+import subprocess
+import sys
+import unittest
+
+# Only imported when a file is tagged, its tags looked up or an application notified
+LAZY = ['requests', 'tmdbsimple', 'tvdb_api', 'mutagen', 'transitions', 'qtfaststart',
+        'mediaprocessor.fetchers.fetchers', 'mediaprocessor.taggers.tagger', 'mediaprocessor.refreshers.refreshers',
+        'mediaprocessor.postprocesses']
+
+
+class TestImports(unittest.TestCase):
+    def imported(self, code) -> set:
+        done = subprocess.run([sys.executable, '-c', code + '\nimport sys\nprint("\\n".join(sys.modules))'],
+                              capture_output=True, text=True, check=True)
+        return set(done.stdout.split())
+
+    def test_cold_start(self):
+        for module in ['mediaprocessor.cli', 'mediaprocessor.Videoprocessor']:
+            self.assertEqual(self.imported(f'import {module}') & set(LAZY), set(), module)
+
+    def test_configspec(self):
+        # The codec and format classes are only gone through when the configspec is needed
+        modules = self.imported('import mediaprocessor.configuration_mod.configuration')
+        self.assertNotIn('mediaprocessor.converter.encoders', modules)
+        modules = self.imported('from mediaprocessor.configuration_mod.configuration import CfgMgr\n'
+                                'CfgMgr().defaultconfig')
+        self.assertIn('mediaprocessor.converter.encoders', modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import threading
+import time
+import unittest
+from mediaprocessor.pipeline import Pipeline, PipelineItem, Stage
+
+
+class TestPipeline(unittest.TestCase):
+    def test_stages_in_order(self):
+        def step(name):
+            def func(item):
+                item.tagging_info.append(name)
+            return func
+
+        stages = [Stage('a', step('a'), workers=2), Stage('b', step('b')), Stage('c', step('c'), workers=3)]
+        items = Pipeline(stages).run(PipelineItem(str(i), []) for i in range(10))
+        self.assertEqual(sorted(int(item.path) for item in items), list(range(10)))
+        for item in items:
+            self.assertEqual(item.tagging_info, ['a', 'b', 'c'])
+            self.assertIsNone(item.error)
+            self.assertEqual(set(item.timings), {'a', 'b', 'c'})
+
+    def test_failure(self):
+        def fail(item):
+            if item.path == 'bad':
+                raise ValueError('boom')
+
+        reached = []
+        stages = [Stage('a', fail), Stage('b', lambda item: reached.append(item.path))]
+        reported = []
+        items = Pipeline(stages, report=reported.append).run([PipelineItem('good'), PipelineItem('bad')])
+        self.assertEqual(reached, ['good'])
+        self.assertEqual({item.path: item.error for item in items}, {'good': None, 'bad': 'boom'})
+        self.assertEqual(len(reported), 2)
+        self.assertEqual(items[0].result()['status'] if items[0].path == 'bad' else items[1].result()['status'],
+                         'failed')
+
+    def test_overlap_and_bound(self):
+        # While the slow stage works on one item the fast one runs ahead, but no further than the depth allows.
+        release = threading.Event()
+        fed = []
+
+        def items():
+            for i in range(10):
+                fed.append(i)
+                yield PipelineItem(str(i))
+
+        stages = [Stage('fast', lambda item: None, depth=1), Stage('slow', lambda item: release.wait(), depth=1)]
+        thread = threading.Thread(target=lambda: Pipeline(stages).run(items()))
+        thread.start()
+        time.sleep(0.2)
+        # one in slow, one waiting for it, one in fast, one waiting for fast, one held by the feeder
+        self.assertLessEqual(len(fed), 5)
+        release.set()
+        thread.join(5)
+        self.assertEqual(len(fed), 10)
+
+    def test_cancel(self):
+        pipeline = Pipeline([Stage('a', lambda item: pipeline.cancel()), Stage('b', lambda item: None)])
+        items = pipeline.run(PipelineItem(str(i)) for i in range(10))
+        # Only what was fed before the cancellation went in, and nothing got through the second stage
+        self.assertLess(len(items), 10)
+        self.assertEqual({item.error for item in items}, {'Cancelled'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+from mediaprocessor.postprocesses import QtFastStart, RelocationError, _patch, atoms, is_faststart, relocate_moov
+
+
+def atom(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', len(payload) + 8, kind) + payload
+
+
+def synthetic_mp4(path, chunks=64, chunk_size=4096, moov_last=True):
+    """An mp4 skeleton: ftyp, mdat made of numbered chunks, and a moov whose stco points to every chunk."""
+    ftyp = atom(b'ftyp', b'isom\0\0\2\0isomiso2')
+    mdat_data = b''.join(struct.pack('>I', i) * (chunk_size // 4) for i in range(chunks))
+    mdat = atom(b'mdat', mdat_data)
+
+    def moov(base):
+        stco = atom(b'stco', struct.pack(f'>II{chunks}I', 0, chunks, *[base + i * chunk_size
+                                                                      for i in range(chunks)]))
+        stbl = atom(b'stbl', atom(b'stsd', b'\0' * 8) + stco)
+        trak = atom(b'trak', atom(b'tkhd', b'\0' * 84) + atom(b'mdia', atom(b'minf', stbl)))
+        return atom(b'moov', atom(b'mvhd', b'\0' * 100) + trak + atom(b'udta', b'\0' * 10))
+
+    with open(path, 'wb') as f:
+        if moov_last:
+            f.write(ftyp + mdat + moov(len(ftyp) + 8))
+        else:
+            m = moov(0)
+            f.write(ftyp + moov(len(ftyp) + len(m) + 8) + mdat)
+
+
+def chunk_numbers(path):
+    """Number found at every chunk offset of the file, through its stco or co64 table."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    for kind in [b'stco', b'co64']:
+        i = data.find(kind)
+        if i >= 0:
+            count = struct.unpack_from('>I', data, i + 8)[0]
+            offsets = struct.unpack_from(f'>{count}{"I" if kind == b"stco" else "Q"}', data, i + 12)
+            return [struct.unpack_from('>I', data, o)[0] for o in offsets]
+
+
+class TestFastStart(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'video.mp4')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, *parts):
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(parts))
+
+    def test_atoms(self):
+        # mdat with a 64 bit size
+        large = struct.pack('>I4sQ', 1, b'mdat', 16 + 4) + b'data'
+        self.write(atom(b'ftyp', b'isom'), large, atom(b'moov', b''))
+        self.assertEqual(list(atoms(self.path)), [('ftyp', 0, 12), ('mdat', 12, 20), ('moov', 32, 8)])
+        self.assertFalse(is_faststart(self.path))
+
+        self.write(atom(b'ftyp', b'isom'), atom(b'moov', b''), atom(b'mdat', b'data'))
+        self.assertTrue(is_faststart(self.path))
+
+    def test_already_faststart(self):
+        self.write(atom(b'ftyp', b'isom'), atom(b'moov', b''), atom(b'mdat', b'data'))
+        with mock.patch('qtfaststart.processor.process') as process:
+            self.assertEqual(QtFastStart.process(self.path), 0)
+        self.assertFalse(process.called)
+
+    def test_relocate(self):
+        synthetic_mp4(self.path)
+        before = chunk_numbers(self.path)
+        size = os.path.getsize(self.path)
+
+        result = relocate_moov(self.path)
+        self.assertTrue(is_faststart(self.path))
+        self.assertEqual(chunk_numbers(self.path), before)
+        self.assertEqual([kind for kind, _, _ in atoms(self.path)], ['ftyp', 'moov', 'free', 'mdat'])
+        # The media data keeps its alignment to filesystem blocks
+        mdat = [offset for kind, offset, _ in atoms(self.path) if kind == 'mdat'][0]
+        self.assertEqual((mdat - 24) % 4096, 0)
+        self.assertEqual(result['written'] + result['cloned'], os.path.getsize(self.path))
+        self.assertGreaterEqual(os.path.getsize(self.path), size)
+
+        self.assertIsNone(relocate_moov(self.path))
+
+    def test_co64(self):
+        synthetic_mp4(self.path, chunks=4)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        moov = data.index(b'moov') - 4
+        with self.assertRaises(RelocationError):
+            _patch(data, moov + 8, len(data), lambda o: 1 << 32, co64=False)
+        patched = _patch(data, moov + 8, len(data), lambda o: 1 << 32, co64=True)
+        i = patched.index(b'co64')
+        self.assertEqual(struct.unpack_from('>I', patched, i - 4)[0], 16 + 4 * 8)
+        self.assertEqual(struct.unpack_from('>Q', patched, i + 12)[0], (1 << 32) + 32)
+        # The containers grew with the table
+        self.assertEqual(struct.unpack_from('>I', patched, patched.index(b'trak') - 4)[0],
+                         struct.unpack_from('>I', data, data.index(b'trak') - 4)[0] + 4 * 4)
+
+    def test_qtfaststart_uses_relocator(self):
+        synthetic_mp4(self.path)
+        before = chunk_numbers(self.path)
+        with mock.patch('qtfaststart.processor.process') as process:
+            self.assertGreater(QtFastStart.process(self.path), 0)
+        self.assertFalse(process.called)
+        self.assertEqual(chunk_numbers(self.path), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import copy
+import os
+import tempfile
+import unittest
+from unittest import mock
+from mediaprocessor.configuration_mod.configuration import CfgMgr, config_hash
+from mediaprocessor.converter.cache import CapabilityCache
+from mediaprocessor.converter.tests import fake_ffmpeg
+from mediaprocessor.processor.processor import ProcessorConfig
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config')
+
+
+def load(**ffmpeg):
+    conf = CfgMgr()
+    conf.configdir = CONFIG_DIR
+    conf.load('defaults.ini', overrides={'FFMPEG': ffmpeg})
+    return conf.cfg
+
+
+class TestProcessorConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {'MEDIAPROCESSOR_CACHE_DIR': self.tmp.name})
+        self.env.start()
+        CapabilityCache.clear_memory()
+        ffmpeg_path, ffprobe_path = fake_ffmpeg.install(self.tmp.name)
+        self.paths = {'ffmpeg': ffmpeg_path, 'ffprobe': ffprobe_path, 'probe_cache': False}
+        self.config = load(**self.paths)
+
+    def tearDown(self):
+        ProcessorConfig._shared.clear()
+        self.env.stop()
+        CapabilityCache.clear_memory()
+        self.tmp.cleanup()
+
+    def test_config_hash(self):
+        same = copy.deepcopy(self.config.dict())
+        self.assertEqual(config_hash(self.config), config_hash(same))
+        same['FFMPEG']['threads'] = 2
+        self.assertNotEqual(config_hash(self.config), config_hash(same))
+
+    def test_shared(self):
+        profile = ProcessorConfig.shared(self.config, 'mp4')
+        self.assertIs(ProcessorConfig.shared(self.config, 'mp4'), profile)
+        self.assertIsNot(ProcessorConfig.shared(self.config, 'matroska'), profile)
+
+        # The same settings loaded again give the same profile, other settings another one
+        conf = CfgMgr()
+        conf.load(self.config.dict())
+        self.assertIsNot(conf.cfg, self.config)
+        self.assertIs(ProcessorConfig.shared(conf.cfg, 'mp4'), profile)
+        self.assertIsNot(ProcessorConfig.shared(load(chunked=True, **self.paths), 'mp4'), profile)
+
+    def test_config_changed(self):
+        profile = ProcessorConfig.shared(self.config, 'mp4')
+        changed = load(chunked=True, **self.paths)
+        ProcessorConfig._config_changed('test.ini', changed, changed)
+        self.assertIs(ProcessorConfig.shared(self.config, 'mp4'), profile)
+        ProcessorConfig._config_changed('test.ini', self.config, changed)
+        self.assertIsNot(ProcessorConfig.shared(self.config, 'mp4'), profile)
+
+    def test_immutable(self):
+        profile = ProcessorConfig.shared(self.config, 'mp4')
+        with self.assertRaises(AttributeError):
+            profile.threads = 4
+        with self.assertRaises(TypeError):
+            profile.stream_formats['h264'] = None
+        with self.assertRaises(TypeError):
+            profile.ignore['video'] = False
+        self.assertIsInstance(profile.audio_languages, tuple)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+from mediaprocessor.fetchers.fetchers import Tags
+from mediaprocessor.taggers.tagger import TaggerFactory
+
+
+class TestMuxMetadata(unittest.TestCase):
+    def test_episode(self):
+        tags = Tags()
+        tags.title = 'Pilot'
+        tags.show = 'Show'
+        tags.season_number = 1
+        tags.season_total = 1
+        tags.episode_number = 3
+
+        metadata = TaggerFactory.get_mux_metadata('mp4', tags, is_hd='1080p')
+        self.assertEqual(metadata['title'], 'Pilot')
+        self.assertEqual(metadata['episode_id'], 'Pilot')
+        self.assertEqual(metadata['album'], 'Show, Season 1')
+        self.assertEqual(metadata['track'], '3/1')
+        self.assertEqual(metadata['hd_video'], '2')
+        self.assertEqual(metadata['media_type'], '10')
+        # Empty tags are not written
+        self.assertNotIn('genre', metadata)
+
+    def test_unsupported(self):
+        self.assertIsNone(TaggerFactory.get_mux_metadata('mkv', Tags()))
+
+
+if __name__ == '__main__':
+    unittest.main()
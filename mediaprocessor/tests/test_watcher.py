@@ -0,0 +1,106 @@
+import os
+import tempfile
+import time
+import unittest
+from mediaprocessor.jobqueue import JobQueue, Journal
+from mediaprocessor.watcher import InotifyWatcher, PollingWatcher, StabilityTracker
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'a.mkv')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, path, data=b'\0' * 16):
+        with open(path, 'ab') as f:
+            f.write(data)
+
+
+class TestJobQueue(WatcherTestCase):
+    def test_queue(self):
+        queue = JobQueue(os.path.join(self.tmp.name, 'queue.sqlite'))
+        self.write(self.path)
+        output = os.path.join(self.tmp.name, 'a.mp4')
+        self.write(output)
+        queue.mark_output(output)
+
+        self.assertTrue(queue.add(self.path))
+        self.assertFalse(queue.add(self.path))
+        self.assertFalse(queue.add(output))
+        self.assertEqual(queue.take(5), [self.path])
+        queue.close()
+
+        # A crash while running puts the file back in the queue
+        queue = JobQueue(os.path.join(self.tmp.name, 'queue.sqlite'))
+        self.assertEqual(queue.recover(), 1)
+        self.assertEqual(queue.take(), [self.path])
+        queue.finish(self.path)
+        self.assertEqual(queue.status(self.path), JobQueue.DONE)
+        self.assertEqual(queue.pending, 0)
+        queue.close()
+
+
+class TestJournal(WatcherTestCase):
+    def test_journal(self):
+        journal = Journal(os.path.join(self.tmp.name, 'queue.sqlite'))
+        self.write(self.path)
+        work_file = os.path.join(self.tmp.name, 'a-working.mp4')
+        self.write(work_file, b'\0' * 100)
+
+        journal.save(self.path, 'processed', ['mp4'], {'command': ['ffmpeg']}, {'mp4': work_file})
+        entry = journal.load(self.path, ['mp4'])
+        self.assertEqual(entry['state'], 'processed')
+        self.assertEqual(entry['plan'], {'command': ['ffmpeg']})
+        self.assertEqual(entry['work_files'], {'mp4': [work_file, 100]})
+
+        # Other targets, or a modified input, start over
+        self.assertIsNone(journal.load(self.path, ['mp4', 'matroska']))
+        journal.save(self.path, 'processed', ['mp4'], {}, {})
+        self.write(self.path)
+        self.assertIsNone(journal.load(self.path, ['mp4']))
+        self.assertIsNone(journal.load(self.path, ['mp4']))
+        journal.close()
+
+
+class TestWatchers(WatcherTestCase):
+    def test_stability(self):
+        self.write(self.path)
+        tracker = StabilityTracker(window=0.2)
+        tracker.touch(self.path)
+        self.assertEqual(tracker.ready(), [])
+
+        time.sleep(0.3)
+        self.write(self.path)
+        # Still growing, the window starts again
+        self.assertEqual(tracker.ready(), [])
+        time.sleep(0.3)
+        self.assertEqual(tracker.ready(), [self.path])
+        self.assertEqual(len(tracker), 0)
+
+    def test_polling(self):
+        watcher = PollingWatcher([self.tmp.name], interval=0)
+        self.write(self.path)
+        self.assertEqual(watcher.events(0), [self.path])
+        self.assertEqual(watcher.events(0), [])
+        self.write(self.path)
+        self.assertEqual(watcher.events(0), [self.path])
+
+    def test_inotify(self):
+        try:
+            watcher = InotifyWatcher([self.tmp.name])
+        except OSError:
+            self.skipTest('inotify is not available')
+
+        sub = os.path.join(self.tmp.name, 'sub')
+        os.mkdir(sub)
+        self.assertEqual(watcher.events(1), [])
+        self.write(os.path.join(sub, 'b.mkv'))
+        self.assertEqual(watcher.events(1), [os.path.join(sub, 'b.mkv')])
+        watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
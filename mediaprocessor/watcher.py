@@ -0,0 +1,340 @@
+"""
+Module watcher.py
+Watch-folder daemon. Directories are watched with inotify where it is available, and rescanned periodically
+otherwise. A file is only considered complete once it has been closed after writing (or moved into the directory)
+and its size and mtime have not changed for a stability window. Complete files go to a persistent JobQueue, and
+a bounded number of them are processed at a time by a pool of workers, see cli.py. The workers journal the state of
+each file in the same database, so that a file interrupted by a crash resumes where it was.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from mediaprocessor.cli import VIDEO_EXTENSIONS, WorkerPids, _init_worker, interrupt_workers, prepare_workers, \
+    process_file
+from mediaprocessor.jobqueue import JobQueue
+
+log = logging.getLogger(__name__)
+
+
+class PollingWatcher(object):
+    """
+    Finds new and modified files by rescanning the directories every interval seconds. The first call reports every
+    file already there.
+    """
+
+    def __init__(self, directories, recursive=True, interval=10):
+        self.directories = list(directories)
+        self.recursive = recursive
+        self.interval = interval
+        self._seen = {}
+        self._next_scan = 0
+
+    def scan(self) -> list:
+        found = {}
+        for directory in self.directories:
+            for path in self._walk(directory):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (st.st_size, st.st_mtime_ns)
+
+        changed = [path for path, stamp in found.items() if self._seen.get(path) != stamp]
+        self._seen = found
+        return changed
+
+    def _walk(self, directory):
+        if self.recursive:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    yield os.path.join(root, name)
+        else:
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    yield entry.path
+
+    def events(self, timeout) -> list:
+        """Waits up to timeout seconds and returns the files that changed, if it was time to rescan."""
+        now = time.monotonic()
+        if now < self._next_scan:
+            time.sleep(min(timeout, self._next_scan - now))
+            if time.monotonic() < self._next_scan:
+                return []
+        self._next_scan = time.monotonic() + self.interval
+        return self.scan()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Reports files closed after writing, or moved into the watched directories, through inotify. Subdirectories
+    created later are watched too when recursive. Raises OSError if inotify is not available.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _header = struct.Struct('iIII')
+
+    def __init__(self, directories, recursive=True):
+        self.recursive = recursive
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._watches = {}
+        self._polling = PollingWatcher(directories, recursive)
+        for directory in directories:
+            self._watch_tree(directory)
+
+    def _watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            log.warning('Cannot watch %s: %s', directory, os.strerror(ctypes.get_errno()))
+            return
+        self._watches[wd] = directory
+
+    def _watch_tree(self, directory):
+        self._watch(directory)
+        if self.recursive:
+            for root, dirs, _ in os.walk(directory):
+                for d in dirs:
+                    self._watch(os.path.join(root, d))
+
+    def scan(self) -> list:
+        """Every file currently in the watched directories, for files that arrived while nobody was watching."""
+        return self._polling.scan()
+
+    def events(self, timeout) -> list:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset + self._header.size <= len(data):
+            wd, mask, _, length = self._header.unpack_from(data, offset)
+            offset += self._header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                log.warning('inotify queue overflowed, rescanning')
+                paths.extend(self.scan())
+                continue
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+
+            path = os.path.join(self._watches[wd], name)
+            if mask & self.IN_ISDIR:
+                if self.recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # Files may have landed in the new directory before it was watched.
+                    self._watch_tree(path)
+                    paths.extend(self._polling._walk(path))
+                continue
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StabilityTracker(object):
+    """
+    Holds files until their size and mtime have not changed for window seconds, so that files still being written
+    (or copied by a tool that closes them several times) are not picked up too early.
+    """
+
+    def __init__(self, window=30):
+        self.window = window
+        self._candidates = {}
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def touch(self, path: str):
+        self._candidates[path] = (self._stamp(path), time.monotonic())
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def ready(self) -> list:
+        """Returns, and forgets, the files that have been stable for the window."""
+        now = time.monotonic()
+        ready = []
+        for path, (stamp, since) in list(self._candidates.items()):
+            if now - since < self.window:
+                continue
+            current = self._stamp(path)
+            if current is None:
+                del self._candidates[path]
+            elif current != stamp:
+                self._candidates[path] = (current, now)
+            else:
+                del self._candidates[path]
+                ready.append(path)
+        return ready
+
+
+class WatchDaemon(object):
+    """
+    Watches directories and processes the files that appear in them, queue_size at a time. Everything found is
+    recorded in a JobQueue first, so files still waiting, or being processed, when the daemon stops are processed
+    when it starts again.
+    """
+
+    def __init__(self, directories, targets, queue_path, config=None, workers=1, queue_size=None,
+                 stability_window=30, poll_interval=10, extensions=VIDEO_EXTENSIONS, recursive=True, notify=None,
+                 use_inotify=True, journal=True):
+        """
+        :param directories: directories to watch
+        :param targets: target containers, e.g. ['mp4']
+        :param queue_path: path to the JobQueue database
+        :param config: name of the configuration file, None for the default configuration
+        :param workers: number of files processed at the same time
+        :param queue_size: number of files handed to the workers at any time, defaults to twice the workers
+        :param stability_window: seconds a file's size and mtime must not change before it is processed
+        :param poll_interval: seconds between two rescans when inotify is not available
+        :param use_inotify: whether to try inotify before falling back to polling
+        :param journal: whether to journal the state of every file in the queue database, so that files interrupted
+        by a crash resume where they were
+        """
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.targets = targets
+        self.config = config
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size or 2 * self.workers
+        self.extensions = tuple('.' + e.lower().lstrip('.') for e in extensions)
+        self.notify = notify
+        self.queue = JobQueue(queue_path)
+        self.journal = queue_path if journal else None
+        self.tracker = StabilityTracker(stability_window)
+        self.stopping = threading.Event()
+        self._pids = None
+
+        self.watcher = None
+        if use_inotify:
+            try:
+                self.watcher = InotifyWatcher(self.directories, recursive)
+                log.info('Watching %s with inotify', ', '.join(self.directories))
+            except OSError:
+                log.info('inotify is not available, polling every %s seconds', poll_interval)
+        if self.watcher is None:
+            self.watcher = PollingWatcher(self.directories, recursive, poll_interval)
+
+    def wanted(self, path: str) -> bool:
+        name = os.path.basename(path)
+        if name.startswith('.') or '-working.' in name:
+            # Temporary files, ours included
+            return False
+        for directory in self.directories:
+            if path.startswith(directory + os.sep):
+                if any(part.startswith('.') for part in os.path.relpath(path, directory).split(os.sep)):
+                    # Our chunk directories, among others
+                    return False
+                break
+        return name.lower().endswith(self.extensions)
+
+    def stop(self):
+        """
+        Stops serving. The conversions running are cancelled, see interrupt_workers: the files being processed stay
+        in the queue, they are processed again when the daemon starts.
+        """
+        self.stopping.set()
+        pids = self._pids
+        if pids is not None:
+            interrupt_workers(pids)
+
+    def serve(self):
+        """Runs until stop() is called."""
+        recovered = self.queue.recover()
+        if recovered:
+            log.info('Resuming %d file(s) interrupted by the last shutdown', recovered)
+        for path in self.watcher.scan():
+            if self.wanted(path):
+                self.tracker.touch(path)
+
+        running = {}
+        prepare_workers(self.config, self.workers, self.targets)
+        pids = WorkerPids()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(self.config, self.workers, self.journal, pids)) as executor:
+            self._pids = pids
+            try:
+                while not self.stopping.is_set():
+                    self._step(executor, running)
+            finally:
+                self._pids = None
+                for future in running:
+                    future.cancel()
+
+            # Whatever did not complete, cancelled conversions included, stays running in the queue and is resumed
+            # on restart.
+            for future in wait(running).done:
+                if not future.cancelled() and future.exception() is None and future.result()['status'] == 'ok':
+                    self._record(future.result())
+
+        self.watcher.close()
+        self.queue.close()
+
+    def _step(self, executor, running):
+        for path in self.watcher.events(timeout=1 if running or len(self.tracker) else 5):
+            if self.wanted(path):
+                self.tracker.touch(path)
+
+        # Results before stable files, so that the files the workers deployed are known as ours.
+        if running:
+            done, _ = wait(running, timeout=0, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                try:
+                    self._record(future.result())
+                except (Exception, KeyboardInterrupt) as e:
+                    if self.stopping.is_set():
+                        # Interrupted by stop(), the file stays in the queue
+                        continue
+                    log.exception('Worker processing %s failed', path)
+                    self.queue.finish(path, ok=False, error=str(e))
+
+        for path in self.tracker.ready():
+            self.queue.add(path)
+
+        for path in self.queue.take(self.queue_size - len(running)):
+            running[executor.submit(process_file, path, self.targets, notify=self.notify)] = path
+
+    def _record(self, result):
+        for output in result.get('outputs', []):
+            self.queue.mark_output(output)
+        self.queue.finish(result['path'], ok=result['status'] == 'ok', error=result['error'])
+        log.info('%s: %s in %.1fs', result['path'], result['status'], result['seconds'])
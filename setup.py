@@ -18,6 +18,10 @@ setup(
     author='Jon',
     author_email='phtagn@gmail.com',
     description='Processes media files',
+    python_requires='>=3.10',
+    entry_points={
+        'console_scripts': ['mediaprocessor = mediaprocessor.cli:main']
+    },
     install_requires=[
         'babelfish',
         'qtfaststart',